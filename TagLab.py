@@ -23,6 +23,7 @@ import os
 import datetime
 import shutil
 import json
+import multiprocessing
 import numpy as np
 import urllib
 import platform
@@ -83,7 +84,7 @@ from source.QtExportAnnAsTable import QtExportAnnAsTable
 from source.QtTableLabel import QtTableLabel
 from source.QtProjectWidget import QtProjectWidget
 from source.QtProjectEditor import QtProjectEditor
-from source.Project import Project, loadProject
+from source.Project import Project, loadProject, BINARY_PROJECT_EXTENSION
 from source.Point import Point
 from source.Image import Image
 from source.MapClassifier import MapClassifier
@@ -101,6 +102,8 @@ import math
 
 from source.QtPanelInfo import QtPanelInfo
 from source.Sampler import Sampler
+from source.TiledImage import tile_cache
+from source.ProjectJournal import ProjectJournal, recoverableJournal, replay
 
 from source.QtImportViscoreWidget import QtImportViscoreWidget
 from source.QtCoralNetToolboxWidget import QtCoralNetToolboxWidget
@@ -188,6 +191,7 @@ class TagLab(QMainWindow):
         logfile.info("[INFO] Initizialization begins..")
 
         self.project = Project()         # current project
+        self.journal = None              # autosave journal of the current project
         self.last_image_loaded = None
 
         self.map_3D_filename = None    #refactor THIS!
@@ -692,6 +696,9 @@ class TagLab(QMainWindow):
         self.settings_widget.general_settings.researchFieldChanged[str].connect(self.researchFieldChanged)
         # self.settings_widget.general_settings.autosaveInfoChanged[int].connect(self.setAutosave)
         self.settings_widget.general_settings.autosaveInfoChanged[int].connect(self.setAutosave)
+        self.settings_widget.general_settings.tiledViewerChanged[bool].connect(self.viewerplus.setTiledViewer)
+        self.settings_widget.general_settings.tiledViewerChanged[bool].connect(self.viewerplus2.setTiledViewer)
+        self.settings_widget.general_settings.tileCacheSizeChanged[int].connect(self.setTileCacheSize)
 
         self.settings_widget.drawing_settings.borderPenChanged[str, int].connect(self.viewerplus.setBorderPen)
         self.settings_widget.drawing_settings.selectionPenChanged[str, int].connect(self.viewerplus.setSelectionPen)
@@ -956,13 +963,77 @@ class TagLab(QMainWindow):
 
             self.timer.timeout.connect(self.autosave)
             self.timer.start(interval * 60 * 1000)   # interval is in seconds
+
+            if self.journal is None:
+                self.startJournal()
         else:
             self.timer.stop()
+            self.closeJournal()
+
+    def startJournal(self):
+        """
+        Start to record the changes of the current project for the autosave (see ProjectJournal).
+        The project file is the base of the journal, so the project must have been just loaded or saved.
+        """
+        self.closeJournal()
+
+        if not self.timer.isActive() or self.project.filename is None or not os.path.exists(self.project.filename):
+            return
+
+        self.journal = ProjectJournal(self.project)
+        self.journal.start(self.project.filename)
+
+    def closeJournal(self):
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def recoverProject(self):
+        """
+        If the autosave journal of the loaded project contains unsaved changes (e.g. TagLab has been closed without
+        saving, or it crashed) it asks to the user to recover them. It returns True if the changes are recovered.
+        """
+        base, events = recoverableJournal(self.project.filename)
+        if base is None:
+            return False
+
+        reply = QMessageBox.question(self, self.TAGLAB_VERSION,
+                                     "This project has unsaved changes (autosave).\nDo you want to recover them?",
+                                     QMessageBox.Yes | QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return False
+
+        filename = self.project.filename
+        if os.path.abspath(base) != os.path.abspath(filename):
+            self.project = loadProject(self.taglab_dir, base, self.default_dictionary)
+            self.project.filename = filename
+            self.project.setCacheDir(self.project.cacheDir())
+
+        replay(self.project, events)
+
+        message = "[PROJECT] {:d} changes of the project {:s} have been recovered.".format(len(events), filename)
+        logfile.info(message)
+
+        return True
+
+    @pyqtSlot(int)
+    def setTileCacheSize(self, size_mb):
+        """
+        Set the memory budget (in MB) of the cache of the tiles used to visualize the maps by tiles.
+        """
+        tile_cache.setBudget(size_mb * 1024 * 1024)
 
     @pyqtSlot()
     def autosave(self):
-        filename, file_extension = os.path.splitext(self.project.filename)
-        self.project.save(filename + "_autosave.json")
+
+        if self.project.filename is None:
+            return
+
+        # only the changes are appended to the journal (the project is saved entirely from time to time)
+        if self.journal is None:
+            self.journal = ProjectJournal(self.project)
+        self.journal.autosave()
 
     # call by pressing right button
     def openContextMenu(self, position):
@@ -1126,7 +1197,7 @@ class TagLab(QMainWindow):
 
         exportShapefilesAct = QAction("Export Regions As Shapefile", self)
         # exportShapefilesAct.setShortcut('Ctrl+??')
-        exportShapefilesAct.setStatusTip("Export visible regions as shapefile")
+        exportShapefilesAct.setStatusTip("Export visible regions as shapefile or GeoPackage")
         exportShapefilesAct.triggered.connect(self.exportAnnAsShapefiles)
 
         exportDXFfilesAct = QAction("Export Regions As DXF", self)
@@ -1729,7 +1800,15 @@ class TagLab(QMainWindow):
             if reply != QMessageBox.Yes:
                 return
 
-        self.project.computeCorrespondences(img_source_index, img_target_index)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            self.project.computeCorrespondences(img_source_index, img_target_index)
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        corr = self.project.correspondences.get(key)
+        logfile.info("[OP-MATCH] Automatic matching '" + key + "': {:d} matches computed in {:.2f} seconds.".format(
+            len(corr.correspondences), corr.matching_time))
         self.compare_panel.setTable(self.project, img_source_index, img_target_index)
         self.setTool("MATCH")
 
@@ -2743,6 +2822,7 @@ class TagLab(QMainWindow):
         self.classifier_name = None
         self.network_name = None
         self.dataset_train_info = None
+        self.closeJournal()
         self.project = Project()
         self.project.loadDictionary(os.path.join(self.taglab_dir, self.default_dictionary))
         self.last_image_loaded = None
@@ -4565,7 +4645,7 @@ class TagLab(QMainWindow):
     @pyqtSlot()
     def openProject(self):
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json *.tlb)"
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
 
         if filename:
@@ -4590,12 +4670,14 @@ class TagLab(QMainWindow):
     @pyqtSlot()
     def saveAsProject(self):
 
-        filters = "ANNOTATION PROJECT (*.json)"
-        filename, _ = QFileDialog.getSaveFileName(self, "Save project", self.taglab_dir, filters)
+        filters = "ANNOTATION PROJECT (*.json);;BINARY ANNOTATION PROJECT (*.tlb)"
+        filename, selected_filter = QFileDialog.getSaveFileName(self, "Save project", self.taglab_dir, filters)
 
         if filename:
-            if not filename.endswith('.json'):
-                filename += '.json'
+            # the binary format is faster to save and load (see Project.saveBinary)
+            extension = BINARY_PROJECT_EXTENSION if selected_filter.startswith("BINARY") else '.json'
+            if not filename.endswith('.json') and not filename.endswith(BINARY_PROJECT_EXTENSION):
+                filename += extension
             dir = QDir(self.taglab_dir)
             self.project.filename = dir.relativeFilePath(filename)
             self.setProjectTitle(self.project.filename)
@@ -4607,7 +4689,7 @@ class TagLab(QMainWindow):
         Opens a previously saved project and append the annotated images to the current ones.
         """
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json *.tlb)"
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
         if filename:
             self.disableSplitScreen()
@@ -5169,17 +5251,26 @@ class TagLab(QMainWindow):
                 box.exec()
                 return
 
-        filters = "SHP (*.shp)"
-        output_filename, _ = QFileDialog.getSaveFileName(self, "Save Shapefile as", self.taglab_dir, filters)
+        filters = "SHP (*.shp);;GEOPACKAGE (*.gpkg)"
+        output_filename, selected_filter = QFileDialog.getSaveFileName(self, "Save Shapefile as", self.taglab_dir, filters)
 
         if output_filename:
+            # the GeoPackage has no limit on the length of the field names and it is faster to write
+            extension = '.gpkg' if selected_filter.startswith("GEOPACKAGE") else '.shp'
+            if not output_filename.endswith('.shp') and not output_filename.endswith('.gpkg'):
+                output_filename += extension
+
             blobs = self.activeviewer.annotations.seg_blobs
             gf = self.activeviewer.image.georef_filename
-            rasterops.write_shapefile(self.project, self.activeviewer.image, blobs, gf, output_filename)
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                rasterops.write_shapefile(self.project, self.activeviewer.image, blobs, gf, output_filename)
+            finally:
+                QApplication.restoreOverrideCursor()
 
             msgBox = QMessageBox(self)
             msgBox.setWindowTitle(self.TAGLAB_VERSION)
-            msgBox.setText("Shapefile exported successfully!")
+            msgBox.setText("Regions exported successfully!")
             msgBox.exec()
             return
 
@@ -5233,14 +5324,25 @@ class TagLab(QMainWindow):
 
             QApplication.setOverrideCursor(Qt.WaitCursor)
 
+            self.setupProgressBar()
+            self.progress_bar.showPerc()
+            self.progress_bar.setMessage("Export GeoTiff: ")
+            QApplication.processEvents()
+
+            def updateProgress(progress):
+                self.progress_bar.setProgress(progress)
+                QApplication.processEvents()
+
+            # the label map is painted and written by tiles, it is never stored entirely in memory
             size = QSize(self.activeviewer.image.width, self.activeviewer.image.height)
-            label_map_img = self.activeviewer.annotations.create_label_map(size, self.project.labels, None)
-            label_map_np = genutils.qimageToNumpyArray(label_map_img)
             georef_filename = self.activeviewer.image.georef_filename
             outfilename = os.path.splitext(output_filename)[0]
-            rasterops.saveGeorefLabelMap(label_map_np, georef_filename, self.project.working_area, outfilename)
-
-            QApplication.restoreOverrideCursor()
+            try:
+                rasterops.writeGeorefLabelMap(self.activeviewer.annotations, size, self.project.labels, georef_filename,
+                                              self.project.working_area, outfilename, progress=updateProgress)
+            finally:
+                self.deleteProgressBar()
+                QApplication.restoreOverrideCursor()
 
             msgBox = QMessageBox(self)
             msgBox.setWindowTitle(self.TAGLAB_VERSION)
@@ -5396,13 +5498,36 @@ class TagLab(QMainWindow):
                 new_dataset.save_samples("tiles_cut.png", show_tiles=True, show_areas=True, radii=None)
 
             # export the tiles
-            self.progress_bar.setMessage("Export tiles (it could take long)..")
-            self.progress_bar.setProgress(75.0)
+            self.progress_bar.showPerc()
+            self.progress_bar.showCancel()
+            self.progress_bar.setProgress(0.0)
+            self.progress_bar.setMessage("Export tiles: ")
             QApplication.processEvents()
 
+            def updateProgress(progress):
+                self.progress_bar.setProgress(progress)
+                QApplication.processEvents()
+
+            def exportCanceled():
+                QApplication.processEvents()
+                return self.progress_bar.canceled
+
             basename = self.newDatasetWidget.getDatasetFolder()
             tilename = self.newDatasetWidget.getTilePrefix()
-            new_dataset.export_tiles(basename=basename, tilename=tilename)
+            completed = new_dataset.export_tiles(basename=basename, tilename=tilename,
+                                                 progress=updateProgress, canceled=exportCanceled)
+
+            if not completed:
+                self.deleteProgressBar()
+                self.deleteNewDatasetWidget()
+                self.disableAreaSelection()
+                QApplication.restoreOverrideCursor()
+
+                msgBox = QMessageBox()
+                msgBox.setWindowTitle(self.TAGLAB_VERSION)
+                msgBox.setText("The export of the dataset has been canceled.")
+                msgBox.exec()
+                return
 
             # save the target pixel size
             target_pixel_size_file = os.path.join(basename, "target-pixel-size.txt")
@@ -5442,6 +5567,7 @@ class TagLab(QMainWindow):
         lr = self.trainYourNetworkWidget.getLR()
         L2 = self.trainYourNetworkWidget.getWeightDecay()
         batch_size = self.trainYourNetworkWidget.getBatchSize()
+        workers = self.trainYourNetworkWidget.getWorkers()
 
         if training_mode == "Preset 1":
             freeze_strategy = False
@@ -5469,7 +5595,7 @@ class TagLab(QMainWindow):
                                                                                           loss_to_use="FOCAL_TVERSKY", epochs_switch=0, epochs_transition=0,
                                                                                           learning_rate=lr, L2_penalty=L2, tversky_alpha=0.6, tversky_gamma=0.75,
                                                                                           optimiz=optimizer_name, freeze_strategy=freeze_strategy, flag_shuffle=True, flag_training_accuracy=False,
-                                                                                          progress=self.progress_bar)
+                                                                                          progress=self.progress_bar, workers=workers)
 
         ##### TEST
 
@@ -5490,7 +5616,7 @@ class TagLab(QMainWindow):
         metrics = training.testNetwork(images_dir_test, labels_dir_test, labels_dictionary=self.project.labels,
                                        target_classes=dataset_train_info.dict_target, dataset_train=dataset_train_info,
                                        network_filename=network_filename, output_folder=output_folder,
-                                       progress=self.progress_bar)
+                                       progress=self.progress_bar, workers=workers)
 
         # info about the classifier created
         self.classifier_name = classifier_name
@@ -5771,6 +5897,7 @@ class TagLab(QMainWindow):
         # TODO check if loadProject actually works!
         try:
             self.project = loadProject(self.taglab_dir, filename, self.default_dictionary)
+            recovered = self.recoverProject()
             self.connectProject()
         except Exception as e:
             box = QMessageBox()
@@ -5797,6 +5924,11 @@ class TagLab(QMainWindow):
         if self.timer is None:
             self.activateAutosave()
 
+        self.startJournal()
+        if recovered and self.journal is not None:
+            # the recovered changes are not in the project file
+            self.journal.compact()
+
         message = "[PROJECT] The project " + self.project.filename + " has been loaded."
         logfile.info(message)
         self.updateToolStatus()
@@ -5836,7 +5968,13 @@ class TagLab(QMainWindow):
         Save the current project.
         """
         QApplication.setOverrideCursor(Qt.WaitCursor)
+
+        # the genets are updated incrementally during the editing (see Genet.updateRegions)
+        if self.project.correspondences is not None and not self.project.genet.checkGenets():
+            logfile.info("[PROJECT] WARNING! Inconsistent genets have been found and recomputed.")
+
         self.project.save()
+        self.startJournal()
         QApplication.restoreOverrideCursor()
 
         if self.timer is None:
@@ -5976,7 +6114,6 @@ class TagLab(QMainWindow):
 
             self.classifier.run(1026, 513, 256, prediction_threshold=pred_thresh,
                                 save_scores=True,autocolor = checkColor, autolevel = checkLevel)
-            self.classifier.loadScores()
             self.showScores()
 
             self.deleteProgressBar()
@@ -6079,11 +6216,11 @@ class TagLab(QMainWindow):
                     self.progress_bar.setMessage("Finalizing classification results..")
                     QApplication.processEvents()
 
-                    filename = os.path.join("temp", "labelmap.png")
+                    label_map = self.classifier.labelMap()
 
                     offset = self.classifier.offset
                     scale = [self.classifier.scale_factor, self.classifier.scale_factor]
-                    created_blobs = self.activeviewer.annotations.import_label_map(filename, self.project.labels,
+                    created_blobs = self.activeviewer.annotations.import_label_map(label_map, self.project.labels,
                                                                                    offset, scale)
                     for blob in created_blobs:
                         self.viewerplus.addBlob(blob, selected=False)
@@ -6117,6 +6254,9 @@ class TagLab(QMainWindow):
 
 if __name__ == '__main__':
 
+    # the label maps import uses a pool of processes (see Annotation.import_label_map)
+    multiprocessing.freeze_support()
+
     # Create the QApplication.
     app = QApplication(sys.argv)
 
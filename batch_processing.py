@@ -3,65 +3,107 @@ import sys
 import glob
 import json
 import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PyQt5.QtCore import QDir, QSize
-from source.Project import Project, loadProject
+from source.Project import Project, ProjectEncoder, loadProject, BINARY_PROJECT_EXTENSION
 import torch
 import argparse
+import rasterio as rio
 from source.Image import Image
+from source.Blob import Blob
 from source.MapClassifier import MapClassifier
 
 class ProgressPrinter(object):
 
     def __init__(self, image_name):
         self.image_name = image_name
+        self.last_progress = -10.0
 
     def updateProgress(self, progress):
 
-        txt = "Classification of image '{:s}' ({:.2f}%)".format(self.image_name, progress)
-        print(txt)
-
+        # print only every 10% (several maps can be classified in parallel)
+        if progress - self.last_progress >= 10.0 or progress >= 100.0:
+            txt = "Classification of image '{:s}' ({:.2f}%)".format(self.image_name, progress)
+            print(txt)
+            self.last_progress = progress
 
-def applyClassifier(input_image, classifier_to_use, taglab_project, prediction_th, autocolor_flag, autolevels_flag, output_label_maps):
 
-    # setup the desired classifier
+def applyClassifier(classifier, input_image, taglab_project, taglab_dir, output_folder, prediction_th, autocolor_flag, autolevels_flag, output_label_maps, streaming=False, import_workers=None):
+    """
+    Classify the given image with an already loaded classifier. The created regions are added to the image
+    annotations and returned. The import_workers are the processes used to extract the regions from the label map
+    (None means one for each CPU).
+    """
 
     progress_printer = ProgressPrinter(input_image.name)
-
-    classifier = MapClassifier(classifier_to_use, taglab_project.labels)
     classifier.updateProgress.connect(progress_printer.updateProgress)
+    classifier.setLabels(taglab_project.labels)
+    classifier.flagStopProcessing = False
 
     # rescaling the map to fit the target scale of the network
 
     RGB_channel = input_image.getRGBChannel()
-    RGB_channel.loadData()
-    w = RGB_channel.qimage.width()
-    h = RGB_channel.qimage.height()
-    target_pixel_size = classifier_to_use['Scale']
-    classifier.setup(RGB_channel.qimage, input_image.pixelSize(), target_pixel_size,
-                     working_area=taglab_project.working_area, padding=256)
+    target_pixel_size = classifier.target_pixel_size
+
+    if streaming:
+        # the map is read by windows during the classification and the label map is written on disk
+        map_filename = os.path.join(taglab_dir, RGB_channel.filename)
+        with rio.open(map_filename) as src:
+            w = src.width
+            h = src.height
+        classifier.setupStreaming(map_filename, input_image.pixelSize(), target_pixel_size,
+                                  working_area=taglab_project.working_area, padding=256)
+        label_filename = os.path.join(output_folder, input_image.name + "_labels.tif")
+    else:
+        RGB_channel.loadData(taglab_dir)
+        w = RGB_channel.qimage.width()
+        h = RGB_channel.qimage.height()
+        classifier.setup(RGB_channel.qimage, input_image.pixelSize(), target_pixel_size,
+                         working_area=taglab_project.working_area, padding=256)
+        label_filename = None
 
     # runs the classifier
     classifier.run(1026, 513, 256, prediction_threshold=prediction_th,
-                   save_scores=False, autocolor=autocolor_flag, autolevel=autolevels_flag)
+                   save_scores=False, autocolor=autocolor_flag, autolevel=autolevels_flag,
+                   output_filename=label_filename)
 
-    if classifier.flagStopProcessing is False:
+    classifier.updateProgress.disconnect(progress_printer.updateProgress)
+
+    # the map is not needed anymore
+    classifier.input_image = None
+    if not streaming:
+        RGB_channel.qimage = None
 
-        filename = os.path.join("temp", "labelmap.png")
+    created_blobs = []
+
+    if classifier.flagStopProcessing is False:
 
         offset = classifier.offset
         scale = [classifier.scale_factor, classifier.scale_factor]
-        created_blobs = input_image.annotations.import_label_map(filename, taglab_project.labels, offset, scale)
+
+        if streaming:
+            # the regions are extracted window by window from the label map on disk
+            created_blobs = input_image.annotations.import_tiled_label_map(label_filename, taglab_project.labels,
+                                                                           offset, scale, workers=import_workers)
+        else:
+            created_blobs = input_image.annotations.import_label_map(classifier.labelMap(), taglab_project.labels,
+                                                                     offset, scale, workers=import_workers)
 
         for blob in created_blobs:
-            input_image.annotations.seg_blobs.append(blob)
+            input_image.annotations.addBlob(blob)
 
-        if output_label_maps == 1:
+        if streaming:
+            # the georeferenced label map of the working area has been already saved
+            pass
+        elif output_label_maps == 1:
             filename = input_image.name + ".png"
-            fileout = os.path.join(OUTPUT_FOLDER, filename)
+            fileout = os.path.join(output_folder, filename)
             input_image.annotations.export_image_data_for_Scripps(QSize(w, h), fileout, taglab_project)
         elif output_label_maps == 2:
             filename = input_image.name + ".png"
-            fileout = os.path.join(OUTPUT_FOLDER, filename)
+            fileout = os.path.join(output_folder, filename)
             wa = taglab_project.working_area
             taglab_project.working_area = [0, 0, w, h]  # update working area to the entire map
             input_image.annotations.export_image_data_for_Scripps(QSize(w, h), fileout, taglab_project)
@@ -69,9 +111,101 @@ def applyClassifier(input_image, classifier_to_use, taglab_project, prediction_t
 
     # reset GPU memory
     torch.cuda.empty_cache()
-    if classifier is not None:
-        del classifier
-        classifier = None
+
+    return created_blobs
+
+
+##### JOB QUEUE - one job for each image of each project, the state of the jobs is saved on disk to resume the runs
+
+def jobKey(project_filename, image_index, image, classifier_name):
+
+    key = "{:s}|{:d}|{:s}|{:s}".format(os.path.abspath(project_filename), image_index, image.name, classifier_name)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def loadJobState(state_folder, key):
+
+    filename = os.path.join(state_folder, key + ".json")
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def saveJobState(state_folder, key, state):
+
+    # write and rename, so an interrupted run never leaves a truncated state
+    filename = os.path.join(state_folder, key + ".json")
+    with open(filename + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(filename + ".tmp", filename)
+
+
+# each worker process loads the classifier (and the last used project) only once
+worker = {}
+
+def initWorker(classifier_info, taglab_dir, default_dictionary, options):
+
+    MapClassifier.setThreads(options["num_threads"], options["num_interop_threads"])
+
+    worker["classifier_info"] = classifier_info
+    worker["taglab_dir"] = taglab_dir
+    worker["default_dictionary"] = default_dictionary
+    worker["options"] = options
+    worker["classifier"] = None
+    worker["project_filename"] = None
+    worker["project"] = None
+
+def runJob(project_filename, image_index, key):
+
+    options = worker["options"]
+
+    if worker["project_filename"] != project_filename:
+        worker["project"] = loadProject(worker["taglab_dir"], project_filename, worker["default_dictionary"])
+        worker["project_filename"] = project_filename
+
+    project = worker["project"]
+    image = project.images[image_index]
+
+    if worker["classifier"] is None:
+        classifier = MapClassifier(worker["classifier_info"], project.labels)
+        classifier.batch_size = options["batch_size"]
+        classifier.mixed_precision = options["mixed_precision"]
+        classifier.channels_last = options["channels_last"]
+        classifier.release_network = False
+        worker["classifier"] = classifier
+
+    classifier = worker["classifier"]
+
+    start = time.time()
+    created_blobs = applyClassifier(classifier, image, project, worker["taglab_dir"], options["output_folder"],
+                                    options["prediction_threshold"], options["autocolor"], options["autolevels"],
+                                    options["output_label_maps"], options["streaming"], options["import_workers"])
+    end = time.time()
+
+    # the created regions are saved with the state of the job, the projects are saved when all their images are done
+    regions_filename = os.path.join(options["state_folder"], key + "_regions.json")
+    with open(regions_filename, "w") as f:
+        f.write(json.dumps(created_blobs, cls=ProjectEncoder))
+
+    # processed map pixels (at the original resolution)
+    mpix = classifier.wa_width * classifier.wa_height * classifier.scale_factor * classifier.scale_factor / 1.0e6
+
+    state = {
+        "project": os.path.abspath(project_filename),
+        "image": image.name,
+        "status": "done" if classifier.flagStopProcessing is False else "stopped",
+        "regions": len(created_blobs),
+        "tiles": classifier.processed_tiles,
+        "mpix": mpix,
+        "seconds": end - start
+    }
+    saveJobState(options["state_folder"], key, state)
+
+    return state
+
 
 if __name__ == '__main__':
 
@@ -80,9 +214,17 @@ if __name__ == '__main__':
     parser.add_argument("--projects_folder", type=str, default="", help="Folder containing the input projects")
     parser.add_argument("--classifier_name", type=str, default="", help="Classifier to use")
     parser.add_argument("--output_folder", type=str, default="", help="Output of the classification")
-    parser.add_argument("--output-label-maps", type=int, default=1, help="0: Not saved | 1: working area is saved | 2: entire map is saved")
+    parser.add_argument("--output-label-maps", type=int, default=None, help="0: Not saved | 1: working area is saved | 2: entire map is saved (default: 1)")
     parser.add_argument("--autocolor", type=bool, default=False, help="Automatic color adjustment")
     parser.add_argument("--autolevels", type=bool, default=False, help="Automatic level adjustments")
+    parser.add_argument("--streaming", action="store_true", help="Read the maps by windows and write the label maps of the working areas as tiled GeoTIFFs (for very large maps). Only --output-label-maps 1 is supported")
+    parser.add_argument("--batch_size", type=int, default=9, help="Number of tiles classified in a single forward pass")
+    parser.add_argument("--mixed_precision", action="store_true", help="Run the network in float16 (GPU) or bfloat16 (CPU)")
+    parser.add_argument("--channels_last", action="store_true", help="Use the channels-last memory layout for the network")
+    parser.add_argument("--num_threads", type=int, default=0, help="Number of CPU threads used by PyTorch (0: default)")
+    parser.add_argument("--num_interop_threads", type=int, default=0, help="Number of CPU inter-op threads used by PyTorch (0: default)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (each one loads the classifier)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the state of the previous runs and classify all the maps again")
 
     args = parser.parse_args()
 
@@ -90,11 +232,14 @@ if __name__ == '__main__':
 
     PROJECTS_FOLDER = args.projects_folder
     OUTPUT_FOLDER = args.output_folder
-    OUTPUT_LABEL_MAPS = args.output_label_maps
+    OUTPUT_LABEL_MAPS = 1 if args.output_label_maps is None else args.output_label_maps
     CLASSIFIER_NAME = args.classifier_name
     AUTOCOLOR = args.autocolor
     AUTOLEVELS = args.autolevels
     PREDICTION_THRESHOLD = 0.5
+    BATCH_SIZE = args.batch_size
+    STREAMING = args.streaming
+    WORKERS = max(1, args.workers)
 
     print("")
     print("* CONFIGURATION *")
@@ -103,7 +248,9 @@ if __name__ == '__main__':
     print("Projects folder:", PROJECTS_FOLDER)
     print("Output folder:", OUTPUT_FOLDER)
 
-    if OUTPUT_LABEL_MAPS == 0:
+    if STREAMING:
+        print("Output label maps: For each map, the label map of the working area is saved as a tiled GeoTIFF (streaming mode).")
+    elif OUTPUT_LABEL_MAPS == 0:
         print("Output label maps: Label maps are not saved.")
     elif OUTPUT_LABEL_MAPS == 1:
         print("Output label maps: For each map, the label map corresponding to the working area is saved.")
@@ -121,9 +268,18 @@ if __name__ == '__main__':
     else:
         print("White balance: NO")
 
+    print("Batch size:", BATCH_SIZE)
+    print("Mixed precision:", "YES" if args.mixed_precision else "NO")
+    print("Channels last:", "YES" if args.channels_last else "NO")
+    print("Workers:", WORKERS)
+
     print("------------------------------------------------")
     print("")
 
+    if STREAMING and OUTPUT_LABEL_MAPS != 1:
+        print("In streaming mode the label map of the working area is always saved (--output-label-maps 1) (!)")
+        sys.exit(-1)
+
     if not os.path.exists(PROJECTS_FOLDER):
         print("Projects folder does not exists (!)")
         sys.exit(-1)
@@ -148,29 +304,107 @@ if __name__ == '__main__':
     if not os.path.exists(OUTPUT_FOLDER):
         os.mkdir(OUTPUT_FOLDER)
 
+    # the state of the jobs is stored inside the output folder
+    STATE_FOLDER = os.path.join(OUTPUT_FOLDER, "batch_state")
+    if not os.path.exists(STATE_FOLDER):
+        os.mkdir(STATE_FOLDER)
+
     # create projects list
     projects = [x for x in glob.glob(os.path.join(PROJECTS_FOLDER, '*.json'))]
+    projects += glob.glob(os.path.join(PROJECTS_FOLDER, '*' + BINARY_PROJECT_EXTENSION))
 
-    ##### MAIN LOOP - run automatic recognition on all the images of all the projects and save the result
-
-    start = time.time()
+    ##### JOBS - one for each image of each project
 
+    jobs = {}  # project filename -> list of (image index, job key)
     for project_filename in projects:
-
-        # load project
         print("Loading project ->", os.path.basename(project_filename))
         project = loadProject(taglab_dir, project_filename, default_dictionary)
+        jobs[project_filename] = [(index, jobKey(project_filename, index, image, CLASSIFIER_NAME))
+                                  for index, image in enumerate(project.images)]
+        del project
+
+    pending_jobs = []
+    for project_filename, project_jobs in jobs.items():
+        for index, key in project_jobs:
+            state = loadJobState(STATE_FOLDER, key)
+            if args.restart or state is None or state["status"] != "done":
+                pending_jobs.append((project_filename, index, key))
+
+    total_jobs = sum([len(project_jobs) for project_jobs in jobs.values()])
+    print("Maps to classify: {:d} (already classified: {:d})".format(len(pending_jobs), total_jobs - len(pending_jobs)))
+
+    ##### MAIN LOOP - run automatic recognition on all the pending images and save the state of each one
+
+    options = {
+        "output_folder": OUTPUT_FOLDER,
+        "state_folder": STATE_FOLDER,
+        "output_label_maps": OUTPUT_LABEL_MAPS,
+        "prediction_threshold": PREDICTION_THRESHOLD,
+        "autocolor": AUTOCOLOR,
+        "autolevels": AUTOLEVELS,
+        "streaming": STREAMING,
+        "batch_size": BATCH_SIZE,
+        "mixed_precision": args.mixed_precision,
+        "channels_last": args.channels_last,
+        "num_threads": args.num_threads,
+        "num_interop_threads": args.num_interop_threads,
+        # the images classified in parallel extract their regions in a single process
+        "import_workers": None if WORKERS == 1 else 1
+    }
 
-        # apply the classifier
-        for image in project.images:
+    start = time.time()
 
-            pstart = time.time()
-            applyClassifier(image, selected_classifier, project, PREDICTION_THRESHOLD,
-                            AUTOCOLOR, AUTOLEVELS, OUTPUT_LABEL_MAPS)
-            pend = time.time()
+    completed = []
 
-            txt = "Image classified in {:.2f} seconds".format(pend-pstart)
-            print(txt)
+    if WORKERS == 1:
+        initWorker(selected_classifier, taglab_dir, default_dictionary, options)
+        for project_filename, index, key in pending_jobs:
+            try:
+                state = runJob(project_filename, index, key)
+            except Exception as e:
+                print("Image {:d} of '{:s}' not classified: {:s}".format(index, os.path.basename(project_filename), str(e)))
+                continue
+
+            print("Image '{:s}' classified in {:.2f} seconds".format(state["image"], state["seconds"]))
+            completed.append(state)
+    else:
+        # spawn: the workers must not inherit the CUDA and Qt state of the main process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=WORKERS, mp_context=context, initializer=initWorker,
+                                 initargs=(selected_classifier, taglab_dir, default_dictionary, options)) as executor:
+
+            futures = {executor.submit(runJob, project_filename, index, key): (project_filename, index)
+                       for project_filename, index, key in pending_jobs}
+
+            for future in as_completed(futures):
+                project_filename, index = futures[future]
+                try:
+                    state = future.result()
+                except Exception as e:
+                    print("Image {:d} of '{:s}' not classified: {:s}".format(index, os.path.basename(project_filename), str(e)))
+                    continue
+
+                print("Image '{:s}' classified in {:.2f} seconds".format(state["image"], state["seconds"]))
+                completed.append(state)
+
+    ##### SAVE - the projects whose images have all been classified are saved with the new regions
+
+    for project_filename, project_jobs in jobs.items():
+
+        states = [loadJobState(STATE_FOLDER, key) for index, key in project_jobs]
+        if any([state is None or state["status"] != "done" for state in states]):
+            print("Project '{:s}' not saved: some maps have not been classified".format(os.path.basename(project_filename)))
+            continue
+
+        project = loadProject(taglab_dir, project_filename, default_dictionary)
+        for index, key in project_jobs:
+            with open(os.path.join(STATE_FOLDER, key + "_regions.json"), "r") as f:
+                regions = json.load(f)
+            image = project.images[index]
+            for data in regions:
+                blob = Blob(None, 0, 0, 0)
+                blob.fromDict(data)
+                image.annotations.addBlob(blob)
 
         # save project
         print("Save result")
@@ -185,5 +419,15 @@ if __name__ == '__main__':
     txt = "Total processing time {:.2f} seconds".format(end-start)
     print(txt)
 
+    ##### THROUGHPUT SUMMARY
 
+    elapsed = max(end - start, 1.0e-6)
+    tiles = sum([state["tiles"] for state in completed])
+    mpix = sum([state["mpix"] for state in completed])
 
+    print("")
+    print("* SUMMARY *")
+    print("")
+    print("Maps classified: {:d}".format(len(completed)))
+    print("Tiles classified: {:d} ({:.2f} tiles/s)".format(tiles, tiles / elapsed))
+    print("Map area classified: {:.2f} MPix ({:.2f} MPix/s)".format(mpix, mpix / elapsed))
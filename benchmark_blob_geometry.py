@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of the geometry of the regions: contour coordinates conversion (createContourFromMask),
+perimeter (calculatePerimeter) and polygon creation (setupForDrawing), per-vertex loops vs NumPy.
+"""
+
+import math
+import time
+import argparse
+import numpy as np
+
+from PyQt5.QtGui import QPolygonF, QPainterPath
+from PyQt5.QtCore import QPointF
+
+from source.Blob import Blob
+
+
+# per-vertex implementations replaced by the NumPy ones of Blob (reference for the comparison)
+
+def loopMapCoordinates(contour, bbox, padding):
+
+    contour = contour.copy()
+    for i in range(contour.shape[0]):
+        ycoor = contour[i, 0]
+        xcoor = contour[i, 1]
+        contour[i, 0] = xcoor - padding + bbox[1]
+        contour[i, 1] = ycoor - padding + bbox[0]
+    return contour
+
+def loopPerimeter(contour):
+
+    px1 = contour[0, 0]
+    py1 = contour[0, 1]
+    N = contour.shape[0]
+    pxlast = contour[N-1, 0]
+    pylast = contour[N-1, 1]
+    perim = math.sqrt((px1-pxlast)*(px1-pxlast) + (py1-pylast)*(py1-pylast))
+    for i in range(1, contour.shape[0]):
+        px2 = contour[i, 0]
+        py2 = contour[i, 1]
+        perim += math.sqrt((px1 - px2)*(px1-px2) + (py1-py2)*(py1-py2))
+        px1 = px2
+        py1 = py2
+    return perim
+
+def loopQPolygonF(contour, shift):
+
+    qpolygon = QPolygonF()
+    for i in range(contour.shape[0]):
+        qpolygon << QPointF(contour[i, 0] + shift, contour[i, 1] + shift)
+    return qpolygon
+
+
+def timeit(function, repetitions):
+    """
+    It returns the best time (in milliseconds) of the given number of runs.
+    """
+    best = float('inf')
+    for i in range(repetitions):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000.0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vertices", type=int, nargs="+", default=[1000, 10000, 100000], help="Vertices of the contour")
+    parser.add_argument("--repetitions", type=int, default=5, help="Runs of each measure (the best one is reported)")
+    args = parser.parse_args()
+
+    blob = Blob(None, 0, 0, 0)
+    bbox = np.array([1000, 2000, 500, 500])
+
+    print("{:>10s} {:>16s} {:>12s} {:>12s} {:>10s}".format("vertices", "operation", "loop (ms)", "numpy (ms)", "speed-up"))
+
+    for n in args.vertices:
+
+        # a noisy circle, as the contours extracted by find_contours
+        t = np.linspace(0.0, 2.0 * np.pi, n, endpoint=False)
+        r = 250.0 + np.random.default_rng(0).uniform(-2.0, 2.0, n)
+        contour = np.stack([250.0 + r * np.sin(t), 250.0 + r * np.cos(t)], axis=1)
+
+        assert np.array_equal(loopMapCoordinates(contour, bbox, 4), Blob.toMapCoordinates(contour, bbox, 4))
+        assert abs(loopPerimeter(contour) - blob.calculateContourPerimeter(contour)) < 1e-6 * n
+
+        tests = [
+            ("coordinates", lambda: loopMapCoordinates(contour, bbox, 4), lambda: Blob.toMapCoordinates(contour, bbox, 4)),
+            ("perimeter", lambda: loopPerimeter(contour), lambda: blob.calculateContourPerimeter(contour)),
+            ("polygon", lambda: loopQPolygonF(contour, 0.5), lambda: Blob.toQPolygonF(contour, 0.5)),
+            ("path", lambda: QPainterPath().addPolygon(loopQPolygonF(contour, 0.5)),
+                     lambda: QPainterPath().addPolygon(Blob.toQPolygonF(contour, 0.5)))
+        ]
+
+        for name, loop, vectorized in tests:
+            loop_time = timeit(loop, args.repetitions)
+            numpy_time = timeit(vectorized, args.repetitions)
+            print("{:>10d} {:>16s} {:>12.3f} {:>12.3f} {:>9.1f}x".format(n, name, loop_time, numpy_time,
+                                                                      loop_time / numpy_time))
@@ -0,0 +1,150 @@
+"""
+Benchmark of the DeepLab V3+ in training and inference, in float32 and in mixed precision (float16 on the GPU,
+bfloat16 on the CPU), with the default and the channels-last memory layout. It reports the images per second
+and the peak memory of each configuration (useful to size the training and classification nodes).
+"""
+
+import sys
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from models.deeplab import DeepLab
+from models.precision import autocastDtype, createGradScaler
+
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on Windows
+
+
+# precision and memory layout of the compared configurations
+CONFIGURATIONS = [
+    ("fp32", False, False),
+    ("fp32 channels-last", False, True),
+    ("amp", True, False),
+    ("amp channels-last", True, True)
+]
+
+
+def peakMemory(device):
+    """
+    It returns the peak memory (in MB): the memory allocated by PyTorch on the GPU, the resident set size of the
+    process on the CPU.
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+
+    if resource is None:
+        return float('nan')
+
+    # kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def benchmark(mode, mixed_precision, channels_last, args):
+    """
+    It runs the network (inference, as the MapClassifier, or training steps) and returns the images per second
+    and the peak memory. It runs in a separate process, so the peak memory of each configuration is measured alone.
+    """
+    torch.manual_seed(0)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    device = torch.device(args.device)
+    dtype = autocastDtype(device)
+
+    net = DeepLab(backbone='resnet', output_stride=16, num_classes=args.classes)
+    net.to(device)
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+
+    images = torch.rand(args.batch_size, 3, args.tile_size, args.tile_size, device=device)
+    if channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+
+    if mode == "inference":
+
+        net.eval()
+
+        def step():
+            with torch.inference_mode(), torch.autocast(device.type, dtype=dtype, enabled=mixed_precision):
+                net(images).float()
+
+    else:
+
+        net.train()
+        labels = torch.randint(0, args.classes, (args.batch_size, args.tile_size, args.tile_size), device=device)
+        optimizer = torch.optim.SGD(net.parameters(), lr=0.0001, momentum=0.9)
+        scaler = createGradScaler(device, mixed_precision)
+        CEloss = nn.CrossEntropyLoss()
+
+        def step():
+            with torch.autocast(device.type, dtype=dtype, enabled=mixed_precision):
+                outputs = net(images)
+            loss = CEloss(outputs.float(), labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+
+    for i in range(args.warmup):
+        step()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.perf_counter()
+    for i in range(args.iterations):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    return (args.batch_size * args.iterations) / elapsed, peakMemory(device)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu", help="cpu or cuda")
+    parser.add_argument("--modes", type=str, nargs="+", default=["inference", "training"], help="inference and/or training")
+    parser.add_argument("--tile_size", type=int, default=513, help="Size of the input tiles (513 is the tile size of TagLab)")
+    parser.add_argument("--batch_size", type=int, default=4, help="Tiles in a single forward pass")
+    parser.add_argument("--classes", type=int, default=10, help="Number of output classes")
+    parser.add_argument("--warmup", type=int, default=1, help="Runs not measured")
+    parser.add_argument("--iterations", type=int, default=3, help="Measured runs")
+    parser.add_argument("--num_threads", type=int, default=0, help="Number of CPU threads used by PyTorch (0: default)")
+    args = parser.parse_args()
+
+    if args.device == "cuda" and not torch.cuda.is_available():
+        print("CUDA is not available (!)")
+        sys.exit(-1)
+
+    print("{:>10s} {:>20s} {:>12s} {:>14s} {:>10s}".format("mode", "configuration", "images/s", "peak mem (MB)", "speed-up"))
+
+    # each configuration runs in a new process
+    context = multiprocessing.get_context("spawn")
+
+    for mode in args.modes:
+
+        reference = None
+        for name, mixed_precision, channels_last in CONFIGURATIONS:
+
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    speed, memory = executor.submit(benchmark, mode, mixed_precision, channels_last, args).result()
+            except Exception as e:
+                print("{:>10s} {:>20s} not supported: {:s}".format(mode, name, str(e)))
+                continue
+
+            if reference is None:
+                reference = speed
+
+            print("{:>10s} {:>20s} {:>12.2f} {:>14.1f} {:>9.2f}x".format(mode, name, speed, memory, speed / reference))
@@ -0,0 +1,80 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from source.Project import loadProject, BINARY_PROJECT_EXTENSION
+
+
+class ProgressPrinter(object):
+
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+        self.last_progress = -10.0
+
+    def updateProgress(self, progress):
+
+        # print only every 10%
+        if progress - self.last_progress >= 10.0 or progress >= 100.0:
+            txt = "Caching of '{:s}' ({:.2f}%)".format(self.channel_name, progress)
+            print(txt)
+            self.last_progress = progress
+
+
+if __name__ == '__main__':
+
+    """
+    Build the on-disk overviews cache of all the maps (RGB and DEM channels) of the projects in a folder.
+    The cache is used when the maps are visualized by tiles (see the Settings).
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--projects_folder", type=str, default="", help="Folder containing the input projects")
+    parser.add_argument("--force", action="store_true", help="Rebuild the cache even if it is up-to-date")
+    args = parser.parse_args()
+
+    PROJECTS_FOLDER = args.projects_folder
+
+    if not os.path.exists(PROJECTS_FOLDER):
+        print("Projects folder does not exists (!)")
+        sys.exit(-1)
+
+    taglab_dir = os.getcwd()
+    default_dictionary = "dictionaries/scripps.json"
+
+    projects = [x for x in glob.glob(os.path.join(PROJECTS_FOLDER, '*.json')) if not x.endswith("_autosave.json")]
+    projects += glob.glob(os.path.join(PROJECTS_FOLDER, '*' + BINARY_PROJECT_EXTENSION))
+
+    start = time.time()
+
+    for project_filename in projects:
+
+        print("Loading project ->", os.path.basename(project_filename))
+        try:
+            project = loadProject(taglab_dir, project_filename, default_dictionary)
+        except Exception as e:
+            print("Project not loaded:", str(e))
+            continue
+
+        print("Cache folder ->", project.cacheDir())
+
+        for image in project.images:
+            for channel in image.channels:
+
+                pstart = time.time()
+                channel_name = image.name + " (" + channel.type + ")"
+                progress_printer = ProgressPrinter(channel_name)
+                try:
+                    channel.buildCache(taglab_dir, progress=progress_printer.updateProgress, force=args.force)
+                except Exception as e:
+                    print("Cache of '{:s}' not created: {:s}".format(channel_name, str(e)))
+                    continue
+                pend = time.time()
+
+                txt = "Map cached in {:.2f} seconds".format(pend - pstart)
+                print(txt)
+
+    end = time.time()
+
+    txt = "Total processing time {:.2f} seconds".format(end - start)
+    print(txt)
@@ -0,0 +1,81 @@
+"""
+Check that a project saved as json and as binary (without opening its images, as the regions of the
+images never opened are saved as they have been loaded) is reloaded with the same regions.
+The copies are saved next to the project, so the relative paths of the maps remain valid, and then removed.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+from source.Project import loadProject, ProjectEncoder, BINARY_PROJECT_EXTENSION
+
+
+def sameContour(contour1, contour2):
+
+    return contour1.shape == contour2.shape and np.allclose(contour1, contour2)
+
+
+def compareRegions(project1, project2):
+    """
+    It returns the number of regions compared and the number of regions with different contours.
+    """
+    regions = 0
+    mismatches = 0
+    for image1, image2 in zip(project1.images, project2.images):
+
+        blobs1 = image1.annotations.seg_blobs
+        blobs2 = image2.annotations.seg_blobs
+        mismatches += abs(len(blobs1) - len(blobs2))
+
+        for blob1, blob2 in zip(blobs1, blobs2):
+            regions += 1
+            if not sameContour(blob1.contour, blob2.contour) or len(blob1.inner_contours) != len(blob2.inner_contours) \
+                    or not all(sameContour(c1, c2) for c1, c2 in zip(blob1.inner_contours, blob2.inner_contours)):
+                mismatches += 1
+
+    return regions, mismatches
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", type=str, default="sampleProjects/multi-temporal_comparison_project.json",
+                        help="Input project (e.g. a project saved by an older version)")
+    parser.add_argument("--dictionary", type=str, default="dictionaries/scripps.json", help="Default dictionary")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.project):
+        print("Project does not exists (!)")
+        sys.exit(-1)
+
+    # loadProject asks for the maps not found
+    app = QApplication(sys.argv)
+
+    taglab_dir = os.getcwd()
+    basename = os.path.splitext(args.project)[0] + "_check"
+    json_filename = basename + ".json"
+    binary_filename = basename + BINARY_PROJECT_EXTENSION
+
+    project = loadProject(taglab_dir, args.project, args.dictionary)
+
+    try:
+        with open(json_filename, "w") as f:
+            f.write(json.dumps(project.__dict__, cls=ProjectEncoder, indent=1))
+        project.saveBinary(binary_filename)
+
+        json_project = loadProject(taglab_dir, json_filename, args.dictionary)
+        binary_project = loadProject(taglab_dir, binary_filename, args.dictionary)
+    finally:
+        for filename in [json_filename, binary_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    regions, mismatches = compareRegions(json_project, binary_project)
+    print("Regions compared:", regions)
+    print("Regions with different contours:", mismatches)
+
+    if mismatches > 0:
+        sys.exit(-1)
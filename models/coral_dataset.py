@@ -1,6 +1,7 @@
 from __future__ import print_function, division
 import sys
 import os
+import json
 import numpy as np
 from PIL import Image as PILimage
 import matplotlib.pyplot as plt
@@ -10,6 +11,61 @@ from torchvision import transforms
 import glob
 from albumentations import (CLAHE, Blur, HueSaturationValue, Equalize, ISONoise, Spatter, PixelDropout, FancyPCA, RandomToneCurve, CoarseDropout, RGBShift, RandomBrightnessContrast, Compose)
 from source.Label import Label
+from source import genutils
+
+# the labels of a dataset are cached (see CoralsDataset.loadCache) as uint8 maps of indices of a table of colors,
+# stored in a .npy file next to the labels folder, with a json sidecar containing the statistics of the dataset
+LABELS_CACHE_VERSION = 1
+LABELS_CACHE_UNKNOWN = 255     # index of the colors not in the table
+
+# the cache is built by a pool of worker processes when the tiles are many
+CACHE_PARALLEL_TILES = 64
+CACHE_CHUNK_SIZE = 32
+
+
+def colorCodes(data):
+
+    data = data.astype(np.int32)
+    return data[:, :, 0] + data[:, :, 1] * 256 + data[:, :, 2] * 65536
+
+
+def centerCropOffsets(data, crop_size):
+
+    return int((data.shape[0] - crop_size) / 2), int((data.shape[1] - crop_size) / 2)
+
+
+def cacheTiles(tiles, images_dir, labels_dir, cache_filename, colors, crop_size):
+    """
+    It converts the labels of a list of (slot, name) to maps of indices of the given colors and writes them in the
+    cache. It returns the number of pixels of each color and the sum of the channels of the images, both computed
+    on the center crop of the tiles. It runs in the worker processes of CoralsDataset.buildCache.
+    """
+    table = colorCodes(np.array(colors, dtype=np.int32).reshape(-1, 1, 3)).ravel()
+    order = np.argsort(table)
+    sorted_table = table[order]
+
+    cache = np.load(cache_filename, mmap_mode="r+")
+    color_counts = np.zeros(256, dtype=np.int64)
+    channel_sums = np.zeros(3, dtype=np.float64)
+
+    for slot, name in tiles:
+
+        codes = colorCodes(np.array(PILimage.open(os.path.join(labels_dir, name))))
+        pos = np.minimum(np.searchsorted(sorted_table, codes), len(sorted_table) - 1)
+        indices = np.where(sorted_table[pos] == codes, order[pos], LABELS_CACHE_UNKNOWN).astype(np.uint8)
+        cache[slot] = indices
+
+        oy, ox = centerCropOffsets(indices, crop_size)
+        color_counts += np.bincount(indices[oy:oy + crop_size, ox:ox + crop_size].ravel(), minlength=256)
+
+        data = np.array(PILimage.open(os.path.join(images_dir, name)), dtype=np.float32)
+        oy, ox = centerCropOffsets(data, crop_size)
+        channel_sums += data[oy:oy + crop_size, ox:ox + crop_size, :3].sum(axis=(0, 1), dtype=np.float64)
+
+    cache.flush()
+    del cache
+
+    return color_counts, channel_sums
 
 
 # ALBUMENTATIONS - USED JUST TO PERFORM THE COLOR AUGMENTATION
@@ -87,6 +143,165 @@ class CoralsDataset(Dataset):
         self.weights = None
         self.dataset_average = np.zeros(3, dtype=float)
 
+        # cached labels (see loadCache)
+        self.cache_info = None
+        self.cache_slots = None
+        self.cache_palette = None
+        self.cache_labels = None
+
+    def __getstate__(self):
+
+        # the memory-mapped cache is reopened by each DataLoader worker
+        state = self.__dict__.copy()
+        state["cache_labels"] = None
+        return state
+
+    def cacheFilenames(self):
+
+        folder = os.path.normpath(self.labels_dir)
+        return folder + "-cache.npy", folder + "-cache.json"
+
+    def cacheSignature(self):
+        """
+        Size and modification time of the images and the labels, used to check if the cache is up-to-date.
+        """
+        signature = {}
+        for name in self.images_names:
+            lbl = os.stat(os.path.join(self.labels_dir, name))
+            img = os.stat(os.path.join(self.images_dir, name))
+            signature[name] = [lbl.st_size, lbl.st_mtime_ns, img.st_size, img.st_mtime_ns]
+
+        return signature
+
+    def colorTable(self):
+        """
+        The colors of the labels (black first, it is also the color of the padding of the geometric transforms).
+        """
+        colors = [[0, 0, 0]]
+        for key in sorted(self.labels_dictionary.keys()):
+            color = [int(c) for c in self.labels_dictionary[key].fill[:3]]
+            if color not in colors:
+                colors.append(color)
+
+        return colors
+
+    def loadCache(self, build=True, workers=None):
+        """
+        Load the cached labels of the dataset, building (or updating) the cache if necessary.
+        The labels are stored as maps of indices of a table of colors, so the same cache works for any target
+        classes; the number of pixels of each color and the average of the images are stored in the sidecar.
+        It returns False if the labels are not cached (the dataset reads the label images).
+        """
+        cache_filename, info_filename = self.cacheFilenames()
+        signature = self.cacheSignature()
+        colors = self.colorTable()
+
+        info = None
+        if os.path.exists(cache_filename) and os.path.exists(info_filename):
+            try:
+                with open(info_filename, "r") as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                info = None
+
+        valid = info is not None and info.get("version") == LABELS_CACHE_VERSION \
+                and info.get("signature") == signature and all(color in info["colors"] for color in colors)
+
+        if not valid:
+            if not build:
+                return False
+            info = self.buildCache(signature, colors, workers)
+            if info is None:
+                return False
+
+        slots = {name: slot for slot, name in enumerate(info["names"])}
+        self.cache_slots = np.array([slots[name] for name in self.images_names], dtype=np.int64)
+
+        # unknown colors are shown as white
+        self.cache_palette = np.full((256, 3), 255, dtype=np.uint8)
+        self.cache_palette[:len(info["colors"])] = np.array(info["colors"], dtype=np.uint8)
+
+        self.cache_info = info
+        self.cache_labels = None
+
+        return True
+
+    def buildCache(self, signature, colors, workers=None):
+        """
+        Convert the labels to maps of indices of the colors and compute the statistics of the dataset.
+        The labels are converted by a pool of worker processes (workers=None means one for each CPU) when the
+        tiles are many. It returns the info of the cache (None if the labels cannot be cached).
+        """
+        cache_filename, info_filename = self.cacheFilenames()
+
+        names = list(self.images_names)
+        if len(names) == 0 or len(colors) >= LABELS_CACHE_UNKNOWN:
+            return None
+
+        # the maps are stored in a single array, so the tiles must have the same size
+        sizes = set([PILimage.open(os.path.join(self.labels_dir, name)).size for name in names])
+        if len(sizes) > 1:
+            return None
+        (w, h) = sizes.pop()
+
+        cache = np.lib.format.open_memmap(cache_filename, mode="w+", dtype=np.uint8, shape=(len(names), h, w))
+        del cache
+
+        tiles = list(enumerate(names))
+        args = (self.images_dir, self.labels_dir, cache_filename, colors, self.CROP_SIZE)
+
+        print("Caching the labels..")
+
+        results = list(genutils.parallelMap(cacheTiles, tiles, CACHE_CHUNK_SIZE, CACHE_PARALLEL_TILES, workers, args=args))
+
+        color_counts = sum([result[0] for result in results])
+        channel_sums = sum([result[1] for result in results])
+        average = channel_sums / (float(len(names)) * self.CROP_SIZE * self.CROP_SIZE * 255.0)
+
+        info = {"version": LABELS_CACHE_VERSION, "names": names, "signature": signature, "colors": colors,
+                "crop_size": self.CROP_SIZE, "color_counts": color_counts.tolist(), "average": average.tolist()}
+
+        with open(info_filename, "w") as f:
+            json.dump(info, f)
+
+        return info
+
+    def cachedLabels(self, idx):
+        """
+        It returns the cached map of indices of the colors of the idx-th label.
+        """
+        if self.cache_labels is None:
+            self.cache_labels = np.load(self.cacheFilenames()[0], mmap_mode="r")
+
+        return np.array(self.cache_labels[self.cache_slots[idx]])
+
+    def labelsLookupTable(self):
+        """
+        Color index -> class label, according to the current target classes.
+        """
+        lut = np.full(256, self.dict_target['Background'], dtype=np.int64)
+        colors = np.array(self.cache_info["colors"])
+
+        for key in self.dict_target.keys():
+            fill = self.labels_dictionary[key].fill
+            idx = np.where((colors[:, 0] == fill[0]) & (colors[:, 1] == fill[1]) & (colors[:, 2] == fill[2]))
+            lut[idx] = self.dict_target[key]
+
+        return lut
+
+    def labelTensors(self, image_label):
+        """
+        It returns the label image and the class labels as Pytorch tensors.
+        """
+        if self.cache_info is None:
+            return transforms.functional.to_tensor(image_label), self.imageLabelToLongTensor(image_label)
+
+        indices = np.array(image_label)
+        imglbl_tensor = transforms.functional.to_tensor(self.cache_palette[indices])
+        labels_tensor = torch.from_numpy(self.labelsLookupTable()[indices])
+
+        return imglbl_tensor, labels_tensor
+
 
     def augmentationSettings(self, range_T, range_R, range_scale, crop_size, augmentation_flip=True):
         """
@@ -168,7 +383,10 @@ class CoralsDataset(Dataset):
         img_filename = os.path.join(self.images_dir, self.images_names[idx])
         label_filename = os.path.join(self.labels_dir, self.images_names[idx])
         img = PILimage.open(img_filename)
-        imglbl = PILimage.open(label_filename)
+        if self.cache_info is not None:
+            imglbl = PILimage.fromarray(self.cachedLabels(idx))
+        else:
+            imglbl = PILimage.open(label_filename)
 
         # APPLY DATA AUGMENTATION
         if self.flagDataAugmentation:
@@ -239,11 +457,8 @@ class CoralsDataset(Dataset):
             # normalize directly the Pytorch tensor
             img_tensor = self.normalizeInputImage(img_tensor)
 
-            # PIL image -> Pytorch tensor
-            imglbl_tensor = transforms.functional.to_tensor(imglbl_augmented)
-
-            # create labels: from PIL image to Pytorch tensor
-            labels_tensor = self.imageLabelToLongTensor(imglbl_augmented)
+            # PIL image -> Pytorch tensor, create labels: from PIL image to Pytorch tensor
+            imglbl_tensor, labels_tensor = self.labelTensors(imglbl_augmented)
 
         else:
 
@@ -252,11 +467,8 @@ class CoralsDataset(Dataset):
             # normalize directly the Pytorch tensor
             img_tensor = self.normalizeInputImage(img_tensor)
 
-            # PIL image -> Pytorch tensor
-            imglbl_tensor = transforms.functional.to_tensor(imglbl)
-
-            # create labels: from PIL image to Pytorch tensor
-            labels_tensor = self.imageLabelToLongTensor(imglbl)
+            # PIL image -> Pytorch tensor, create labels: from PIL image to Pytorch tensor
+            imglbl_tensor, labels_tensor = self.labelTensors(imglbl)
 
         # image labels saves the label as image for check purposes
         sample = {'image': img_tensor, 'image_label': imglbl_tensor, 'labels': labels_tensor, 'name': sample_name}
@@ -333,24 +545,29 @@ class CoralsDataset(Dataset):
         class_sample_count = np.zeros(self.num_classes)
         N = len(self.images_names)
         print(" ")
-        for i, image_name in enumerate(self.images_names):
 
-            label_filename = os.path.join(self.labels_dir, image_name)
-            imglbl = PILimage.open(label_filename)
-            data = np.array(imglbl)
-            w = data.shape[1]
-            h = data.shape[0]
-            ox = int((w - self.CROP_SIZE) / 2)
-            oy = int((h - self.CROP_SIZE) / 2)
-            data_crop = data[oy:oy + self.CROP_SIZE, ox:ox + self.CROP_SIZE]
+        if self.cache_info is not None and self.cache_info["crop_size"] == self.CROP_SIZE:
+            # the pixels of each color are counted once, when the cache is built
+            np.add.at(class_sample_count, self.labelsLookupTable(), np.array(self.cache_info["color_counts"]))
+        else:
+            for i, image_name in enumerate(self.images_names):
 
-            labels = self.colorsToLabels(data_crop)
-            existing_labels, counts = np.unique(labels, return_counts=True)
+                label_filename = os.path.join(self.labels_dir, image_name)
+                imglbl = PILimage.open(label_filename)
+                data = np.array(imglbl)
+                w = data.shape[1]
+                h = data.shape[0]
+                ox = int((w - self.CROP_SIZE) / 2)
+                oy = int((h - self.CROP_SIZE) / 2)
+                data_crop = data[oy:oy + self.CROP_SIZE, ox:ox + self.CROP_SIZE]
 
-            for j in range(len(existing_labels)):
-                class_sample_count[existing_labels[j]] += counts[j]
+                labels = self.colorsToLabels(data_crop)
+                existing_labels, counts = np.unique(labels, return_counts=True)
 
-            sys.stdout.write("\rComputing frequencies... %.2f"% ((i * 100.0) / float(N)))
+                for j in range(len(existing_labels)):
+                    class_sample_count[existing_labels[j]] += counts[j]
+
+                sys.stdout.write("\rComputing frequencies... %.2f"% ((i * 100.0) / float(N)))
 
         true_dict_target = dict()
         tot = np.sum(class_sample_count)
@@ -383,6 +600,10 @@ class CoralsDataset(Dataset):
 
     def computeAverage(self):
 
+        if self.cache_info is not None and self.cache_info["crop_size"] == self.CROP_SIZE:
+            self.dataset_average[:] = self.cache_info["average"]
+            return
+
         sum = np.zeros((self.CROP_SIZE, self.CROP_SIZE, 3), dtype=np.float32)
         N = len(self.images_names)
         print(" ")
@@ -0,0 +1,20 @@
+import torch
+
+
+# mixed precision (AMP) settings shared by the training, the classification and the benchmark of the networks
+
+def autocastDtype(device):
+    """
+    Precision of the mixed precision mode: float16 on the GPU (with the scaling of the loss), bfloat16 on the CPU.
+    """
+    return torch.float16 if device.type == "cuda" else torch.bfloat16
+
+
+def createGradScaler(device, enabled):
+    """
+    Loss scaling for the float16 training (it does nothing if it is not enabled or on the CPU).
+    """
+    enabled = enabled and device.type == "cuda"
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
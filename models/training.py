@@ -1,5 +1,6 @@
 import sys
 import os
+import multiprocessing
 import numpy as np
 import torch
 import torch.multiprocessing
@@ -11,6 +12,7 @@ from sklearn.metrics import jaccard_score
 from sklearn.metrics import confusion_matrix
 from models.coral_dataset import CoralsDataset
 import models.losses as losses
+from models.precision import autocastDtype, createGradScaler
 from PyQt5.QtWidgets import QApplication
 from qhoptim.pyt import QHAdam
 
@@ -20,6 +22,9 @@ np.random.seed(997)
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
+# default number of the worker processes of each DataLoader (training, validation and test)
+DATALOADER_WORKERS = 2
+
 import glob
 import os
 
@@ -102,12 +107,15 @@ def saveMetrics(metrics, filename):
 # VALIDATION
 def evaluateNetwork(dataset, dataloader, loss_to_use, CEloss, w_for_GDL, tversky_loss_alpha, tversky_loss_beta,
                     focal_tversky_gamma, epoch, epochs_switch, epochs_transition, nclasses, net,
-                    progress, flag_compute_mIoU=False, flag_test=False, savefolder=""):
+                    progress, flag_compute_mIoU=False, flag_test=False, savefolder="", mixed_precision=False,
+                    channels_last=False):
     """
     It evaluates the network on the validation set.  
     :param dataloader: Pytorch DataLoader to load the dataset for the evaluation.
     :param net: Network to evaluate.
     :param savefolder: if a folder is given the classification results are saved into this folder. 
+    :param mixed_precision: if True the network runs with autocast (see autocastDtype).
+    :param channels_last: if True the images use the channels-last memory layout.
     :return: all the computed metrics.
     """""
 
@@ -115,11 +123,15 @@ def evaluateNetwork(dataset, dataloader, loss_to_use, CEloss, w_for_GDL, tversky
 
     USE_CUDA = torch.cuda.is_available()
 
+    device = torch.device("cpu")
     if USE_CUDA:
         device = torch.device("cuda")
         net.to(device)
         torch.cuda.synchronize()
 
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+
     ##### EVALUATION #####
 
     net.eval()  # set the network in evaluation mode
@@ -145,8 +157,13 @@ def evaluateNetwork(dataset, dataloader, loss_to_use, CEloss, w_for_GDL, tversky
                 batch_images = batch_images.to(device)
                 labels_batch = labels_batch.to(device)
 
+            if channels_last:
+                batch_images = batch_images.contiguous(memory_format=torch.channels_last)
+
             # N x K x H x W --> N: batch size, K: number of classes, H: height, W: width
-            outputs = net(batch_images)
+            with torch.autocast(device.type, dtype=autocastDtype(device), enabled=mixed_precision):
+                outputs = net(batch_images)
+            outputs = outputs.float()
 
             # predictions size --> N x H x W
             values, predictions_t = torch.max(outputs, 1)
@@ -255,6 +272,30 @@ def computeLoss(loss_name, CE, w_for_GDL, tversky_alpha, tversky_beta, focal_tve
     return loss
 
 
+def seedWorker(worker_id):
+    """
+    Seed NumPy in the DataLoader workers (the data augmentation uses it), otherwise they generate the same
+    random transforms.
+    """
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def createDataLoader(dataset, batch_size, shuffle, workers=None):
+    """
+    DataLoader with the given number of worker processes (None means DATALOADER_WORKERS, 0 loads the data in the
+    main process). The workers are kept alive between the epochs and they are spawned, since forking a process
+    that has already initialized CUDA is not safe.
+    """
+    if workers is None:
+        workers = DATALOADER_WORKERS
+
+    context = multiprocessing.get_context("spawn") if workers > 0 else None
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers, drop_last=True,
+                      pin_memory=True, persistent_workers=workers > 0, worker_init_fn=seedWorker,
+                      multiprocessing_context=context)
+
+
 def updateProgressBar(progress_bar, prefix_message, num_iter, total_iter):
     """
     Update progress bar according to the number of iterations done.
@@ -271,7 +312,8 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
                     labels_dictionary, target_classes, output_classes, save_network_as, classifier_name,
                     epochs, epochs_stage1, epochs_stage2, batch_sz, batch_mult, learning_rate, L2_penalty, validation_frequency, loss_to_use,
                     epochs_switch, epochs_transition, tversky_alpha, tversky_gamma, optimiz, freeze_strategy,
-                    flag_shuffle, flag_training_accuracy, progress):
+                    flag_shuffle, flag_training_accuracy, progress, workers=None, mixed_precision=False,
+                    channels_last=False):
 
     ##### DATA #####
 
@@ -279,6 +321,7 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
     datasetTrain = CoralsDataset(images_folder_train, labels_folder_train, labels_dictionary, target_classes)
 
     print("Dataset setup..", end='')
+    datasetTrain.loadCache()
     datasetTrain.computeAverage()
     datasetTrain.computeWeights()
     print(datasetTrain.dict_target)
@@ -294,17 +337,16 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
     datasetVal = CoralsDataset(images_folder_val, labels_folder_val, labels_dictionary, datasetTrain.dict_target)
     datasetVal.dataset_average = datasetTrain.dataset_average
     datasetVal.weights = datasetTrain.weights
+    datasetVal.loadCache()
 
     #AUGUMENTATION IS NOT APPLIED ON THE VALIDATION SET
     datasetVal.disableAugumentation()
 
     # setup the data loader
-    dataloaderTrain = DataLoader(datasetTrain, batch_size=batch_sz, shuffle=flag_shuffle, num_workers=0, drop_last=True,
-                                 pin_memory=True)
+    dataloaderTrain = createDataLoader(datasetTrain, batch_sz, flag_shuffle, workers)
 
     validation_batch_size = 4
-    dataloaderVal = DataLoader(datasetVal, batch_size=validation_batch_size, shuffle=False, num_workers=0, drop_last=True,
-                                 pin_memory=True)
+    dataloaderVal = createDataLoader(datasetVal, validation_batch_size, False, workers)
 
     training_images_number = len(datasetTrain.images_names)
     validation_images_number = len(datasetVal.images_names)
@@ -376,6 +418,11 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
         device = torch.device("cpu")
 
     net.to(device)
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+
+    # the loss is scaled to avoid the underflow of the float16 gradients
+    scaler = createGradScaler(device, mixed_precision)
 
     ##### TRAINING LOOP #####
 
@@ -449,17 +496,23 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
                 images_batch = images_batch.to(device)
                 labels_batch = labels_batch.to(device)
 
-            # forward+loss+backward
-            outputs = net(images_batch)
+            if channels_last:
+                images_batch = images_batch.contiguous(memory_format=torch.channels_last)
+
+            # forward+loss+backward (the loss is computed in float32)
+            with torch.autocast(device.type, dtype=autocastDtype(device), enabled=mixed_precision):
+                outputs = net(images_batch)
+            outputs = outputs.float()
 
             loss = computeLoss(loss_to_use, CEloss, w_for_GDL, tversky_loss_alpha, tversky_loss_beta, focal_tversky_gamma,
                                epoch, epochs_switch, epochs_transition, labels_batch, outputs)
 
-            loss.backward()
+            scaler.scale(loss).backward()
 
             # TO AVOID MEMORY TROUBLE UPDATE WEIGHTS EVERY BATCH SIZE x BATCH MULT
             if (i+1)% batch_mult == 0:
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
 
             print(epoch, i, loss.item())
@@ -479,7 +532,8 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
                                                          tversky_loss_alpha, tversky_loss_beta, focal_tversky_gamma,
                                                          epoch, epochs_switch, epochs_transition,
                                                          output_classes, net, progress, flag_compute_mIoU=False,
-                                                         flag_test=False)
+                                                         flag_test=False, mixed_precision=mixed_precision,
+                                                         channels_last=channels_last)
             accuracy = metrics_val['Accuracy']
             jaccard_score = metrics_val['JaccardScore']
             scheduler.step(mean_loss_val)
@@ -493,7 +547,9 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
                                                                  tversky_loss_alpha, tversky_loss_beta, focal_tversky_gamma,
                                                                  epoch, epochs_switch, epochs_transition,
                                                                  output_classes, net, progress,
-                                                                 flag_compute_mIoU=False, flag_test=False)
+                                                                 flag_compute_mIoU=False, flag_test=False,
+                                                                 mixed_precision=mixed_precision,
+                                                                 channels_last=channels_last)
                 accuracy_training = metrics_train['Accuracy']
                 jaccard_training = metrics_train['JaccardScore']
 
@@ -578,7 +634,7 @@ def trainingNetwork(images_folder_train, labels_folder_train, images_folder_val,
 
 
 def testNetwork(images_folder, labels_folder, labels_dictionary, target_classes, dataset_train,
-                network_filename, output_folder, progress):
+                network_filename, output_folder, progress, workers=None, mixed_precision=False, channels_last=False):
     """
     Load a network and test it on the test dataset.
     :param network_filename: Full name of the network to load (PATH+name)
@@ -592,12 +648,12 @@ def testNetwork(images_folder, labels_folder, labels_dictionary, target_classes,
     datasetTest.weights = dataset_train.weights
     datasetTest.dataset_average = dataset_train.dataset_average
     datasetTest.dict_target = dataset_train.dict_target
+    datasetTest.loadCache()
 
     output_classes = dataset_train.num_classes
 
     batchSize = 4
-    dataloaderTest = DataLoader(datasetTest, batch_size=batchSize, shuffle=False, num_workers=0, drop_last=True,
-                            pin_memory=True)
+    dataloaderTest = createDataLoader(datasetTest, batchSize, False, workers)
 
     # DEEPLAB V3+
     net = DeepLab(backbone='resnet', output_stride=16, num_classes=output_classes)
@@ -610,7 +666,8 @@ def testNetwork(images_folder, labels_folder, labels_dictionary, target_classes,
     print("Weights loaded.")
 
     metrics_test, loss = evaluateNetwork(datasetTest, dataloaderTest, "NONE", None, [0.0], 0.0, 0.0, 0.0, 0, 0, 0,
-                                         output_classes, net, progress, True, True, output_folder)
+                                         output_classes, net, progress, True, True, output_folder,
+                                         mixed_precision, channels_last)
     metrics_filename = network_filename[:len(network_filename) - 4] + "-test-metrics.txt"
     saveMetrics(metrics_test, metrics_filename)
     print("***** TEST FINISHED *****")
@@ -21,6 +21,7 @@ import os
 import re
 import csv
 import sys
+import heapq
 from datetime import datetime
 
 from PyQt5.QtWidgets import QMessageBox
@@ -37,18 +38,183 @@ from source import genutils
 
 import numpy as np
 import pandas as pd
+import rasterio as rio
+from rasterio.windows import Window
 from scipy import ndimage as ndi
 from skimage.morphology import binary_dilation, binary_erosion
 from skimage.segmentation import watershed
-from source.Blob import Blob
+from source.Blob import Blob, RegionMask, blobsFromRegionMasks, blobsFromScaledRegionMasks, IMPORT_CHUNK_SIZE
 from source.Point import Point
 import source.Mask as Mask
 from source.Label import Label
+from source.SpatialIndex import SpatialIndex
 from coraline.Coraline import segment, mutual
 
 
 # from PIL import Image as Img  #for debug
 
+# the label maps with many regions are imported in parallel (see import_label_map)
+IMPORT_PARALLEL_REGIONS = 1000
+
+# memory (in bytes) of the strips of rows used to export the label maps (see export_label_map)
+LABEL_MAP_STRIP_BUDGET = 64 * 1024 * 1024
+
+# the tiled label maps are imported by windows of this size (see import_tiled_label_map)
+LABEL_MAP_WINDOW_SIZE = 2048
+
+
+def readLabelCodes(src, row, col, h, w):
+    """
+    It reads a window of a label map (a rasterio dataset) as color codes (R + G * 256 + B * 65536).
+    """
+    data = src.read([1, 2, 3], window=Window(col, row, w, h)).astype(np.int32)
+    return data[0] + (data[1] << 8) + (data[2] << 16)
+
+
+def tiledLabelMapComponents(src, window_size):
+    """
+    It finds the regions (connected components of the same color) of a label map window by window: the components
+    of each window are merged with the ones of the previous windows along the seams (union-find), so only a window
+    is in memory at a time. Black is the background and never forms a region (as in import_label_map).
+    It returns the color code, the area, the bbox (min_row, min_col, max_row, max_col) and a pixel (row, col)
+    of each region.
+    """
+    W = src.width
+    H = src.height
+
+    parents = []
+    codes = []
+    areas = []
+    bboxes = []
+    seeds = []
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def globalIds(labels, base):
+        # -1 is the background
+        return np.where(labels > 0, labels.astype(np.int64) + base - 1, -1)
+
+    def merge(ids, neighbour_ids):
+        for a, b in np.unique(np.stack([ids, neighbour_ids], axis=1), axis=0):
+            ra = find(int(a))
+            rb = find(int(b))
+            if ra != rb:
+                parents[max(ra, rb)] = min(ra, rb)
+
+    # components and colors of the last row of the previous row of windows (-1 is the background)
+    above_ids = np.full(W, -1, dtype=np.int64)
+    above_codes = np.zeros(W, dtype=np.int32)
+
+    for row in range(0, H, window_size):
+        h = min(window_size, H - row)
+        left_ids = None
+        left_codes = None
+
+        for col in range(0, W, window_size):
+            w = min(window_size, W - col)
+
+            window_codes = readLabelCodes(src, row, col, h, w)
+            labels, n = measure.label(window_codes, connectivity=1, background=0, return_num=True)
+
+            # the components of the window are numbered after the previous ones
+            base = len(parents)
+
+            if n > 0:
+                flat = labels.ravel()
+                values, first = np.unique(flat, return_index=True)
+                first = first[values > 0]
+                component_codes = np.zeros(n + 1, dtype=np.int32)
+                component_codes[flat] = window_codes.ravel()
+
+                parents.extend(range(base, base + n))
+                codes.append(component_codes[1:])
+                areas.append(np.bincount(flat, minlength=n + 1)[1:])
+                seeds.append(np.stack([first // w + row, first % w + col], axis=1))
+                bboxes.append(np.array([[sl[0].start + row, sl[1].start + col, sl[0].stop + row, sl[1].stop + col]
+                                        for sl in ndi.find_objects(labels)], dtype=np.int64))
+
+                # the components touching the windows above and on the left
+                top_ids = globalIds(labels[0], base)
+                same = (top_ids >= 0) & (above_ids[col:col + w] >= 0) & (window_codes[0] == above_codes[col:col + w])
+                merge(top_ids[same], above_ids[col:col + w][same])
+
+                if left_ids is not None:
+                    border_ids = globalIds(labels[:, 0], base)
+                    same = (border_ids >= 0) & (left_ids >= 0) & (window_codes[:, 0] == left_codes)
+                    merge(border_ids[same], left_ids[same])
+
+            left_ids = globalIds(labels[:, -1], base)
+            left_codes = window_codes[:, -1].copy()
+            above_ids[col:col + w] = globalIds(labels[-1], base)
+            above_codes[col:col + w] = window_codes[-1]
+
+    if len(parents) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.int64), \
+               np.zeros((0, 2), dtype=np.int64)
+
+    # the components of each region
+    roots = np.array(parents, dtype=np.int64)
+    while True:
+        grand_parents = roots[roots]
+        if np.array_equal(grand_parents, roots):
+            break
+        roots = grand_parents
+
+    codes = np.concatenate(codes)
+    areas = np.concatenate(areas)
+    bboxes = np.concatenate(bboxes)
+    seeds = np.concatenate(seeds)
+
+    regions, inverse = np.unique(roots, return_inverse=True)
+    region_areas = np.bincount(inverse, weights=areas, minlength=len(regions)).astype(np.int64)
+    region_bboxes = bboxes[regions].copy()
+    np.minimum.at(region_bboxes[:, 0], inverse, bboxes[:, 0])
+    np.minimum.at(region_bboxes[:, 1], inverse, bboxes[:, 1])
+    np.maximum.at(region_bboxes[:, 2], inverse, bboxes[:, 2])
+    np.maximum.at(region_bboxes[:, 3], inverse, bboxes[:, 3])
+
+    return codes[regions], region_areas, region_bboxes, seeds[regions]
+
+
+def tiledLabelMapMasks(src, codes, bboxes, seeds, indices, window_size):
+    """
+    It extracts the masks of the given regions (see tiledLabelMapComponents) from a label map. The regions are
+    grouped by the window containing the top-left corner of their bbox and each group is read at once; the regions
+    larger than a window are read alone. It yields, for each group, a list of (index, RegionMask).
+    """
+    groups = {}
+    for i in indices:
+        (r0, c0, r1, c1) = bboxes[i]
+        if r1 - r0 <= window_size and c1 - c0 <= window_size:
+            key = (r0 // window_size, c0 // window_size, -1)
+        else:
+            key = (r0 // window_size, c0 // window_size, i)
+        groups.setdefault(key, []).append(i)
+
+    for key in sorted(groups.keys()):
+        group = groups[key]
+        top = min([bboxes[i][0] for i in group])
+        left = min([bboxes[i][1] for i in group])
+        bottom = max([bboxes[i][2] for i in group])
+        right = max([bboxes[i][3] for i in group])
+        window_codes = readLabelCodes(src, top, left, bottom - top, right - left)
+
+        masks = []
+        for i in group:
+            (r0, c0, r1, c1) = bboxes[i]
+            mask = window_codes[r0 - top:r1 - top, c0 - left:c1 - left] == codes[i]
+
+            # the bbox can contain other regions of the same color
+            labels, _ = ndi.label(mask)
+            mask = labels == labels[seeds[i][0] - r0, seeds[i][1] - c0]
+            masks.append((i, RegionMask((r0, c0, r1, c1), mask)))
+
+        yield masks
+
 # refactor: change name to annotationS
 class Annotation(object):
     """
@@ -64,6 +230,19 @@ class Annotation(object):
         self.annpoints = []
         self.annotationsDict = {}
 
+        # spatial index of the bounding boxes of the regions (kept in sync by addBlob/removeAnn)
+        self.spatial_index = SpatialIndex()
+
+        # id -> region and id -> point maps (kept in sync by addBlob/addPoint/removeAnn)
+        self.blobs_by_id = {}
+        self.points_by_id = {}
+
+        # free ids: the ids below next_id are used or stored in the heap (the heap may contain ids used again)
+        self.free_blob_ids = []
+        self.next_blob_id = 0
+        self.free_point_ids = []
+        self.next_point_id = 0
+
         # relative weight of depth map for refine borders
         # refactor: this is to be saved and loaded in qsettings
         self.refine_depth_weight = 0.0
@@ -76,20 +255,21 @@ class Annotation(object):
     def addPoint(self, point):
 
 
-        used = [point.id for point in self.annpoints]
-        if point.id in used:
+        if point.id in self.points_by_id:
             point.id = self.getFreePointId()
         self.annpoints.append(point)
+        self.points_by_id[point.id] = point
 
         self.table_needs_update = True
 
 
     def addBlob(self, blob):
 
-        used = [blob.id for blob in self.seg_blobs]
-        if blob.id in used:
+        if blob.id in self.blobs_by_id:
             blob.id = self.getFreeId()
         self.seg_blobs.append(blob)
+        self.blobs_by_id[blob.id] = blob
+        self.spatial_index.insert(blob, blob.bbox)
 
         self.table_needs_update = True
 
@@ -108,6 +288,10 @@ class Annotation(object):
                 print("WARNING!! point to be removed not found !")
             else:
                 del self.annpoints[index]
+                if self.points_by_id.get(point.id) is point:
+                    del self.points_by_id[point.id]
+                    if point.id < self.next_point_id:
+                        heapq.heappush(self.free_point_ids, point.id)
                 self.table_needs_update = True
         else:
             blob = blob_or_point
@@ -120,6 +304,11 @@ class Annotation(object):
                 print("WARNING!! region to be removed not found !")
             else:
                 del self.seg_blobs[index]
+                self.spatial_index.remove(blob)
+                if self.blobs_by_id.get(blob.id) is blob:
+                    del self.blobs_by_id[blob.id]
+                    if blob.id < self.next_blob_id:
+                        heapq.heappush(self.free_blob_ids, blob.id)
                 self.table_needs_update = True
 
     def updateBlob(self, old_blob, new_blob):
@@ -143,16 +332,10 @@ class Annotation(object):
             point.class_name = class_name
 
     def blobById(self, id):
-        for blob in self.seg_blobs:
-            if blob.id == id:
-                return blob
-        return None
+        return self.blobs_by_id.get(id)
 
     def pointById(self, id):
-        for point in self.annpoints:
-            if point.id == id:
-                return point
-        return None
+        return self.points_by_id.get(id)
 
     def blobByGenet(self, genet):
         return [blob for blob in self.seg_blobs if blob.genet == genet]
@@ -184,22 +367,31 @@ class Annotation(object):
         return last_blobs_added
 
     def getFreeId(self):
-        used = []
-        for blob in self.seg_blobs:
-            used.append(blob.id)
-        for id in range(len(used)):
-            if id not in used:
-                return id
-        return len(used)
+        """
+        It returns the smallest id not used by the regions (the id is not reserved).
+        """
+        # discard the ids used again after they have been freed
+        while self.free_blob_ids and self.free_blob_ids[0] in self.blobs_by_id:
+            heapq.heappop(self.free_blob_ids)
+        if self.free_blob_ids:
+            return self.free_blob_ids[0]
+
+        while self.next_blob_id in self.blobs_by_id:
+            self.next_blob_id += 1
+        return self.next_blob_id
 
     def getFreePointId(self):
-        used = []
-        for annpoint in self.annpoints:
-            used.append(annpoint.id)
-        for id in range(len(used)):
-            if id not in used:
-                return id
-        return len(used)
+        """
+        It returns the smallest id not used by the annotation points (the id is not reserved).
+        """
+        while self.free_point_ids and self.free_point_ids[0] in self.points_by_id:
+            heapq.heappop(self.free_point_ids)
+        if self.free_point_ids:
+            return self.free_point_ids[0]
+
+        while self.next_point_id in self.points_by_id:
+            self.next_point_id += 1
+        return self.next_point_id
 
     def union(self, blobs):
         """
@@ -213,7 +405,7 @@ class Annotation(object):
         (mask, box) = Mask.jointMask(box, box)
 
         for blob in blobs:
-            Mask.paintMask(mask, box, blob.getMask(), blob.bbox, 1)
+            Mask.paintMask(mask, box, blob.getMask(copy=False), blob.bbox, 1)
 
         if mask.any():
             # measure is brutally slower with non int types (factor 4), while byte&bool would be faster by 25%, conversion is fast.
@@ -227,7 +419,7 @@ class Annotation(object):
         """
         Update the blobA subtracting the blobB from it
         """
-        (mask, box) = Mask.subtract(blobA.getMask(), blobA.bbox, blobB.getMask(), blobB.bbox)
+        (mask, box) = Mask.subtract(blobA.getMask(copy=False), blobA.bbox, blobB.getMask(copy=False), blobB.bbox)
 
         if mask.any():
             # measure is brutally slower with non int types (factor 4), while byte&bool would be faster by 25%, conversion is fast.
@@ -247,7 +439,7 @@ class Annotation(object):
         box = wa.copy()
 
         for blob in inner_blobs:
-            Mask.paintMask(mask, box, blob.getMask().astype(np.uint8), blob.bbox, 1)
+            Mask.paintMask(mask, box, blob.getMask(copy=False).astype(np.uint8), blob.bbox, 1)
 
         inversemask = 1 - mask
         area_min = 0.0
@@ -259,12 +451,12 @@ class Annotation(object):
         """
         Update the blobA by adding to it the intersection between the blobB and the blobC
         """
-        mask_intersect, bbox_intersect = Mask.intersectMask(blobB.getMask(), blobB.bbox, blobC.getMask(), blobC.bbox)
+        mask_intersect, bbox_intersect = Mask.intersectMask(blobB.getMask(copy=False), blobB.bbox, blobC.getMask(copy=False), blobC.bbox)
 
         bbox = Mask.jointBox([blobA.bbox, bbox_intersect])
         (mask, bbox) = Mask.jointMask(bbox, bbox)
 
-        Mask.paintMask(mask, bbox, blobA.getMask(), blobA.bbox, 1)
+        Mask.paintMask(mask, bbox, blobA.getMask(copy=False), blobA.bbox, 1)
         Mask.paintMask(mask, bbox, mask_intersect, bbox_intersect, 1)
 
         if mask.any():
@@ -565,9 +757,9 @@ class Annotation(object):
 
         blobs_clicked = []
 
-        for blob in self.seg_blobs:
+        point = np.array([[x, y]])
+        for blob in self.spatial_index.queryPoint(x, y):
 
-            point = np.array([[x, y]])
             out = measure.points_in_poly(point, blob.contour)
             if out[0] == True:
                 blobs_clicked.append(blob)
@@ -604,18 +796,37 @@ class Annotation(object):
     ###########################################################################
     ### IMPORT / EXPORT
 
-    def create_label_map(self, size, labels_dictionary, working_area):
+    def label_map_order(self):
         """
-        Create a label map as a QImage and returns it.
+        Position of the regions in the drawing order of the label map (id(blob) -> index).
         """
-        # create a transparent canvas of the same size of your map
-        w = size.width()
-        h = size.height()
+        return {id(blob): i for i, blob in enumerate(self.seg_blobs)}
 
-        imagebox = [0, 0, h, w]
-        image = np.zeros([h, w, 4], np.uint8)  # 4 channels for RGBA
+    def render_label_window(self, window, size, labels_dictionary, order=None):
+        """
+        It paints the regions of a window (top, left, width, height) of the label map of a map of the given size,
+        and returns it as a RGBA array. Only the regions intersecting the window are painted; the result is the
+        same window of the label map of the whole map.
+        """
+        top, left, width, height = [int(v) for v in window]
+        image = np.zeros([height, width, 4], np.uint8)  # 4 channels for RGBA
 
-        for i, blob in enumerate(self.seg_blobs):
+        # the borders depend on the pixels around the window, so the canvas is 1 pixel larger
+        # (within the map)
+        imagebox = [max(top - 1, 0), max(left - 1, 0), min(top + height + 1, size.height()),
+                    min(left + width + 1, size.width())]
+        if imagebox[0] >= imagebox[2] or imagebox[1] >= imagebox[3]:
+            return image
+
+        canvas = np.zeros([imagebox[2] - imagebox[0], imagebox[3] - imagebox[1], 4], np.uint8)
+
+        querybox = [imagebox[0], imagebox[1], imagebox[3] - imagebox[1], imagebox[2] - imagebox[0]]
+        blobs = [blob for blob in self.spatial_index.query(querybox) if Mask.checkIntersection(querybox, blob.bbox)]
+        if order is None:
+            order = self.label_map_order()
+        blobs.sort(key=lambda blob: order[id(blob)])
+
+        for blob in blobs:
 
             if blob.qpath_gitem is not None:
                 if not blob.qpath_gitem.isVisible():
@@ -627,14 +838,16 @@ class Annotation(object):
                 rgb = labels_dictionary[blob.class_name].fill
                 rgba = [rgb[0], rgb[1], rgb[2], 255]  # Add full opacity
 
-            mask = blob.getMask().astype(bool)  # bool is required for bitmask indexing
+            mask = blob.getMask(copy=False).astype(bool)  # bool is required for bitmask indexing
             box = blob.bbox.copy()  # blob.bbox is top, left, width, height
             (box[2], box[3]) = (box[3] + box[0], box[2] + box[1])  # box is now startx, starty, endx, endy
 
             # range is the interection of box and imagebox
             range = [max(box[0], imagebox[0]), max(box[1], imagebox[1]), min(box[2], imagebox[2]),
                      min(box[3], imagebox[3])]
-            subimage = image[range[0] - imagebox[0]:range[2] - imagebox[0],
+            if range[0] >= range[2] or range[1] >= range[3]:
+                continue
+            subimage = canvas[range[0] - imagebox[0]:range[2] - imagebox[0],
                        range[1] - imagebox[1]:range[3] - imagebox[1]]
             submask = mask[range[0] - box[0]:range[2] - box[0], range[1] - box[1]:range[3] - box[1]]
 
@@ -648,20 +861,58 @@ class Annotation(object):
             samecolor = np.all(subimage[:, :, :3] == rgba[:3], axis=-1)
             subimage[border & samecolor] = [0, 0, 0, 255]  # Black border with full opacity
 
-        labelimg = genutils.rgbaToQImage(image)
+        # copy the window (the part inside the map)
+        r0 = max(top, 0)
+        c0 = max(left, 0)
+        r1 = min(top + height, size.height())
+        c1 = min(left + width, size.width())
+        if r0 < r1 and c0 < c1:
+            image[r0 - top:r1 - top, c0 - left:c1 - left] = canvas[r0 - imagebox[0]:r1 - imagebox[0],
+                                                                  c0 - imagebox[1]:c1 - imagebox[1]]
+        return image
+
+    def create_label_map(self, size, labels_dictionary, working_area):
+        """
+        Create a label map as a QImage and returns it. If the working area is given only the working area is
+        painted (see render_label_window).
+        """
+        if working_area is None:
+            window = [0, 0, size.width(), size.height()]
+        else:
+            window = working_area
+
+        image = self.render_label_window(window, size, labels_dictionary)
+        return genutils.rgbaToQImage(image)
 
-        if working_area is not None:
-            # FIXME: this is inefficient! The working_area should be used during the drawing.
-            labelimg_cropped = genutils.cropQImage(labelimg, working_area)
-            return labelimg_cropped
+    def export_label_map(self, filename, size, labels_dictionary, working_area, progress=None):
+        """
+        Save the label map (of the working area, if given) as a PNG image. The label map is painted and written
+        by strips of rows, so the memory used does not depend on the size of the map.
+        """
+        if working_area is None:
+            window = [0, 0, size.width(), size.height()]
         else:
-            return labelimg
+            window = [int(v) for v in working_area]
+
+        top, left, width, height = window
+        strip_height = max(1, min(height, LABEL_MAP_STRIP_BUDGET // (4 * max(width, 1))))
+        order = self.label_map_order()
+
+        writer = genutils.PNGWriter(filename, width, height)
+        try:
+            for row in range(0, height, strip_height):
+                rows = min(strip_height, height - row)
+                writer.write(self.render_label_window([top + row, left, width, rows], size, labels_dictionary, order))
+                if progress is not None:
+                    progress(100.0 * (row + rows) / height)
+        finally:
+            writer.close()
 
     def calculate_inner_blobs(self, working_area):
         """
         This consider only blobs falling ENTIRELY in the working area"
         """
-        selected_blobs = self.seg_blobs
+        selected_blobs = self.spatial_index.query(working_area)
         inner_blobs = []
         for blob in selected_blobs:
             if Mask.insideBox(working_area, blob.bbox):
@@ -673,7 +924,7 @@ class Annotation(object):
         """
         This consider only blobs inside or intersecting the working area"
         """
-        selected_blobs = self.seg_blobs
+        selected_blobs = self.spatial_index.query(working_area)
         intersecting_blobs = []
         for blob in selected_blobs:
             if Mask.checkIntersection(working_area, blob.bbox):
@@ -725,12 +976,16 @@ class Annotation(object):
         return count
 
 
-    def import_label_map(self, filename, labels_dictionary, offset, scale, create_holes=False):
+    def import_label_map(self, filename, labels_dictionary, offset, scale, create_holes=False, workers=None):
         """
-        It imports a label map and create the corresponding blobs.
+        It imports a label map (a filename or a QImage) and create the corresponding blobs.
         The offset is stored as a [top, left] coordinates and scale are the scale factors of X and Y axis respectively.
+        The contours of the regions are extracted by a pool of worker processes (workers=None means one for each
+        CPU) when the regions are many.
+        The black pixels are the background: they never form a region, also when create_holes is True (the holes
+        are the regions of the colors not in the labels dictionary).
         """
-        qimg_label_map = QImage(filename)
+        qimg_label_map = filename if isinstance(filename, QImage) else QImage(filename)
         qimg_label_map = qimg_label_map.convertToFormat(QImage.Format_RGB32)
 
         # label map rescaling (if necessary)
@@ -743,33 +998,89 @@ class Annotation(object):
 
         # RGB -> label code association (ok, it is a dirty trick but it saves time..)
         label_coded = label_map[:, :, 0] + (label_map[:, :, 1] << 8) + (label_map[:, :, 2] << 16)
+        del label_map
 
         labels = measure.label(label_coded, connectivity=1)
 
+        # the pixels of a region have all the same color (code), the class is looked up once for each color
+        codes = np.zeros(labels.max() + 1, dtype=np.int32)
+        codes[labels.ravel()] = label_coded.ravel()
+        del label_coded
+
+        classes = {}
+        for key in labels_dictionary.keys():
+            c = labels_dictionary[key].fill
+            classes.setdefault(int(c[0]) + (int(c[1]) << 8) + (int(c[2]) << 16), labels_dictionary[key].name)
+
+        region_classes = {code: classes.get(code, "Empty") for code in np.unique(codes).tolist()}
+
         too_much_small_area = 50
-        region_big = None
+        areas = np.bincount(labels.ravel())
+
+        # the regions to create (the holes are discarded before extracting their contours)
+        regions = []
+        for index, slices in enumerate(ndi.find_objects(labels)):
+            label = index + 1
+            if slices is None or areas[label] <= too_much_small_area:
+                continue
+
+            class_name = region_classes[int(codes[label])]
+            if create_holes or class_name != 'Empty':
+                bbox = (slices[0].start, slices[1].start, slices[0].stop, slices[1].stop)
+                regions.append((RegionMask(bbox, labels[slices] == label), class_name))
+
+        del labels
 
         offset_x = offset[1]
         offset_y = offset[0]
-        created_blobs = []
-        for region in measure.regionprops(labels):
-            if region.area > too_much_small_area:
-                id = len(self.seg_blobs)
+        id = self.getFreeId()
+
+        results = genutils.parallelMap(blobsFromRegionMasks, regions, IMPORT_CHUNK_SIZE, IMPORT_PARALLEL_REGIONS,
+                                       workers, args=(offset_x, offset_y, id))
+        created_blobs = [blob for blobs in results for blob in blobs]
+
+        return created_blobs
+
+    def import_tiled_label_map(self, filename, labels_dictionary, offset, scale, create_holes=False, workers=None,
+                               window_size=LABEL_MAP_WINDOW_SIZE):
+        """
+        It imports a label map stored in a (tiled) GeoTIFF, e.g. written by the classifier in streaming mode, and
+        creates the corresponding blobs. The parameters are the ones of import_label_map, but the label map is never
+        loaded entirely: the regions are found window by window (see tiledLabelMapComponents) and their contours are
+        extracted at the scale of the label map and then scaled, so the memory does not grow with the size of the map.
+        As in import_label_map, the black pixels are the background and never form a region, also when create_holes
+        is True.
+        """
+        classes = {}
+        for key in labels_dictionary.keys():
+            c = labels_dictionary[key].fill
+            classes.setdefault(int(c[0]) + (int(c[1]) << 8) + (int(c[2]) << 16), labels_dictionary[key].name)
+
+        too_much_small_area = 50
+
+        offset_x = offset[1]
+        offset_y = offset[0]
+        id = self.getFreeId()
+
+        with rio.open(filename) as src:
 
-                blob = Blob(region, offset_x, offset_y, self.getFreeId())
+            codes, areas, bboxes, seeds = tiledLabelMapComponents(src, window_size)
 
-                # assign class
-                row = region.coords[0, 0]
-                col = region.coords[0, 1]
-                color = label_map[row, col]
+            # the regions to create (the holes are discarded before extracting their contours)
+            class_names = {}
+            for i in range(len(codes)):
+                class_name = classes.get(int(codes[i]), "Empty")
+                if areas[i] * scale[0] * scale[1] > too_much_small_area and (create_holes or class_name != 'Empty'):
+                    class_names[i] = class_name
 
-                for key in labels_dictionary.keys():
-                    c = labels_dictionary[key].fill
-                    if c[0] == color[0] and c[1] == color[1] and c[2] == color[2]:
-                        blob.class_name = labels_dictionary[key].name
-                        break
-                if create_holes or blob.class_name != 'Empty':
-                    created_blobs.append(blob)
+            # the masks are extracted window by window while the chunks already extracted are processed
+            masks = tiledLabelMapMasks(src, codes, bboxes, seeds, list(class_names.keys()), window_size)
+            regions = ((mask, class_names[i]) for window_masks in masks for i, mask in window_masks)
+
+            results = genutils.parallelMap(blobsFromScaledRegionMasks, regions, IMPORT_CHUNK_SIZE,
+                                           IMPORT_PARALLEL_REGIONS, workers, args=(offset_x, offset_y, scale, id),
+                                           count=len(class_names))
+            created_blobs = [blob for blobs in results for blob in blobs]
 
         return created_blobs
 
@@ -788,11 +1099,12 @@ class Annotation(object):
         if working_area is None:
             # all the blobs are considered
             self.blobs = self.seg_blobs
+            annpoints = self.annpoints
 
         else:
             # only blobs and points inside the working area are considered
             self.blobs = self.calculate_inner_blobs(working_area)
-            self.annpoints = self.calculate_inner_points(working_area)
+            annpoints = self.calculate_inner_points(working_area)
 
         visible_blobs = []
 
@@ -804,7 +1116,7 @@ class Annotation(object):
 
         visible_points = []
 
-        for annpoint in self.annpoints:
+        for annpoint in annpoints:
             if annpoint.cross1_gitem.isVisible():
                 point_id = annpoint.id
                 pointindexlist.append(point_id)
@@ -1007,8 +1319,7 @@ class Annotation(object):
         return df
 
     def export_image_data_for_Scripps(self, size, filename, project):
-        label_map = self.create_label_map(size, labels_dictionary=project.labels, working_area=project.working_area)
-        label_map.save(filename, 'png')
+        self.export_label_map(filename, size, labels_dictionary=project.labels, working_area=project.working_area)
 
     def computeBBoxWithAffineTransform(self, rot, tra) -> QRectF:
         """
@@ -19,12 +19,14 @@
 
 import math
 import copy
+import weakref
+import threading
+from collections import OrderedDict
 import numpy as np
 
 from skimage import measure
 from scipy import ndimage as ndi
 from PyQt5.QtGui import QPainterPath, QPolygonF
-from PyQt5.QtCore import QPointF
 
 from skimage.morphology import square, binary_dilation, binary_erosion
 from skimage.measure import points_in_poly
@@ -36,6 +38,172 @@ from source import genutils
 
 import time
 
+# memory (in bytes) used to cache the masks of the regions (see MaskCache)
+MASK_CACHE_BUDGET = 256 * 1024 * 1024
+
+# the label maps and the shapefiles with many regions are imported in parallel by chunks of regions
+# (see blobsFromRegionMasks and blobsFromPolygons)
+IMPORT_CHUNK_SIZE = 500
+
+
+class MaskCache(object):
+    """
+    Cache of the masks of the regions (see Blob.getMask) with a global memory budget: when the budget is exceeded
+    the least recently used masks are discarded. The mask is stored in the region together with the geometry it
+    has been created from (contours and bbox), so it is not used anymore when the geometry is replaced.
+    """
+
+    def __init__(self, budget):
+
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()   # id(blob) -> (weakref(blob), size of the mask)
+        self.lock = threading.Lock()
+
+    def geometry(self, blob):
+        return (blob.contour, list(blob.inner_contours), tuple(np.asarray(blob.bbox).tolist()))
+
+    def get(self, blob):
+
+        entry = blob.mask_cache
+        if entry is None:
+            return None
+
+        (mask, contour, inner_contours, bbox) = entry
+        (current_contour, current_inner_contours, current_bbox) = self.geometry(blob)
+        valid = contour is current_contour and bbox == current_bbox and len(inner_contours) == len(current_inner_contours) \
+                and all(a is b for a, b in zip(inner_contours, current_inner_contours))
+
+        with self.lock:
+            key = id(blob)
+            registered = key in self.entries and self.entries[key][0]() is blob
+            if valid and registered:
+                self.entries.move_to_end(key)
+                return mask
+
+        self.discard(blob)
+        return None
+
+    def put(self, blob, mask):
+
+        self.discard(blob)
+        if mask.nbytes > self.budget // 8:
+            return
+
+        with self.lock:
+            key = id(blob)
+            if key in self.entries:
+                # the id of a deleted region
+                self.size -= self.entries.pop(key)[1]
+
+            blob.mask_cache = (mask,) + self.geometry(blob)
+            self.entries[key] = (weakref.ref(blob), mask.nbytes)
+            self.size += mask.nbytes
+
+            while self.size > self.budget:
+                (ref, size) = self.entries.popitem(last=False)[1]
+                self.size -= size
+                evicted = ref()
+                if evicted is not None:
+                    evicted.mask_cache = None
+
+    def discard(self, blob):
+
+        blob.mask_cache = None
+        with self.lock:
+            key = id(blob)
+            if key in self.entries and self.entries[key][0]() is blob:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+
+        with self.lock:
+            for ref, size in self.entries.values():
+                blob = ref()
+                if blob is not None:
+                    blob.mask_cache = None
+            self.entries.clear()
+            self.size = 0
+
+
+mask_cache = MaskCache(MASK_CACHE_BUDGET)
+
+
+class RegionMask(object):
+    """
+    Minimal replacement of the skimage RegionProperties used to create a Blob (see Blob.__init__):
+    the bbox (min_row, min_col, max_row, max_col) and the mask cropped according to it.
+    """
+
+    def __init__(self, bbox, image):
+        self.bbox = bbox
+        self.image = image
+
+    @property
+    def centroid(self):
+        rows, cols = np.nonzero(self.image)
+        return (rows.mean() + self.bbox[0], cols.mean() + self.bbox[1])
+
+
+def blobsFromRegionMasks(regions, offset_x, offset_y, id):
+    """
+    It creates the blobs of a list of (RegionMask, class name). It runs in the worker processes of the
+    label maps import (see Annotation.import_label_map).
+    """
+    blobs = []
+    for region, class_name in regions:
+        blob = Blob(region, offset_x, offset_y, id)
+        blob.class_name = class_name
+        blobs.append(blob)
+
+    return blobs
+
+
+def scaleContour(contour, scale, offset_x, offset_y):
+    """
+    It maps a contour (x, y) extracted from a downsampled mask to the map (pixel centers are preserved).
+    """
+    return np.stack([(contour[:, 0] + 0.5) * scale[0] - 0.5 + offset_x,
+                     (contour[:, 1] + 0.5) * scale[1] - 0.5 + offset_y], axis=1)
+
+
+def blobsFromScaledRegionMasks(regions, offset_x, offset_y, scale, id):
+    """
+    Same as blobsFromRegionMasks, but the masks have a different scale than the map: the contours are extracted
+    from the masks and then scaled (scale = [sx, sy]), so the masks are never resampled at the scale of the map.
+    It runs in the worker processes of the tiled label maps import (see Annotation.import_tiled_label_map).
+    """
+    blobs = []
+    for region, class_name in regions:
+        scaled = Blob(region, 0, 0, id)
+        outer = scaleContour(scaled.contour, scale, offset_x, offset_y)
+        inners = [scaleContour(inner, scale, offset_x, offset_y) for inner in scaled.inner_contours]
+
+        blob = Blob(None, 0, 0, id)
+        if not blob.createFromPolygon(outer, inners):
+            continue
+        blob.class_name = class_name
+        blob.instance_name = "region" + str(id)
+        blobs.append(blob)
+
+    return blobs
+
+
+def blobsFromPolygons(polygons):
+    """
+    It creates the blobs of a list of polygons (outer ring, inner rings, valid) in pixel coordinates. It runs in
+    the worker processes of the shapefiles import (see RasterOps.read_regions_geometry).
+    """
+    blobs = []
+    for outer, inners, valid in polygons:
+        blob = Blob(None, 0, 0, 0)
+        if not valid or not blob.createFromPolygon(outer, inners):
+            blob.createFromPolygon(outer, inners, rasterise=True)
+        blobs.append(blob)
+
+    return blobs
+
+
 class Blob(object):
     """
     Blob data. A blob is a group of pixels.
@@ -70,6 +238,9 @@ class Blob(object):
 
         self.correspondence_to_check = False
 
+        # cached mask (see getMask)
+        self.mask_cache = None
+
         if region:
 
             # extract properties
@@ -147,6 +318,9 @@ class Blob(object):
         #no deep copy for qobjects
         self.qpath = None
         self.qpath_gitem = None
+        #nor for the cached mask
+        mask = self.mask_cache
+        self.mask_cache = None
 
         blob = copy.deepcopy(self)
         blob.contour = self.contour.copy()
@@ -158,6 +332,7 @@ class Blob(object):
         blob.qpath_gitem = None
         self.qpath = path
         self.qpath_gitem = pathitem
+        self.mask_cache = mask
         #restore deepcopy (also to the newly created Blob!
         blob.__deepcopy__ = self.__deepcopy__ = deepcopy_method
         return blob
@@ -169,7 +344,23 @@ class Blob(object):
         self.id = id
         self.blob_name = "c-{:d}-{:.1f}x-{:.1f}y".format(self.id, xc, yc)
 
-    def getMask(self):
+    def getMask(self, copy=True):
+        """
+        It returns the mask of the region. The mask is created from the contours the first time and cached
+        (see MaskCache). With copy=False the cached mask (read-only) is returned without copying it.
+        """
+        mask = mask_cache.get(self)
+        if mask is None:
+            mask = self.createMask()
+            mask.flags.writeable = False
+            mask_cache.put(self, mask)
+
+        return mask.copy() if copy else mask
+
+    def invalidateMask(self):
+        mask_cache.discard(self)
+
+    def createMask(self):
         """
         It creates the mask from the contour and returns it.
         """
@@ -191,6 +382,7 @@ class Blob(object):
 
 
     def updateUsingMask(self, bbox, mask):
+        self.invalidateMask()
         self.createContourFromMask(mask, bbox)
         self.calculatePerimeter()
         self.calculateCentroid(mask, bbox)
@@ -221,6 +413,40 @@ class Blob(object):
         return True
 
 
+    def createFromPolygon(self, outer, inners, rasterise=False):
+        """
+        It creates a blob from the rings of a polygon (in pixel coordinates). The rings are used as contours, the
+        mask is rasterised only to compute the area and the centroid; False is returned if it is empty.
+        With rasterise=True (e.g. for invalid polygons) the rings are painted and the contours are extracted
+        from the mask (see createFromClosedCurve).
+        """
+        if rasterise:
+            self.createFromClosedCurve([np.asarray(outer)], False)
+            for inner in inners:
+                innerblob = Blob(None, 0, 0, 0)
+                innerblob.createFromClosedCurve([np.asarray(inner)], False)
+                # FIXME: prevents problem if the innerblob size is less than one pixel, but it is not clear
+                #  when it happens
+                if innerblob.bbox[2] > 0.9 and innerblob.bbox[3] > 0.9:
+                    (mask, box) = Mask.subtract(self.createMask(), self.bbox, innerblob.createMask(), innerblob.bbox)
+                    if mask.any():
+                        self.updateUsingMask(box, mask.astype(int))
+            return True
+
+        self.invalidateMask()
+        self.contour = np.asarray(outer, dtype=float)
+        self.inner_contours = [np.asarray(inner, dtype=float) for inner in inners]
+        self.bbox = Mask.pointsBox(self.contour, 4)
+
+        mask = self.createMask()
+        if not mask.any():
+            return False
+
+        self.calculatePerimeter()
+        self.calculateCentroid(mask, self.bbox)
+        self.calculateArea(mask)
+        return True
+
     def createContourFromMask(self, mask, bbox):
         """
         It creates the contour (and the corrisponding polygon) from the blob mask.
@@ -275,19 +501,10 @@ class Blob(object):
 
             # adjust the coordinates of the outer contour
             # (NOTE THAT THE COORDINATES OF THE BBOX ARE IN THE GLOBAL MAP COORDINATES SYSTEM)
-            for i in range(self.contour.shape[0]):
-                ycoor = self.contour[i, 0]
-                xcoor = self.contour[i, 1]
-                self.contour[i, 0] = xcoor - PADDED_SIZE + bbox[1]
-                self.contour[i, 1] = ycoor - PADDED_SIZE + bbox[0]
+            self.contour = self.toMapCoordinates(self.contour, bbox, PADDED_SIZE)
 
             # adjust coordinates of the INNER contours
-            for j, contour in enumerate(self.inner_contours):
-                for i in range(contour.shape[0]):
-                    ycoor = contour[i, 0]
-                    xcoor = contour[i, 1]
-                    self.inner_contours[j][i, 0] = xcoor - PADDED_SIZE + bbox[1]
-                    self.inner_contours[j][i, 1] = ycoor - PADDED_SIZE + bbox[0]
+            self.inner_contours = [self.toMapCoordinates(contour, bbox, PADDED_SIZE) for contour in self.inner_contours]
         elif number_of_contours == 1:
 
             coords = measure.approximate_polygon(contours[0], tolerance=0.2)
@@ -295,16 +512,19 @@ class Blob(object):
 
             # adjust the coordinates of the outer contour
             # (NOTE THAT THE COORDINATES OF THE BBOX ARE IN THE GLOBAL MAP COORDINATES SYSTEM)
-            for i in range(self.contour.shape[0]):
-                ycoor = self.contour[i, 0]
-                xcoor = self.contour[i, 1]
-                self.contour[i, 0] = xcoor - PADDED_SIZE + bbox[1]
-                self.contour[i, 1] = ycoor - PADDED_SIZE + bbox[0]
+            self.contour = self.toMapCoordinates(self.contour, bbox, PADDED_SIZE)
         else:
             raise Exception("Empty contour")
         #TODO optimize the bbox
         self.bbox = bbox
 
+    @staticmethod
+    def toMapCoordinates(contour, bbox, padding):
+        """
+        Contour extracted from a (padded) mask cropped according to the bbox: (row, col) -> map (x, y).
+        """
+        return contour[:, ::-1] - padding + np.array([bbox[1], bbox[0]])
+
     def lineToPoints(self, lines, snap = False):
         points = np.empty(shape=(0, 2), dtype=int)
 
@@ -375,6 +595,23 @@ class Blob(object):
 
 
 
+    @staticmethod
+    def toQPolygonF(contour, shift=0.0):
+        """
+        QPolygonF of the given contour (translated by shift), filled through its memory buffer
+        (QPointF is a pair of doubles) instead of point by point.
+        """
+        n = contour.shape[0]
+        qpolygon = QPolygonF(n)
+        if n > 0:
+            buffer = qpolygon.data()
+            buffer.setsize(n * 2 * np.dtype(np.float64).itemsize)
+            points = np.frombuffer(buffer, dtype=np.float64).reshape(n, 2)
+            points[:] = contour[:, :2]
+            points += shift
+
+        return qpolygon
+
     def setupForDrawing(self):
         """
         Create the QPolygon and the QPainterPath according to the blob's contours.
@@ -383,17 +620,13 @@ class Blob(object):
         # QPolygon to draw the blob
         #working with mask the center of the pixels is in 0, 0
         #if drawing the center of the pixel is 0.5, 0.5
-        qpolygon = QPolygonF()
-        for i in range(self.contour.shape[0]):
-            qpolygon << QPointF(self.contour[i, 0] + 0.5, self.contour[i, 1] + 0.5)
+        qpolygon = self.toQPolygonF(self.contour, 0.5)
 
         self.qpath = QPainterPath()
         self.qpath.addPolygon(qpolygon)
 
         for inner_contour in self.inner_contours:
-            qpoly_inner = QPolygonF()
-            for i in range(inner_contour.shape[0]):
-                qpoly_inner << QPointF(inner_contour[i, 0] + 0.5, inner_contour[i, 1] + 0.5)
+            qpoly_inner = self.toQPolygonF(inner_contour, 0.5)
 
             path_inner = QPainterPath()
             path_inner.addPolygon(qpoly_inner)
@@ -412,25 +645,12 @@ class Blob(object):
 
         #self.perimeter = measure.perimeter(mask) instead?
 
+        # length of the closed polyline (the last segment joins the last point with the first one)
+        if contour.shape[0] < 2:
+            return 0.0
 
-        # perimeter of the outer contour
-        px1 = contour[0, 0]
-        py1 = contour[0, 1]
-        N = contour.shape[0]
-        pxlast = contour[N-1, 0]
-        pylast = contour[N-1, 1]
-        perim = math.sqrt((px1-pxlast)*(px1-pxlast) + (py1-pylast)*(py1-pylast))
-        for i in range(1, contour.shape[0]):
-            px2 = contour[i, 0]
-            py2 = contour[i, 1]
-
-            d = math.sqrt((px1 - px2)*(px1-px2) + (py1-py2)*(py1-py2))
-            perim += d
-
-            px1 = px2
-            py1 = py2
-
-        return perim
+        d = np.diff(contour, axis=0, append=contour[:1])
+        return float(np.hypot(d[:, 0], d[:, 1]).sum())
 
     def calculatePerimeter(self):
         #tole = 2
@@ -451,6 +671,7 @@ class Blob(object):
 
         dic = dictionary
 
+        self.invalidateMask()
         self.bbox = np.asarray(dic["bbox"])
         self.centroid = np.asarray(dic["centroid"])
         self.area = dic["area"]
@@ -485,12 +706,20 @@ class Blob(object):
     def save(self):
         return self.toDict()
 
-    def toPoints(self, c):
-
-        #return c.tolist()
+    @staticmethod
+    def toDeltas(c):
+        """
+        Contour encoded as a flat array of integers: the differences between consecutive points (in tenths of pixel).
+        """
         d = (c * 10).astype(int)
         d = np.diff(d, axis=0, prepend=[[0, 0]])
         d = np.reshape(d, -1)
+        return d
+
+    def toPoints(self, c):
+
+        #return c.tolist()
+        d = self.toDeltas(c)
         d = np.char.mod('%d', d)
         # combine to a string
         d = " ".join(d)
@@ -513,11 +742,15 @@ class Blob(object):
         return c
 
 
-    def toDict(self):
+    def toDict(self, contour_encoder=None):
         """
         Get the blob information as a dictionary.
+        The contours are encoded as strings (see toPoints) unless a different contour_encoder is given.
         """
 
+        if contour_encoder is None:
+            contour_encoder = self.toPoints
+
         dic = dict()
 
         dic["bbox"] = self.bbox.tolist()
@@ -527,12 +760,12 @@ class Blob(object):
         dic["perimeter"] = math.trunc(10 *self.perimeter)/10
 
         #dic["contour"] = self.contour.tolist()
-        dic["contour"] = self.toPoints(self.contour)
+        dic["contour"] = contour_encoder(self.contour)
 
         dic["inner contours"] = []
         for c in self.inner_contours:
             #dic["inner contours"].append(c.tolist())
-            dic["inner contours"].append(self.toPoints(c))
+            dic["inner contours"].append(contour_encoder(c))
 
 #       dic["genet"] = self.genet
         dic["class name"] = self.class_name
@@ -21,6 +21,8 @@ from PyQt5.QtGui import QImage
 from PyQt5.QtGui import QImageReader
 import rasterio as rio
 from source import genutils
+from source.TiledImage import TiledImage, MAX_QIMAGE_SIZE
+from source.OverviewCache import OverviewCache
 import numpy as np
 import os
 
@@ -29,17 +31,42 @@ class Channel(object):
 
         self.filename = filename      # path relative to the TagLab directory
         self.type = type              # RGB | DEM
-        self.qimage = None            # cached QImage (to speed up visualization)
+        self.qimage = None            # cached QImage (to speed up visualization), a TiledImage for huge maps
         self.float_map = None         # map of 32-bit floating point (e.g. to store high precision depth values)
         self.nodata = None            # invalid value
+        self.cache_dir = None         # folder of the on-disk overviews cache (not saved, see OverviewCache)
 
-    def loadData(self, taglab_dir):
+    def isTiled(self):
+        return type(self.qimage) is TiledImage
+
+    def loadData(self, taglab_dir, tiled=False):
         """
         Load the image data. The QImage is cached to speed up visualization.
+        If tiled is True, or the map is too large to be stored in a QImage, the map is not loaded:
+        a TiledImage is created instead and the data is read by tiles when needed. In this case, if the
+        overviews cache of the channel has been built, the map is drawn using the cache (the crops of the
+        map used by the tools are always read from the original file).
         """
 
         filename = os.path.join(taglab_dir, self.filename)
 
+        if tiled is False:
+            with rio.open(filename) as img:
+                tiled = img.width > MAX_QIMAGE_SIZE or img.height > MAX_QIMAGE_SIZE
+
+        if tiled:
+            if self.isTiled():
+                self.qimage.close()
+
+            # the cache is lossy (and the cached DEM is already converted in a shaded RGB map), so it is used
+            # only for the visualization
+            cached_filename, _ = OverviewCache(self.cache_dir).cachedFile(filename, self.type)
+            self.qimage = TiledImage(filename, self.type, display_filename=cached_filename)
+            self.nodata = self.qimage.nodata
+
+            self.float_map = None
+            return self.qimage
+
         if self.type == "RGB":
 
             # reader = QImageReader(self.filename)
@@ -60,5 +87,15 @@ class Channel(object):
 
         return self.qimage
 
+    def buildCache(self, taglab_dir, progress=None, force=False):
+        """
+        Build the on-disk overviews cache of this channel. It returns the cached file.
+        """
+        if self.cache_dir is None:
+            return None
+
+        filename = os.path.join(taglab_dir, self.filename)
+        return OverviewCache(self.cache_dir).build(filename, self.type, progress=progress, force=force)
+
     def save(self):
         return { "filename": self.filename, "type": self.type }
@@ -1,9 +1,103 @@
 from source.Blob import Blob
+import os
+from collections import Counter
 import numpy as np
 from source.Blob import Blob
 from source.Mask import intersectMask
+from source.SpatialIndex import SpatialIndex
+from source import genutils
 import pandas as pd
 
+# the intersections of the candidate pairs of regions are computed by a pool of worker processes when
+# the candidate pairs are many (see Correspondences.matchRegions)
+MATCH_PARALLEL_PAIRS = 5000
+MATCH_CHUNK_SIZE = 1000
+
+
+def bboxesIntersect(bbox1, bbox2):
+    """
+    True if the intersection of the two bboxes (top, left, width, height) has a positive area.
+    """
+    x1 = max(bbox1[0], bbox2[0])
+    y1 = max(bbox1[1], bbox2[1])
+    x2 = min(bbox1[0] + bbox1[3], bbox2[0] + bbox2[3])
+    y2 = min(bbox1[1] + bbox1[2], bbox2[1] + bbox2[2])
+    return x2 > x1 and y2 > y1
+
+def candidatePairs(blobs1, blobs2):
+    """
+    It returns the pairs of indices (i, j) of the regions of blobs1 and blobs2 whose bboxes intersect, in the
+    order of a nested loop over blobs1 and blobs2. The regions of blobs2 are registered in a uniform grid
+    (see SpatialIndex), so each region of blobs1 is tested only against the regions nearby.
+    """
+    if len(blobs1) == 0 or len(blobs2) == 0:
+        return []
+
+    # cells about twice the typical region
+    sizes = [max(blob.bbox[2], blob.bbox[3]) for blob in blobs2]
+    index = SpatialIndex(cell_size=max(2.0 * float(np.median(sizes)), 1.0))
+
+    position = {}
+    for j, blob in enumerate(blobs2):
+        index.insert(blob, blob.bbox)
+        position[id(blob)] = j
+
+    pairs = []
+    for i, blob1 in enumerate(blobs1):
+        for blob2 in index.query(blob1.bbox):
+            if bboxesIntersect(blob1.bbox, blob2.bbox):
+                pairs.append((i, position[id(blob2)]))
+
+    return pairs
+
+def regionOverlaps(blobs1, blobs2, pairs):
+    """
+    It returns, for each pair of indices (i, j), the areas (in pixels) of the masks of blobs1[i], of blobs2[j]
+    and of their intersection. The masks are rasterised once (see Blob.getMask) and counted once.
+    """
+    sizes1 = {}
+    sizes2 = {}
+    overlaps = []
+    for i, j in pairs:
+        blob1 = blobs1[i]
+        blob2 = blobs2[j]
+        mask1 = blob1.getMask(copy=False)
+        mask2 = blob2.getMask(copy=False)
+
+        if i not in sizes1:
+            sizes1[i] = np.count_nonzero(mask1)
+        if j not in sizes2:
+            sizes2[j] = np.count_nonzero(mask2)
+
+        mask, bbox = intersectMask(mask1, blob1.bbox, mask2, blob2.bbox)
+        overlaps.append((sizes1[i], sizes2[j], np.count_nonzero(mask)))
+
+    return overlaps
+
+def regionGeometry(blob):
+    return (blob.bbox, blob.contour, blob.inner_contours)
+
+def blobFromGeometry(geometry):
+
+    blob = Blob(None, 0, 0, 0)
+    blob.bbox, blob.contour, blob.inner_contours = geometry
+    return blob
+
+def regionOverlapsFromGeometries(items):
+    """
+    regionOverlaps run by the worker processes, the pairs are passed as (i, j, geometry of i, geometry of j),
+    where the geometry of a region is (bbox, contour, inner contours).
+    """
+    blobs1 = {}
+    blobs2 = {}
+    for i, j, geometry1, geometry2 in items:
+        if i not in blobs1:
+            blobs1[i] = blobFromGeometry(geometry1)
+        if j not in blobs2:
+            blobs2[j] = blobFromGeometry(geometry2)
+
+    return regionOverlaps(blobs1, blobs2, [(i, j) for i, j, geometry1, geometry2 in items])
+
 
 class Correspondences(object):
 
@@ -17,6 +111,7 @@ class Correspondences(object):
         self.threshold = 1.05
         self.data = pd.DataFrame(data = correspondences, columns=['Genet', 'Blob1', 'Blob2', 'Area1', 'Area2', 'Class', 'Action', 'Split\Fuse'])
         self.area_type_shown = False  # True means that the surface area is currently shown
+        self.matching_time = 0.0      # seconds spent by the last automatic matching (see autoMatch)
 
     def area_in_sq_cm(self, area, is_source):
 
@@ -61,46 +156,41 @@ class Correspondences(object):
 
     def updateAreas(self, use_surface_area=False):
 
-        for index, row in self.data.iterrows():
-            id1 = int(row['Blob1'])
-            id2 = int(row['Blob2'])
-            action = row['Action']
-            blob1 = self.source.annotations.blobById(id1)
-            blob2 = self.target.annotations.blobById(id2)
-
-            if blob1 is None and blob2 is None:
-                print("SOMETHING WRONG HAPPENED!! (blob1=None blob2=None)")
-
-            # WHAT ??
-            #self.data.loc[index, 'Class'] = blob1.class_name if blob1 is not None else blob2.class_name
-
-            area1 = 0
-            if blob1 is not None:
-                area_pixel = blob1.area
-                if use_surface_area:
-                    area_pixel = blob1.surface_area
-                area1 = self.area_in_sq_cm(area_pixel, True)
-            self.data.loc[index, 'Area1'] = area1
-
-            area2 = 0
-            if blob2 is not None:
-                area_pixel = blob2.area
-                if use_surface_area:
-                    area_pixel = blob2.surface_area
-                area2 = self.area_in_sq_cm(area_pixel, False)
-            self.data.loc[index, 'Area2'] = area2
-
-            # update grow/shrink information
-            if action == "grow" or action == "shrink" or action == "same":
-                if area2 > area1*self.threshold:
-                    self.data.loc[index, 'Action'] = "grow"
-                elif area2 < area1 / self.threshold:
-                    self.data.loc[index, 'Action'] = "shrink"
-                else:
-                    self.data.loc[index, 'Action'] = "same"
+        # the (planar) areas are available without decoding the regions (see Image.regionAreas)
+        if use_surface_area:
+            source_areas = {blob.id: blob.surface_area for blob in self.source.annotations.seg_blobs}
+            target_areas = {blob.id: blob.surface_area for blob in self.target.annotations.seg_blobs}
+        else:
+            source_areas = self.source.regionAreas()
+            target_areas = self.target.regionAreas()
+
+        area_pixel1 = self.data['Blob1'].astype(int).map(source_areas)
+        area_pixel2 = self.data['Blob2'].astype(int).map(target_areas)
+
+        if (area_pixel1.isna() & area_pixel2.isna()).any():
+            print("SOMETHING WRONG HAPPENED!! (blob1=None blob2=None)")
+
+        self.data['Area1'] = self.area_in_sq_cm(area_pixel1.astype(float), True).fillna(0.0)
+        self.data['Area2'] = self.area_in_sq_cm(area_pixel2.astype(float), False).fillna(0.0)
+
+        self.updateActions(pd.Series(True, index=self.data.index))
 
         self.area_shown = use_surface_area
 
+    def updateActions(self, rows):
+        """
+        Update the grow/shrink information of the given rows (a boolean Series) according to their areas.
+        """
+        rows = rows & self.data['Action'].isin(["grow", "shrink", "same"])
+        if not rows.any():
+            return
+
+        area1 = pd.to_numeric(self.data.loc[rows, 'Area1'], errors='coerce').fillna(0.0).to_numpy()
+        area2 = pd.to_numeric(self.data.loc[rows, 'Area2'], errors='coerce').fillna(0.0).to_numpy()
+
+        actions = np.where(area2 > area1 * self.threshold, "grow", np.where(area2 < area1 / self.threshold, "shrink", "same"))
+        self.data.loc[rows, 'Action'] = actions.tolist()
+
     def updateBlobId(self, img, blob_id, new_id):
         """
         Update the id of a region
@@ -116,39 +206,21 @@ class Correspondences(object):
     def updateBlobArea(self, img, blob_id, new_area, new_surface_area):
 
         if self.source == img:
-            rows = self.data[self.data['Blob1'] == blob_id]
+            rows = self.data['Blob1'] == blob_id
             column_name = 'Area1'
             is_source = True
         else:
-            rows = self.data[self.data['Blob2'] == blob_id]
+            rows = self.data['Blob2'] == blob_id
             column_name = 'Area2'
             is_source = False
 
-        for index, row in rows.iterrows():
-
-            area = self.area_in_sq_cm(new_area, is_source)
-            self.data.loc[index, column_name] = area
-
-            try:
-                area1 = float(row['Area1'])
-            except:
-                area1 = 0.0
-
-            try:
-                area2 = float(row['Area2'])
-            except:
-                area2 = 0.0
+        if not rows.any():
+            return
 
-            action = row['Action']
+        self.data.loc[rows, column_name] = self.area_in_sq_cm(new_area, is_source)
 
-            # update grow/shrink information
-            if action == "grow" or action == "shrink" or action == "same":
-                if area2 > area1*self.threshold:
-                    self.data.loc[index, 'Action'] = "grow"
-                elif area2 < area1 / self.threshold:
-                    self.data.loc[index, 'Action'] = "shrink"
-                else:
-                    self.data.loc[index, 'Action'] = "same"
+        # update grow/shrink information
+        self.updateActions(rows)
 
     def save(self):
         return { "source": self.source.id, "target": self.target.id, "correspondences": self.data.values.tolist() }
@@ -162,17 +234,13 @@ class Correspondences(object):
         Table may contain inconsistencies. This function check and remove them.
         """
 
-        inconsistencies = False
-        current_table = self.data.copy()
-        for index, row in current_table.iterrows():
-            id1 = int(row['Blob1'])
-            id2 = int(row['Blob2'])
-            blob1 = self.source.annotations.blobById(id1)
-            blob2 = self.target.annotations.blobById(id2)
+        source_ids = self.source.regionIds()
+        target_ids = self.target.regionIds()
 
-            if blob1 is None and blob2 is None:
-                self.data.drop(index, inplace=True)
-                inconsistencies = True
+        consistent = self.data['Blob1'].astype(int).isin(source_ids) | self.data['Blob2'].astype(int).isin(target_ids)
+        inconsistencies = not consistent.all()
+        if inconsistencies:
+            self.data.drop(self.data.index[~consistent], inplace=True)
 
         return inconsistencies
 
@@ -195,7 +263,6 @@ class Correspondences(object):
         self.checkTable()
 
         #this is needed to ensure consistency between blob data and correspondences data (WHICH SHOULD NOT BE REPLICATED!!!!)
-        #FIXME! this is also pretty expensive when loading data!
         self.updateAreas()
 
         self.sort_data()
@@ -454,85 +521,81 @@ class Correspondences(object):
         # reindexing
         self.data.reset_index(drop=True, inplace=True)
 
-    def autoMatch(self, blobs1, blobs2):
-        self.correspondences.clear()
-        for blob1 in blobs1:
-            for blob2 in blobs2:
-                # use bb to quickly calculate intersection
-                x1 = max(blob1.bbox[0], blob2.bbox[0])
-                y1 = max(blob1.bbox[1], blob2.bbox[1])
-                x2 = min(blob1.bbox[0] + blob1.bbox[3], blob2.bbox[0] + blob2.bbox[3])
-                y2 = min(blob1.bbox[1] + blob1.bbox[2], blob2.bbox[1] + blob2.bbox[2])
-                # compute the area of intersection rectangle
-                interArea = abs(max((x2 - x1, 0)) * max((y2 - y1), 0))
-
-                if interArea != 0 and blob2.class_name == blob1.class_name and blob1.class_name != 'Empty':
-                    # this is the get mask function for the outer contours, I put it here using two different if conditions so getMask just runs just on intersections
-                    mask1 = Blob.getMask(blob1)
-                    sizeblob1 = np.count_nonzero(mask1)
-                    mask2 = Blob.getMask(blob2)
-                    sizeblob2 = np.count_nonzero(mask2)
-                    minblob = min(sizeblob1, sizeblob2)
-                    mask, bbox = intersectMask(mask1, blob1.bbox, mask2, blob2.bbox)
-                    intersectionArea = np.count_nonzero(mask)
-
-                    if (intersectionArea < (0.6 * minblob)):
-                        continue
-                    if (sizeblob2 > sizeblob1 * self.threshold):
-                        self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, 'grow', 'none'])
-
-                    elif (sizeblob2 < sizeblob1 / self.threshold):
-                        self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, 'shrink', 'none'])
-
-                    else:
-                        self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, 'same', 'none'])
+    def computeOverlaps(self, blobs1, blobs2, pairs, workers=None):
+        """
+        It computes the overlaps of the given pairs of regions (see regionOverlaps). The pairs are split in chunks
+        processed by a pool of worker processes (workers=None means one for each CPU) when they are many.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
 
+        # in this process the masks of the regions are cached (see Blob.getMask)
+        if workers <= 1 or len(pairs) < MATCH_PARALLEL_PAIRS:
+            return regionOverlaps(blobs1, blobs2, pairs)
 
-        # operates on the correspondences found and update them
-        self.assignSplit()
-        self.assignFuse()
+        # the workers receive only the geometry of the regions (a region shared by more pairs is pickled once
+        # for each chunk)
+        items = [(i, j, regionGeometry(blobs1[i]), regionGeometry(blobs2[j])) for i, j in pairs]
+        results = genutils.parallelMap(regionOverlapsFromGeometries, items, MATCH_CHUNK_SIZE, MATCH_PARALLEL_PAIRS,
+                                       workers)
+        overlaps = [overlap for chunk_overlaps in results for overlap in chunk_overlaps]
 
-        # fill self.born and self.dead blob lists
-        self.assignDead(blobs1)
-        self.assignBorn(blobs2)
+        return overlaps
 
+    def matchRegions(self, blobs1, blobs2, min_overlap, same_class, workers=None):
+        """
+        It returns the matching regions as a list of (blob1, blob2, size1, size2), where the sizes are the areas of
+        the masks. Two regions match if their intersection is at least min_overlap times the smaller of the two.
+        Only the pairs of regions with intersecting bboxes are tested (see candidatePairs).
+        """
+        pairs = []
+        for i, j in candidatePairs(blobs1, blobs2):
+            class_name = blobs1[i].class_name
+            if class_name == 'Empty' or (same_class and blobs2[j].class_name != class_name):
+                continue
+            pairs.append((i, j))
 
-    def autoMatchM(self, blobs1, blobs2):
-        self.correspondences.clear()
-        for blob1 in blobs1:
-            for blob2 in blobs2:
-                # use bb to quickly calculate intersection
-                x1 = max(blob1.bbox[0], blob2.bbox[0])
-                y1 = max(blob1.bbox[1], blob2.bbox[1])
-                x2 = min(blob1.bbox[0] + blob1.bbox[3], blob2.bbox[0] + blob2.bbox[3])
-                y2 = min(blob1.bbox[1] + blob1.bbox[2], blob2.bbox[1] + blob2.bbox[2])
-                # compute the area of intersection rectangle
-                interArea = abs(max((x2 - x1, 0)) * max((y2 - y1), 0))
+        overlaps = self.computeOverlaps(blobs1, blobs2, pairs, workers)
 
-                if interArea != 0 and blob1.class_name != 'Empty':
-                    # this is the get mask function for the outer contours, I put it here using two different if conditions so getMask just runs just on intersections
-                    mask1 = Blob.getMask(blob1)
-                    sizeblob1 = np.count_nonzero(mask1)
-                    mask2 = Blob.getMask(blob2)
-                    sizeblob2 = np.count_nonzero(mask2)
-                    minblob = min(sizeblob1, sizeblob2)
-                    mask, bbox = intersectMask(mask1, blob1.bbox, mask2, blob2.bbox)
-                    intersectionArea = np.count_nonzero(mask)
+        matches = []
+        for (i, j), (sizeblob1, sizeblob2, intersectionArea) in zip(pairs, overlaps):
+            minblob = min(sizeblob1, sizeblob2)
+            if intersectionArea < (min_overlap * minblob):
+                continue
+            matches.append((blobs1[i], blobs2[j], sizeblob1, sizeblob2))
 
-                    class_name = blob1.class_name + "-" + blob2.class_name
+        return matches
 
-                    if (intersectionArea < (0.2 * minblob)):
-                        continue
+    def matchAction(self, sizeblob1, sizeblob2):
 
-                    if (sizeblob2 > sizeblob1 * self.threshold):
-                        self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, class_name, 'grow', 'none'])
+        if sizeblob2 > sizeblob1 * self.threshold:
+            return 'grow'
+        elif sizeblob2 < sizeblob1 / self.threshold:
+            return 'shrink'
+        else:
+            return 'same'
 
-                    elif (sizeblob2 < sizeblob1 / self.threshold):
-                        self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, class_name, 'shrink', 'none'])
+    def autoMatch(self, blobs1, blobs2, workers=None):
+        self.correspondences.clear()
+        for blob1, blob2, sizeblob1, sizeblob2 in self.matchRegions(blobs1, blobs2, 0.6, True, workers):
+            action = self.matchAction(sizeblob1, sizeblob2)
+            self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, blob1.class_name, action, 'none'])
+
+        # operates on the correspondences found and update them
+        self.assignSplit()
+        self.assignFuse()
+
+        # fill self.born and self.dead blob lists
+        self.assignDead(blobs1)
+        self.assignBorn(blobs2)
 
-                    else:
-                        self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, class_name, 'same', 'none'])
 
+    def autoMatchM(self, blobs1, blobs2, workers=None):
+        self.correspondences.clear()
+        for blob1, blob2, sizeblob1, sizeblob2 in self.matchRegions(blobs1, blobs2, 0.2, False, workers):
+            class_name = blob1.class_name + "-" + blob2.class_name
+            action = self.matchAction(sizeblob1, sizeblob2)
+            self.correspondences.append([-1, blob1.id, blob2.id, blob1.area, blob2.area, class_name, action, 'none'])
 
         # operates on the correspondences found and update them
         self.assignSplit()
@@ -762,26 +825,18 @@ class Correspondences(object):
 
     def assignSplit(self):
 
-        mylist = []
-        for i in range(0, len(self.correspondences)):
-            mylist.append(int(self.correspondences[i][1]))
-        splitted = sorted(set([i for i in mylist if mylist.count(i) > 1]))
-
-        for i in range(0, len(self.correspondences)):
-            if int(self.correspondences[i][1]) in splitted:
-                self.correspondences[i][7] = 'split'
+        counts = Counter(int(row[1]) for row in self.correspondences)
+        for row in self.correspondences:
+            if counts[int(row[1])] > 1:
+                row[7] = 'split'
 
 
     def assignFuse(self):
 
-        mylist = []
-        for i in range(0, len(self.correspondences)):
-            mylist.append(int(self.correspondences[i][2]))
-        fused = sorted(set([i for i in mylist if mylist.count(i) > 1]))
-
-        for i in range(0, len(self.correspondences)):
-            if int(self.correspondences[i][2]) in fused:
-                self.correspondences[i][7] = 'fuse'
+        counts = Counter(int(row[2]) for row in self.correspondences)
+        for row in self.correspondences:
+            if counts[int(row[2])] > 1:
+                row[7] = 'fuse'
 
 
     def assignDead(self, blobs1):
@@ -789,22 +844,15 @@ class Correspondences(object):
         # """
         # Deads are all the blobs that are in project 1 but don't match with any blobs of project 2
         # """
-        all_blobs = []
-        existing = []
-        missing = []
-
-        for i in range(0, len(blobs1)):
-            all_blobs.append(int(blobs1[i].id))
-
-        for j in range(0, len(self.correspondences)):
-            existing.append(int(self.correspondences[j][1]))
+        existing = set(int(row[1]) for row in self.correspondences)
 
-        missing = [i for i in all_blobs if i not in existing]
-
-        for id in missing:
-            index = all_blobs.index(id)
-            if blobs1[index].class_name != 'Empty':
-                self.dead.append([-1, id, -1,  blobs1[index].area, 0.0, blobs1[index].class_name, 'dead', 'none'])
+        missing = set()
+        for blob in blobs1:
+            id = int(blob.id)
+            if id not in existing and id not in missing:
+                missing.add(id)
+                if blob.class_name != 'Empty':
+                    self.dead.append([-1, id, -1,  blob.area, 0.0, blob.class_name, 'dead', 'none'])
 
 
     def assignBorn(self, blobs2):
@@ -813,21 +861,13 @@ class Correspondences(object):
         # Borns are all the blobs that are in project 2 but don't match with any blobs of project 1
         # MAYBE NOW MOVED MIGHT BE EXCHANGED FOR NEW BORN
         # """
-
-        all_blobs = []
-        existing = []
-        missing = []
-
-        for i in range(0, len(blobs2)):
-            all_blobs.append(int(blobs2[i].id))
-
-        for j in range(0, len(self.correspondences)):
-            existing.append(int(self.correspondences[j][2]))
-
-        missing = [i for i in all_blobs if i not in existing]
-
-        for id in missing:
-            index = all_blobs.index(id)
-            if blobs2[index].class_name != 'Empty':
-                self.born.append([-1, -1, id, 0.0, blobs2[index].area, blobs2[index].class_name, 'born', 'none'])
+        existing = set(int(row[2]) for row in self.correspondences)
+
+        missing = set()
+        for blob in blobs2:
+            id = int(blob.id)
+            if id not in existing and id not in missing:
+                missing.add(id)
+                if blob.class_name != 'Empty':
+                    self.born.append([-1, -1, id, 0.0, blob.area, blob.class_name, 'born', 'none'])
 
@@ -12,78 +12,267 @@ from source.Blob import Blob
 from source.Mask import jointBox
 from source.Annotation import Annotation
 
+class UnionFind:
+    """
+    Persistent union-find (path compression and union by rank) of the regions of the project, used to maintain
+    the genets. The nodes are (image id, region id); each component stores its members and its genet.
+    """
+
+    def __init__(self):
+        self.parent = {}    # node -> parent node
+        self.rank = {}      # root -> rank
+        self.members = {}   # root -> nodes of the component
+        self.genets = {}    # root -> genet of the component
+        self.relabelled = []    # nodes whose genet has been changed by union()
+
+    def __contains__(self, node):
+        return node in self.parent
+
+    def add(self, node):
+        self.parent[node] = node
+        self.rank[node] = 0
+        self.members[node] = [node]
+
+    def find(self, node):
+
+        parent = self.parent
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+
+        # path compression
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+
+        return root
+
+    def union(self, node1, node2):
+
+        root1 = self.find(node1)
+        root2 = self.find(node2)
+        if root1 == root2:
+            return root1
+
+        if self.rank[root1] < self.rank[root2]:
+            root1, root2 = root2, root1
+        elif self.rank[root1] == self.rank[root2]:
+            self.rank[root1] += 1
+
+        self.parent[root2] = root1
+        del self.rank[root2]
+
+        members = { root1: self.members.pop(root1), root2: self.members.pop(root2) }
+        genets = { root1: self.genets.pop(root1, None), root2: self.genets.pop(root2, None) }
+        larger, smaller = (root1, root2) if len(members[root1]) >= len(members[root2]) else (root2, root1)
+
+        # the genet of the larger component is kept, the regions of the other one are relabelled
+        genet = genets[larger] if genets[larger] is not None else genets[smaller]
+        if genet is not None:
+            self.genets[root1] = genet
+            for root in (larger, smaller):
+                if genets[root] != genet:
+                    self.relabelled.extend(members[root])
+
+        members[larger].extend(members[smaller])
+        self.members[root1] = members[larger]
+
+        return root1
+
+    def dissolve(self, node):
+        """
+        Remove the component of the node. It returns its nodes and its genet.
+        """
+        root = self.find(node)
+        nodes = self.members.pop(root)
+        del self.rank[root]
+        for member in nodes:
+            del self.parent[member]
+
+        return nodes, self.genets.pop(root, None)
+
+    def genet(self, node):
+        return self.genets.get(self.find(node))
+
+
 class Genet:
 
     def __init__(self, project):
         self.project = project
+        self.union_find = UnionFind()
+        self.next_genet = 0
         self.updateGenets()
         pass
 
     # check all blobs and all corrispondences and compute the connected components.
-    # will preserve existing genets ids, if possible
-    #assign all genets to the first map.
-    #propagate all genets to the second map (ensure consistency.
+    #the genets are numbered following the order of the images and of the region ids.
 
+    #it works on the ids of the regions, so the regions of the images not shown yet are not decoded (see Image.annotations)
+    def computeUnionFind(self):
+
+        union_find = UnionFind()
+        nodes = []
+        for img in self.project.images:
+            for blob_id in sorted(img.regionIds()):
+                node = (img.id, blob_id)
+                union_find.add(node)
+                nodes.append(node)
+
+        for corrs in self.project.correspondences.values():
+            for id1, id2 in self.links(corrs, corrs.data):
+                node1 = (corrs.source.id, id1)
+                node2 = (corrs.target.id, id2)
+                if node1 in union_find and node2 in union_find:
+                    union_find.union(node1, node2)
+
+        count = 0
+        for node in nodes:
+            root = union_find.find(node)
+            if root not in union_find.genets:
+                union_find.genets[root] = count
+                count += 1
+
+        union_find.relabelled = []
+        return union_find, count
+
+    def links(self, corrs, rows):
+        """
+        It returns the pairs (source region id, target region id) of the given rows of a correspondences' table,
+        born and dead corals excluded.
+        """
+        ids1 = rows['Blob1'].astype(int).tolist()
+        ids2 = rows['Blob2'].astype(int).tolist()
+        return [(id1, id2) for id1, id2 in zip(ids1, ids2) if id1 != -1 and id2 != -1]
 
-    #union find algorithm to find connected components
     def updateGenets(self):
-        parents = []
+        """
+        Recompute the genets of all the regions of the project from scratch.
+        """
+        self.union_find, self.next_genet = self.computeUnionFind()
 
-        count = len(parents)
+        genets = {}   # image id -> {region id -> genet}
         for img in self.project.images:
-            sorted_blobs = sorted(img.annotations.seg_blobs, key=lambda x: x.id)
-            for blob in sorted_blobs:
-                blob.genet = count
-                parents.append(count)
-                count += 1
+            genets[img.id] = {}
+
+        for (image_id, blob_id) in self.union_find.parent.keys():
+            genets[image_id][blob_id] = self.union_find.genet((image_id, blob_id))
 
-        def root(p): 
-            while p != parents[p]:
-                p = parents[p]
-            return p
+        for img in self.project.images:
+            img.setGenets(genets[img.id])
+
+        self.updateTables(genets)
+
+    def updateRegions(self, img, added_blobs, removed_blobs=[]):
+        """
+        Update the genets after the regions of an image have been added or removed, or their correspondences
+        changed (the correspondences' tables must be already updated). Only the components containing the given
+        regions are recomputed.
+        """
+        union_find = self.union_find
+        # (an id of a removed region can be already reused by an added one)
+        removed = set((img.id, blob.id) for blob in removed_blobs) - set((img.id, blob.id) for blob in added_blobs)
+
+        # the components of the regions involved are dissolved..
+        dissolved = set()
+        genets_pool = set()
+        for blob in list(added_blobs) + list(removed_blobs):
+            node = (img.id, blob.id)
+            if node in union_find:
+                nodes, genet = union_find.dissolve(node)
+                dissolved.update(nodes)
+                if genet is not None:
+                    genets_pool.add(genet)
+            else:
+                dissolved.add(node)
 
-        def link(p0, p1):
-            r0 = root(p0)
-            r1 = root(p1)
-            parents[r1] = r0
+        nodes = sorted(dissolved - removed)
+        for node in nodes:
+            union_find.add(node)
 
+        # ..and rebuilt from their correspondences (the components they are linked to are merged)
+        union_find.relabelled = []
         for corrs in self.project.correspondences.values():
-            for index, row in corrs.data.iterrows():
-                id1 = int(row['Blob1'])
-                id2 = int(row['Blob2'])
-                if id1 == -1 or id2 == -1:  #born or dead corals
+            ids1 = [blob_id for (image_id, blob_id) in nodes if image_id == corrs.source.id]
+            ids2 = [blob_id for (image_id, blob_id) in nodes if image_id == corrs.target.id]
+            if len(ids1) == 0 and len(ids2) == 0:
+                continue
+
+            rows = corrs.data[corrs.data['Blob1'].isin(ids1) | corrs.data['Blob2'].isin(ids2)]
+            for id1, id2 in self.links(corrs, rows):
+                node1 = (corrs.source.id, id1)
+                node2 = (corrs.target.id, id2)
+                if node1 in removed or node2 in removed:
                     continue
-                blob1 = corrs.source.annotations.blobById(id1)
-                blob2 = corrs.target.annotations.blobById(id2)
+                for node in (node1, node2):
+                    if node not in union_find:
+                        union_find.add(node)
+                        nodes.append(node)
+                union_find.union(node1, node2)
+
+        # the genets of the dissolved components are reused
+        genets_pool = sorted(genets_pool, reverse=True)
+        for node in nodes:
+            root = union_find.find(node)
+            if root not in union_find.genets:
+                if len(genets_pool) > 0:
+                    union_find.genets[root] = genets_pool.pop()
+                else:
+                    union_find.genets[root] = self.next_genet
+                    self.next_genet += 1
 
-                if blob1.genet != blob2.genet:
-                    link(blob1.genet, blob2.genet)
+        genets = {}   # image id -> {region id -> genet} of the regions whose genet changed
+        for (image_id, blob_id) in set(nodes).union(union_find.relabelled):
+            genets.setdefault(image_id, {})[blob_id] = union_find.genet((image_id, blob_id))
+        union_find.relabelled = []
 
-        remap = [None]*len(parents) #keep tracks of where each root points to.
-        count = 0
-        for i in range(len(parents)):
-            r = root(i)
-            if remap[r] is None:
-                remap[r] = count
-                count += 1
-            remap[i] = remap[r]
+        for blob in added_blobs:
+            blob.genet = genets[img.id][blob.id]
 
-        for img in self.project.images:
-            for blob in img.annotations.seg_blobs:
-                blob.genet = remap[blob.genet]
-
-         #update corrs genets.
-        for corrs in self.project.correspondences.values():            
-            for index, row in corrs.data.iterrows():
-                id1 = int(row['Blob1'])
-                id2 = int(row['Blob2'])
-                
-                if id1 != -1:
-                    blob1 = corrs.source.annotations.blobById(id1)
-                    corrs.data.loc[index, 'Genet'] = blob1.genet
-                else:
-                    blob2 = corrs.target.annotations.blobById(id2)
-                    corrs.data.loc[index, 'Genet'] = blob2.genet
+        for image in self.project.images:
+            if image.id in genets:
+                image.updateGenets(genets[image.id])
+
+        self.updateTables(genets)
+
+    def updateTables(self, genets):
+        """
+        Update the genets of the correspondences' tables (image id -> {region id -> genet}): a row takes the genet
+        of the source region, of the target one for the born corals.
+        """
+        for corrs in self.project.correspondences.values():
+            if corrs.data.empty:
+                continue
+            source_genets = genets.get(corrs.source.id, {})
+            target_genets = genets.get(corrs.target.id, {})
+            if len(source_genets) == 0 and len(target_genets) == 0:
+                continue
+            ids1 = corrs.data['Blob1'].astype(int)
+            genet1 = ids1.map(source_genets)
+            genet2 = corrs.data['Blob2'].astype(int).map(target_genets)
+            genet = genet1.where(ids1 != -1, genet2)
+            rows = genet.notna()
+            corrs.data.loc[rows, 'Genet'] = genet[rows].astype(int)
+
+    def checkGenets(self):
+        """
+        Consistency check of the genets maintained incrementally against the ones recomputed from scratch.
+        If they differ, the latter are used. It returns False if the genets were inconsistent.
+        The check recomputes all the genets, so it is run only when the user saves the project (not by the autosave).
+        """
+        union_find, count = self.computeUnionFind()
+
+        # the two partitions of the regions must be the same (a region unknown to the incremental union-find
+        # is alone, the regions no more existing are ignored)
+        current = self.union_find
+        pairs = set()
+        for node in union_find.parent.keys():
+            label = current.find(node) if node in current else node
+            pairs.add((union_find.find(node), label))
+
+        consistent = len(pairs) == len(set(pair[0] for pair in pairs)) == len(set(pair[1] for pair in pairs))
+        if not consistent:
+            self.updateGenets()
+
+        return consistent
 
 
 
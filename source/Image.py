@@ -33,29 +33,19 @@ class Image(object):
         self.width = width
         self.height = height  # in pixels!
 
-        self.annotations = Annotation()
-
-        if annotations is not None:
-
-            if type(annotations) == list:
-                for data in annotations:
-                    blob = Blob(None, 0, 0, 0)
-                    blob.fromDict(data)
-                    self.annotations.addBlob(blob)
-            else:
-                regions = annotations.get("regions")
-                if regions is not None:
-                    for data in regions:
-                        blob = Blob(None, 0, 0, 0)
-                        blob.fromDict(data)
-                        self.annotations.addBlob(blob)
-
-                points = annotations.get("points")
-                if points is not None:
-                    for data in points:
-                        point = Point(0, 0, "Empty", 0)
-                        point.fromDict(data)
-                        self.annotations.addPoint(point)
+        # the annotations are decoded the first time they are used (see the annotations property), until then
+        # the regions and the points are kept as they have been loaded (dictionaries)
+        self._annotations = None
+        self.raw_annotations = None
+        self.raw_genets = None
+
+        if type(annotations) == list:
+            annotations = { "regions": annotations }
+
+        if annotations:
+            self.raw_annotations = annotations
+        else:
+            self._annotations = Annotation()
 
         self.layers = list()
         for layer_data in layers:
@@ -90,6 +80,97 @@ class Image(object):
         self.cache_data_table = None
         self.cache_labels_table = None
 
+    @property
+    def annotations(self):
+        if self._annotations is None:
+            self.loadAnnotations()
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations):
+        self._annotations = annotations
+        self.raw_annotations = None
+        self.raw_genets = None
+
+    def annotationsLoaded(self):
+        return self._annotations is not None
+
+    def loadAnnotations(self):
+        """
+        Decode the regions and the points of the image.
+        """
+        annotations = Annotation()
+
+        regions = self.raw_annotations.get("regions")
+        if regions is not None:
+            for data in regions:
+                blob = Blob(None, 0, 0, 0)
+                blob.fromDict(data)
+                if self.raw_genets is not None:
+                    blob.genet = self.raw_genets.get(blob.id)
+                annotations.addBlob(blob)
+
+        points = self.raw_annotations.get("points")
+        if points is not None:
+            for data in points:
+                point = Point(0, 0, "Empty", 0)
+                point.fromDict(data)
+                annotations.addPoint(point)
+
+        self.annotations = annotations
+
+    def regionIds(self):
+        """
+        It returns the ids of the regions (without decoding them).
+        """
+        if self._annotations is not None:
+            return [blob.id for blob in self._annotations.seg_blobs]
+
+        return [int(data["id"]) for data in self.raw_annotations.get("regions", [])]
+
+    def regionAreas(self):
+        """
+        It returns the area (in pixels) of the regions by id (without decoding them).
+        """
+        if self._annotations is not None:
+            return {blob.id: blob.area for blob in self._annotations.seg_blobs}
+
+        return {int(data["id"]): data["area"] for data in self.raw_annotations.get("regions", [])}
+
+    def annotationsCount(self):
+        """
+        It returns the number of regions and points (without decoding them).
+        """
+        if self._annotations is not None:
+            return len(self._annotations.seg_blobs) + len(self._annotations.annpoints)
+
+        return len(self.raw_annotations.get("regions", [])) + len(self.raw_annotations.get("points", []))
+
+    def setGenets(self, genets):
+        """
+        Assign the genets (region id -> genet) to the regions. If the regions are not decoded yet,
+        the genets are assigned when they are.
+        """
+        if self._annotations is not None:
+            for blob in self._annotations.seg_blobs:
+                blob.genet = genets.get(blob.id)
+        else:
+            self.raw_genets = genets
+
+    def updateGenets(self, genets):
+        """
+        Update the genets (region id -> genet) of some regions.
+        """
+        if self._annotations is not None:
+            for blob_id, genet in genets.items():
+                blob = self._annotations.blobById(blob_id)
+                if blob is not None:
+                    blob.genet = genet
+        else:
+            if self.raw_genets is None:
+                self.raw_genets = {}
+            self.raw_genets.update(genets)
+
     def deleteLayer(self, layer):
         self.layers.remove(layer)
 
@@ -124,11 +205,6 @@ class Image(object):
                 raise Exception("Size of the images is not consistent! It is " + str(img.width) + "x" +
                                 str(img.height) + ", should have been: " + str(self.width) + "x" + str(self.height))
 
-        # check image size limits
-        if img.width > 32767 or img.height > 32767:
-            raise Exception(
-                "This map exceeds the image dimension handled by TagLab (the maximum size is 32767 x 32767).")
-
         if img.crs is not None:
             # this image contains georeference information
             self.georef_filename = filename
@@ -295,6 +371,13 @@ class Image(object):
         del data["cache_data_table"]
         del data["cache_labels_table"]
 
+        # the annotations not decoded are saved as they have been loaded (see ProjectEncoder)
+        del data["raw_annotations"]
+        del data["raw_genets"]
+        annotations = self._annotations if self._annotations is not None else self.raw_annotations
+        data = {("annotations" if key == "_annotations" else key): (annotations if key == "_annotations" else value)
+                for key, value in data.items()}
+
         return data
 
     def copyTransform(self, tag, rot, tra, borders, geoTransform=None, geoRef=None):
@@ -18,10 +18,14 @@
 # for more details.                                               
 
 import os
-import glob
+import queue
+import threading
 import numpy as np
-import pickle as pkl
 import cv2
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+from affine import Affine
 
 # PYTORCH
 import torch
@@ -32,6 +36,7 @@ from models.dataloaders import helpers as helpers
 
 # DEEPLAB V3+
 from models.deeplab import DeepLab
+from models.precision import autocastDtype
 
 from PyQt5.QtCore import QCoreApplication, Qt, QObject, pyqtSlot, pyqtSignal
 from PyQt5.QtGui import QPainter, QImage, QColor, QPixmap, qRgb, qRed, qGreen, qBlue
@@ -56,37 +61,58 @@ class MapClassifier(QObject):
         self.classifier_name = classifier_info['Classifier Name']
         self.nclasses = classifier_info['Num. Classes']
         self.labels_code_dict = classifier_info['Classes']
+        self.target_pixel_size = classifier_info.get('Scale')
 
         self.background_index = -1
-
-        self.label_colors = [[0,0,0]] * len(self.labels_code_dict)
-        for key in self.labels_code_dict.keys():
-            if key == "Background":
-                self.background_index = self.labels_code_dict[key]
-                self.label_colors[self.background_index] = [0,0,0]
-            else:
-                color = labels_dictionary[key].fill
-                index = self.labels_code_dict[key]
-                self.label_colors[index] = color
+        self.label_colors = []
+        self.setLabels(labels_dictionary)
 
         self.average_norm = classifier_info['Average Norm.']
         self.net = self._load_classifier(classifier_info['Weights'])
 
+        # if False, the network is kept after run() so the same classifier can be used on several maps
+        self.release_network = True
+        self.processed_tiles = 0
+
         self.flagStopProcessing = False
         self.processing_step = 0
         self.total_processing_steps = 0
         self.scores = None
+        self.label_map = None
+
+        # number of tiles classified in a single forward pass (reduced automatically if the memory is not enough)
+        self.batch_size = 9
+
+        # mixed precision (float16 on the GPU, bfloat16 on the CPU) and channels-last memory layout, both opt-in
+        self.mixed_precision = False
+        self.channels_last = False
 
         self.scale_factor = 1.0
         self.input_image = None
+        self.input_dataset = None     # streaming mode: the map is read by windows (see setupStreaming)
+        self.input_crop = None
+        self.input_size = None
+        self.output_dataset = None
         self.padding = 0
         self.wa_top = 0
         self.wa_left = 0
         self.wa_width = 0
         self.wa_height = 0
 
-        self.temp_dir = "temp"
 
+    def setLabels(self, labels_dictionary):
+        """
+        Set the colors of the label map using the given labels (the colors can change from project to project).
+        """
+        self.label_colors = [[0,0,0]] * len(self.labels_code_dict)
+        for key in self.labels_code_dict.keys():
+            if key == "Background":
+                self.background_index = self.labels_code_dict[key]
+                self.label_colors[self.background_index] = [0,0,0]
+            else:
+                color = labels_dictionary[key].fill
+                index = self.labels_code_dict[key]
+                self.label_colors[index] = color
 
     def _load_classifier(self, modelName):
 
@@ -144,228 +170,403 @@ class MapClassifier(QObject):
         self.wa_width = round(w_target - 2*self.padding)
         self.wa_height = round(h_target - 2*self.padding)
 
-
-    def run(self, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, prediction_threshold=0.5,
-            save_scores = False, autocolor = False,  autolevel = False):
+    def setupStreaming(self, filename, pixel_size, target_pixel_size, working_area=[], padding=0):
         """
-        :param TILE_SIZE: Base tile. This corresponds to the INPUT SIZE of the network.
-        :param AGGREGATION_WINDOW_SIZE: Size of the center window considered for the aggregation.
-        :param AGGREGATION_STEP: Step, in pixels, to calculate the different scores.
-        :return:
+        Same as setup(), but the map (a GeoTIFF) is not loaded: the rescaled tiles are read by windows directly
+        from the file during the classification, so the memory used does not depend on the size of the map.
         """
+        self.input_image = None
+        self.input_dataset = rio.open(filename)
 
-        # create a temporary folder to store the processing
-        if not os.path.exists(self.temp_dir):
-            os.mkdir(self.temp_dir)
-        else:
-            # if the folder exists, remove all files
-            files = glob.glob(os.path.join(self.temp_dir, "*"))
-            for f in files:
-                os.remove(f)
+        self.scale_factor = target_pixel_size / pixel_size
+        if not working_area:
+            working_area = [0, 0, self.input_dataset.width, self.input_dataset.height]
 
-        # prepare for running..
-        DELTA_CROP = int((TILE_SIZE - AGGREGATION_WINDOW_SIZE) / 2)
-        tile_cols = int(self.wa_width / AGGREGATION_WINDOW_SIZE) + 1
-        tile_rows = int(self.wa_height / AGGREGATION_WINDOW_SIZE) + 1
+        self.padding = round(padding * self.scale_factor)
+        top = int(working_area[0] - self.padding)
+        left = int(working_area[1] - self.padding)
+        width = int(max(513, working_area[2]) + 2*self.padding)
+        height = int(max(513, working_area[3]) + 2*self.padding)
 
-        if torch.cuda.is_available():
-            device = torch.device("cuda")
-            self.net.to(device)
-            torch.cuda.synchronize()
+        self.offset = [working_area[0], working_area[1]]
 
-        self.net.eval()
+        w_target = round(width / self.scale_factor)
+        h_target = round(height / self.scale_factor)
 
-        # classification (per-tiles)
-        tiles_number = tile_rows * tile_cols
+        # area of the map (in map pixels) corresponding to the rescaled image [0, w_target] x [0, h_target]
+        self.input_crop = [top, left, width, height]
+        self.input_size = [w_target, h_target]
 
-        self.processing_step = 0
-        self.total_processing_steps = 19 * tiles_number
+        self.padding = round(self.padding / self.scale_factor)
+        self.wa_top = self.padding
+        self.wa_left = self.padding
+        self.wa_width = round(w_target - 2*self.padding)
+        self.wa_height = round(h_target - 2*self.padding)
 
-        for row in range(tile_rows):
+    def inputTile(self, top, left, size):
+        """
+        It returns the tile (size x size) of the rescaled image with the given top-left corner.
+        The parts outside the map are black.
+        """
+        if self.input_dataset is None:
+            return genutils.cropImage(self.input_image, [top, left, size, size])
+
+        dataset = self.input_dataset
+        [crop_top, crop_left, crop_width, crop_height] = self.input_crop
+        sx = crop_width / self.input_size[0]
+        sy = crop_height / self.input_size[1]
+
+        # part of the tile inside the map (in rescaled image coordinates)
+        x1 = max(left, int(np.ceil(-crop_left / sx)))
+        y1 = max(top, int(np.ceil(-crop_top / sy)))
+        x2 = min(left + size, int(np.floor((dataset.width - crop_left) / sx)))
+        y2 = min(top + size, int(np.floor((dataset.height - crop_top) / sy)))
+
+        tile = np.zeros((size, size, 3), dtype=np.uint8)
+        if x2 <= x1 or y2 <= y1:
+            return tile
+
+        col_off = crop_left + round(x1 * sx)
+        row_off = crop_top + round(y1 * sy)
+        window = Window(col_off, row_off,
+                        min(crop_left + round(x2 * sx), dataset.width) - col_off,
+                        min(crop_top + round(y2 * sy), dataset.height) - row_off)
+
+        indexes = list(range(1, min(dataset.count, 3) + 1))
+        data = dataset.read(indexes, window=window, out_shape=(len(indexes), y2 - y1, x2 - x1),
+                            resampling=Resampling.cubic)
+        data = np.moveaxis(data, 0, -1)
+        if data.shape[2] == 1:
+            data = np.repeat(data, 3, axis=2)
+        if data.dtype != np.uint8:
+            data = np.clip(data, 0, 255).astype(np.uint8)
+
+        tile[y1 - top:y2 - top, x1 - left:x2 - left] = data
+        return tile
+
+    def createOutput(self, output_filename):
+        """
+        Create the (tiled) GeoTIFF receiving the label map of the working area, at the scale of the classifier.
+        """
+        profile = {
+            "driver": "GTiff",
+            "width": self.wa_width,
+            "height": self.wa_height,
+            "count": 3,
+            "dtype": "uint8",
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+            "compress": "DEFLATE",
+            "BIGTIFF": "IF_SAFER"
+        }
+
+        if self.input_dataset is not None and self.input_dataset.crs is not None:
+            [crop_top, crop_left, crop_width, crop_height] = self.input_crop
+            sx = crop_width / self.input_size[0]
+            sy = crop_height / self.input_size[1]
+            profile["crs"] = self.input_dataset.crs
+            profile["transform"] = self.input_dataset.transform * \
+                                   Affine.translation(crop_left + self.wa_left * sx, crop_top + self.wa_top * sy) * \
+                                   Affine.scale(sx, sy)
+
+        return rio.open(output_filename, "w", **profile)
+
+
+    @staticmethod
+    def setThreads(num_threads=None, num_interop_threads=None):
+        """
+        Set the number of threads used by PyTorch on the CPU (intra-op and inter-op parallelism).
+        None keeps the PyTorch default. Useful on CPU-only nodes and when several processes share a node.
+        Note that the inter-op threads can be set only before any parallel work has started.
+        """
+        if num_threads is not None and num_threads > 0:
+            torch.set_num_threads(num_threads)
 
-            if self.flagStopProcessing is True:
-                break
+        if num_interop_threads is not None and num_interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                print("WARNING! The number of inter-op threads cannot be changed after the parallel work has started.")
 
-            for col in range(tile_cols):
+    def preprocessTile(self, tile, autocolor, autolevel):
+        """
+        Color correction and normalization of a tile. It returns the tile as a C x H x W float32 array.
+        """
+        if autocolor is True and autolevel is False:
+            tile = genutils.whiteblance(tile)
 
-                if self.flagStopProcessing is True:
-                    break
+        if autolevel is True and autocolor is False:
+            tile = genutils.autolevel(tile, 1.0)
 
-                scores = np.zeros((9, self.nclasses, TILE_SIZE, TILE_SIZE))
+        if autolevel is True and autocolor is True:
+            white = genutils.whiteblance(tile)
+            white = white.astype(np.uint8)
+            tile = genutils.autolevel(white, 1.0)
 
-                k = 0
-                for i in range(-1,2):
-                    for j in range(-1,2):
+        tile = tile.astype(np.float32)
+        tile = tile / 255.0
 
-                        top = self.wa_top - DELTA_CROP + row * AGGREGATION_WINDOW_SIZE + i * AGGREGATION_STEP
-                        left = self.wa_left - DELTA_CROP + col * AGGREGATION_WINDOW_SIZE + j * AGGREGATION_STEP
-                        img_np = genutils.cropImage(self.input_image, [top, left, TILE_SIZE, TILE_SIZE])
+        # H x W x C --> C x H x W
+        tile = tile.transpose(2, 0, 1)
 
-                        if autocolor is True and autolevel is False:
-                            img_np = genutils.whiteblance(img_np)
+        # Normalization (average subtraction)
+        tile[0] = tile[0] - self.average_norm[0]
+        tile[1] = tile[1] - self.average_norm[1]
+        tile[2] = tile[2] - self.average_norm[2]
 
-                        if autolevel is True and autocolor is False:
-                            img_np = genutils.autolevel(img_np, 1.0)
+        return tile
 
-                        if autolevel is True and autocolor is True:
-                            white = genutils.whiteblance(img_np)
-                            white = white.astype(np.uint8)
-                            img_np = genutils.autolevel(white, 1.0)
+    def prefetchBatches(self, crops, TILE_SIZE, autocolor, autolevel, batches_queue, stop_event):
+        """
+        Producer thread: it crops and normalizes the tiles of the next batches while the network is running.
+        The size of each batch is the current batch_size (it is reduced by forward() if the memory is not enough).
+        """
+        try:
+            start = 0
+            while start < len(crops):
+                items = crops[start:start + max(1, self.batch_size)]
+                start += len(items)
+                batch = np.zeros((len(items), 3, TILE_SIZE, TILE_SIZE), dtype=np.float32)
+                for n, (cell, k, top, left) in enumerate(items):
+                    tile = self.inputTile(top, left, TILE_SIZE)
+                    batch[n] = self.preprocessTile(tile, autocolor, autolevel)
+
+                batch_tensor = torch.from_numpy(batch)
+                if self.channels_last:
+                    batch_tensor = batch_tensor.contiguous(memory_format=torch.channels_last)
+                if torch.cuda.is_available():
+                    batch_tensor = batch_tensor.pin_memory()
+
+                if not self.putBatch(batches_queue, (items, batch_tensor), stop_event):
+                    return
+
+            self.putBatch(batches_queue, None, stop_event)
+
+        except Exception as e:
+            self.putBatch(batches_queue, e, stop_event)
+
+    @staticmethod
+    def putBatch(batches_queue, item, stop_event):
+        """
+        Put an item in the queue, waiting for a free slot unless the consumer has stopped (otherwise the producer
+        could wait forever on a full queue). It returns False if the consumer has stopped.
+        """
+        while not stop_event.is_set():
+            try:
+                batches_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
 
-                        # if i == 0 and j == 0:
-                        # tilename = "RGB_r=" + str(row) + "_c=" + str(col) + "_i=" + str(i) + "_j=" + str(j) + ".png"
-                        # filename = os.path.join(self.temp_dir, tilename)
-                        # tile = genutils.rgbToQImage(img_np)
-                        # tile.save(filename)
+        return False
 
-                        img_np = img_np.astype(np.float32)
-                        img_np = img_np / 255.0
+    @staticmethod
+    def isOutOfMemory(e):
 
-                        # H x W x C --> C x H x W
-                        img_np = img_np.transpose(2, 0, 1)
+        if isinstance(e, MemoryError):
+            return True
 
-                        # Normalization (average subtraction)
-                        img_np[0] = img_np[0] - self.average_norm[0]
-                        img_np[1] = img_np[1] - self.average_norm[1]
-                        img_np[2] = img_np[2] - self.average_norm[2]
+        # GPU and CPU allocators
+        message = str(e)
+        return "out of memory" in message or "can't allocate memory" in message or "not enough memory" in message
 
-                        with torch.no_grad():
+    def forward(self, batch_tensor, device):
+        """
+        Run the network on a batch of tiles. If the memory (of the GPU or of the CPU) is not enough the batch
+        is split in smaller ones.
+        """
+        device_type = device.type if device is not None else "cpu"
+        dtype = autocastDtype(torch.device(device_type))
+
+        with torch.inference_mode(), torch.autocast(device_type, dtype=dtype, enabled=self.mixed_precision):
+            try:
+                input = batch_tensor.to(device, non_blocking=True) if device is not None else batch_tensor
+                return self.net(input).float().cpu().numpy()
+            except (RuntimeError, MemoryError) as e:
+                if not self.isOutOfMemory(e) or batch_tensor.shape[0] == 1:
+                    raise
+                if device is not None:
+                    torch.cuda.empty_cache()
+                half = batch_tensor.shape[0] // 2
+                self.batch_size = max(1, half)
+                return np.concatenate([self.forward(batch_tensor[:half], device),
+                                       self.forward(batch_tensor[half:], device)])
 
-                            img_tensor = torch.from_numpy(img_np)
-                            input = img_tensor.unsqueeze(0)
+    def run(self, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, prediction_threshold=0.5,
+            save_scores = False, autocolor = False,  autolevel = False, output_filename = None):
+        """
+        :param TILE_SIZE: Base tile. This corresponds to the INPUT SIZE of the network.
+        :param AGGREGATION_WINDOW_SIZE: Size of the center window considered for the aggregation.
+        :param AGGREGATION_STEP: Step, in pixels, to calculate the different scores.
+        :return:
 
-                            if torch.cuda.is_available():
-                                input = input.to(device)
+        The nine shifted tiles of each aggregation window are classified in batches of batch_size tiles
+        (a batch can span neighbouring windows). The tiles are prepared by a separate thread while the network
+        is running. The results are written directly in the label map (and in the scores, if save_scores is True).
 
-                            outputs = self.net(input)
+        If output_filename is given, the label map is written window by window in a tiled GeoTIFF instead of being
+        kept in memory (the scores are not saved in this case).
 
-                            scores[k] = outputs[0].cpu().numpy()
-                            k = k + 1
+        If mixed_precision is True the network runs in float16 on the GPU and in bfloat16 on the CPU (the scores
+        are always returned as float32); if channels_last is True the weights and the tiles use the NHWC layout.
+        """
 
-                            self.processing_step += 1
-                            self.updateProgress.emit( (100.0 * self.processing_step) / self.total_processing_steps )
-                            QCoreApplication.processEvents()
+        # prepare for running..
+        DELTA_CROP = int((TILE_SIZE - AGGREGATION_WINDOW_SIZE) / 2)
+        tile_cols = int(self.wa_width / AGGREGATION_WINDOW_SIZE) + 1
+        tile_rows = int(self.wa_height / AGGREGATION_WINDOW_SIZE) + 1
 
-                if self.flagStopProcessing is True:
-                    break
+        device = None
+        if torch.cuda.is_available():
+            device = torch.device("cuda")
+            self.net.to(device)
+            torch.cuda.synchronize()
 
-                # import matplotlib.pyplot as plt
-                # for k in range(9):
-                #     plt.imshow(scores[k,0,513-256:513+256, 513-256:513+256])
-                #     filename = "C:\\temp\\predPorite_r=" + str(row) + "_c=" + str(col) + "-" + str(k) + ".png"
-                #     plt.savefig(filename)
-                #     plt.close('all')
-                #     plt.imshow(scores[k,1,513-256:513+256, 513-256:513+256])
-                #     filename = "C:\\temp\\predBack_r=" + str(row) + "_c=" + str(col) + "-" + str(k) + ".png"
-                #     plt.savefig(filename)
-                #     plt.close('all')
-                #
-                # por = scores[:,0,513-256:513+256, 513-256:513+256]
-                # por = np.average(por, axis=0)
-                # plt.imshow(por)
-                # filename = "C:\\temp\\por_r=" + str(row) + "_c=" + str(col) + ".png"
-                # plt.savefig(filename)
-                #
-                # back = scores[:,1,513-256:513+256, 513-256:513+256]
-                # back = np.average(back, axis=0)
-                # plt.imshow(back)
-                # filename = "C:\\temp\\backg_r=" + str(row) + "_c=" + str(col) + ".png"
-                # plt.savefig(filename)
-
-                preds_avg = self.aggregateScores(scores, tile_sz=TILE_SIZE,
-                                                     center_window_size=AGGREGATION_WINDOW_SIZE, step=AGGREGATION_STEP)
-
-                values_t, predictions_t = torch.max(torch.from_numpy(preds_avg), 0)
-                preds = predictions_t.cpu().numpy()
-                values_t = values_t.cpu().numpy()
-                unc_matrix = values_t < prediction_threshold
-                preds[unc_matrix] = self.background_index  # assign background
-
-                resimg = np.zeros((preds.shape[0], preds.shape[1], 3), dtype='uint8')
-                for label_index in range(self.nclasses):
-                    resimg[preds == label_index, :] = self.label_colors[label_index]
-
-                tilename = str(row) + "_" + str(col) + ".png"
-                filename = os.path.join(self.temp_dir, tilename)
-                genutils.rgbToQImage(resimg).save(filename)
-
-                if save_scores is True:
-                    tilename = str(row) + "_" + str(col) + ".dat"
-                    filename = os.path.join(self.temp_dir, tilename)
-                    fileobject = open(filename, 'wb')
-                    pkl.dump(preds_avg, fileobject)
-                    fileobject.close()
+        if self.channels_last:
+            self.net.to(memory_format=torch.channels_last)
 
-                self.processing_step += 1
-                self.updateProgress.emit( (100.0 * self.processing_step) / self.total_processing_steps )
-                QCoreApplication.processEvents()
+        self.net.eval()
 
-        self.assembleTiles(tile_rows, tile_cols, AGGREGATION_WINDOW_SIZE, ass_scores= save_scores)
-        torch.cuda.empty_cache()
-        del self.net
-        self.net = None
+        # classification (per-tiles)
+        tiles_number = tile_rows * tile_cols
 
-    def loadScores(self):
+        self.processing_step = 0
+        self.total_processing_steps = 19 * tiles_number
+        self.processed_tiles = 0
+
+        # output (the classified area can exceed the working area)
+        AWS = AGGREGATION_WINDOW_SIZE
+        W = AWS * tile_cols
+        H = AWS * tile_rows
+        if output_filename is not None:
+            self.output_dataset = self.createOutput(output_filename)
+            self.label_map = None
+            self.scores = None
+        else:
+            self.label_map = np.zeros((H, W, 3), dtype=np.uint8)
+            self.scores = np.zeros((self.nclasses, H, W), dtype=np.float32) if save_scores is True else None
 
-        filename = os.path.join(self.temp_dir, "assembled_scores.dat")
-        fileobject = open(filename, 'rb')
-        self.scores = pkl.load(fileobject)
-        fileobject.close()
+        palette = np.zeros((self.nclasses + 1, 3), dtype=np.uint8)
+        for label_index in range(self.nclasses):
+            palette[label_index] = self.label_colors[label_index]
 
-    def assembleTiles(self, tile_rows, tile_cols, AGGREGATION_WINDOW_SIZE, ass_scores = False):
+        # the nine shifted tiles of each aggregation window, in row-major order
+        crops = []
+        for row in range(tile_rows):
+            for col in range(tile_cols):
+                k = 0
+                for i in range(-1, 2):
+                    for j in range(-1, 2):
+                        top = self.wa_top - DELTA_CROP + row * AWS + i * AGGREGATION_STEP
+                        left = self.wa_left - DELTA_CROP + col * AWS + j * AGGREGATION_STEP
+                        crops.append(((row, col), k, top, left))
+                        k = k + 1
+
+        batches_queue = queue.Queue(maxsize=2)
+        stop_event = threading.Event()
+        producer = threading.Thread(target=self.prefetchBatches, daemon=True,
+                                    args=(crops, TILE_SIZE, autocolor, autolevel, batches_queue, stop_event))
+        producer.start()
+
+        pending = {}   # aggregation window -> scores of its shifted tiles
+
+        try:
+            while self.flagStopProcessing is False:
+
+                batch = batches_queue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
 
-        # put tiles together
+                items, batch_tensor = batch
 
-        W = AGGREGATION_WINDOW_SIZE * tile_cols
-        H = AGGREGATION_WINDOW_SIZE * tile_rows
+                # the batches prefetched before a reduction of the batch size are split
+                step = max(1, self.batch_size)
+                outputs = np.concatenate([self.forward(batch_tensor[i:i + step], device)
+                                          for i in range(0, len(items), step)])
+                self.processed_tiles += len(items)
 
-        if ass_scores is True:
-            AWS = AGGREGATION_WINDOW_SIZE
-            assembled_scores = np.zeros((self.nclasses, H, W))
-            for r in range(tile_rows):
-                for c in range(tile_cols):
-                    tilename = str(r) + "_" + str(c) + ".dat"
-                    filename = os.path.join(self.temp_dir, tilename)
+                for (cell, k, top, left), output in zip(items, outputs):
 
-                    fileobject = open(filename, 'rb')
-                    scores = pkl.load(fileobject)
-                    fileobject.close()
+                    scores = pending.get(cell)
+                    if scores is None:
+                        scores = np.zeros((9, self.nclasses, TILE_SIZE, TILE_SIZE), dtype=np.float32)
+                        pending[cell] = scores
+                    scores[k] = output
 
-                    xoffset = c * AGGREGATION_WINDOW_SIZE
-                    yoffset = r * AGGREGATION_WINDOW_SIZE
+                    self.processing_step += 1
 
-                    assembled_scores[:, yoffset: yoffset + AWS, xoffset: xoffset + AWS] = scores[:, 0:AWS, 0:AWS]
+                    if k == 8:
+                        del pending[cell]
+                        self.writeCell(cell, scores, palette, TILE_SIZE, AWS, AGGREGATION_STEP, prediction_threshold)
 
-            working_area_scores = np.zeros((self.nclasses, self.wa_height, self.wa_width))
-            working_area_scores = assembled_scores[:, 0:self.wa_height, 0: self.wa_width]
+                self.updateProgress.emit((100.0 * self.processing_step) / self.total_processing_steps)
+                QCoreApplication.processEvents()
 
-            filename = os.path.join(self.temp_dir, "assembled_scores.dat")
-            fileobject = open(filename, 'wb')
-            pkl.dump(working_area_scores, fileobject)
-            fileobject.close()
+        finally:
+            stop_event.set()
+            producer.join()
 
-        qimglabel = QImage(W, H, QImage.Format_RGB32)
-        painter = QPainter(qimglabel)
+            if self.output_dataset is not None:
+                self.output_dataset.close()
+                self.output_dataset = None
+            if self.input_dataset is not None:
+                self.input_dataset.close()
+                self.input_dataset = None
 
-        for r in range(tile_rows):
-            for c in range(tile_cols):
-                tilename = str(r) + "_" + str(c) + ".png"
-                filename = os.path.join(self.temp_dir, tilename)
-                qimg = QImage(filename)
+        # the classified area can exceed the working area
+        if self.label_map is not None:
+            self.label_map = self.label_map[0:self.wa_height, 0:self.wa_width]
+        if self.scores is not None:
+            self.scores = self.scores[:, 0:self.wa_height, 0:self.wa_width]
 
-                xoffset = c * AGGREGATION_WINDOW_SIZE
-                yoffset = r * AGGREGATION_WINDOW_SIZE
+        torch.cuda.empty_cache()
+        if self.release_network:
+            del self.net
+            self.net = None
 
-                painter.drawImage(xoffset, yoffset, qimg)
+    def writeCell(self, cell, scores, palette, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP,
+                  prediction_threshold):
+        """
+        Aggregate the scores of an aggregation window and put the results in the label map.
+        """
+        preds_avg = self.aggregateScores(scores, tile_sz=TILE_SIZE,
+                                         center_window_size=AGGREGATION_WINDOW_SIZE, step=AGGREGATION_STEP)
+
+        values = np.max(preds_avg, axis=0)
+        preds = np.argmax(preds_avg, axis=0)
+        preds[values < prediction_threshold] = self.background_index  # assign background
+        preds[preds < 0] = self.nclasses  # no background class -> black
+
+        (row, col) = cell
+        AWS = AGGREGATION_WINDOW_SIZE
+        xoffset = col * AWS
+        yoffset = row * AWS
+        labels = palette[preds]
+
+        if self.output_dataset is not None:
+            # the classified area can exceed the working area
+            w = min(AWS, self.wa_width - xoffset)
+            h = min(AWS, self.wa_height - yoffset)
+            if w > 0 and h > 0:
+                window = Window(xoffset, yoffset, w, h)
+                for band in range(3):
+                    self.output_dataset.write(labels[0:h, 0:w, band], band + 1, window=window)
+        else:
+            self.label_map[yoffset:yoffset + AWS, xoffset:xoffset + AWS] = labels
 
-        # detach the qimglabel otherwise the Qt EXPLODES when memory is free
-        painter.end()
+        if self.scores is not None:
+            self.scores[:, yoffset:yoffset + AWS, xoffset:xoffset + AWS] = preds_avg
 
-        # the classified area can exceed the working area
-        qimgworkingarea = qimglabel.copy(0, 0, self.wa_width, self.wa_height)
+        self.processing_step += 1
 
-        labelfile = os.path.join(self.temp_dir, "labelmap.png")
-        qimgworkingarea.save(labelfile)
+    def labelMap(self):
+        """
+        It returns the label map of the working area (as a QImage), available after run().
+        """
+        return genutils.rgbToQImage(self.label_map)
 
     def classify(self, tresh):
         """
@@ -33,11 +33,165 @@ from skimage import measure
 import glob
 import sys
 import json
+import tempfile
 from cv2 import fillPoly
 import datetime
 from skimage.measure import label, regionprops
 from source.Blob import Blob
 from source.Label import Label
+from source.PoissonDisk import PoissonDiskSampler
+from source.SpatialIndex import SpatialIndex
+
+# the tiles are cropped, encoded and annotated by a pool of worker processes when they are many
+EXPORT_PARALLEL_TILES = 32
+EXPORT_CHUNK_SIZE = 8
+
+# rows of the images copied at a time in the memory-mapped arrays read by the workers
+MEMMAP_STRIP_ROWS = 1024
+
+# candidate areas evaluated at a time against the regions of a class (see computeCountsAndPSCV)
+METRICS_CHUNK_SIZE = 256
+
+
+def qimageToMemmap(qimg, filename, mode):
+	"""
+	It copies a QImage in a .npy file (read by the workers as a memory-mapped array) one strip at a time.
+	Mode "RGB" and "RGBA" store the color channels, mode "ID" the integers encoded by genutils.integerMapToQImage.
+	"""
+	w = qimg.width()
+	h = qimg.height()
+
+	qimg = qimg.convertToFormat(QImage.Format_ARGB32 if mode == "RGBA" else QImage.Format_RGB32)
+	bits = qimg.constBits()
+	bits.setsize(qimg.bytesPerLine() * h)
+	pixels = np.frombuffer(bits, np.uint8).reshape(h, qimg.bytesPerLine())[:, :w * 4].reshape(h, w, 4)
+
+	if mode == "ID":
+		array = np.lib.format.open_memmap(filename, mode="w+", dtype=np.int32, shape=(h, w))
+	else:
+		channels = [2, 1, 0, 3] if mode == "RGBA" else [2, 1, 0]   # BGRA -> RGB(A)
+		array = np.lib.format.open_memmap(filename, mode="w+", dtype=np.uint8, shape=(h, w, len(channels)))
+
+	for r in range(0, h, MEMMAP_STRIP_ROWS):
+		strip = pixels[r:r + MEMMAP_STRIP_ROWS]
+		if mode == "ID":
+			strip = strip.astype(np.int32)
+			array[r:r + MEMMAP_STRIP_ROWS] = strip[:, :, 2] + (strip[:, :, 1] << 8) + (strip[:, :, 0] << 16)
+		else:
+			array[r:r + MEMMAP_STRIP_ROWS] = strip[:, :, channels]
+
+	array.flush()
+	del array
+
+
+def cropTile(array, top, left, size):
+	"""
+	Crop a tile of an array, the part outside the array is filled with zeros (as QImage.copy does).
+	"""
+	tile = np.zeros((size, size) + array.shape[2:], dtype=array.dtype)
+
+	h = array.shape[0]
+	w = array.shape[1]
+	r0 = max(top, 0)
+	r1 = min(top + size, h)
+	c0 = max(left, 0)
+	c1 = min(left + size, w)
+	if r0 < r1 and c0 < c1:
+		tile[r0 - top:r1 - top, c0 - left:c1 - left] = array[r0:r1, c0:c1]
+
+	return tile
+
+
+def saveTile(filename, tile):
+
+	if tile.shape[2] == 4:
+		cv2.imwrite(filename, cv2.cvtColor(tile, cv2.COLOR_RGBA2BGRA))
+	else:
+		cv2.imwrite(filename, cv2.cvtColor(tile, cv2.COLOR_RGB2BGR))
+
+
+def regionContour(region):
+	"""
+	It returns the outer contour of a region (in tile coordinates), as extracted for the blobs.
+	"""
+	blob = Blob(None, 0, 0, 0)
+	bbox = np.array([region.bbox[0], region.bbox[1], region.bbox[3] - region.bbox[1], region.bbox[2] - region.bbox[0]])
+	blob.createContourFromMask(region.image.astype(int), bbox)
+	return blob.contour
+
+
+def exportTiles(tiles, sources, settings):
+	"""
+	It crops and saves the RGB and the label tiles of a list of (index, top, left), reading the images from the
+	memory-mapped arrays of NewDataset.createTileSources. It runs in the worker processes of the dataset export
+	(see NewDataset.cropAndSaveTiles).
+	It returns the annotations of each tile: the YOLO rows as (color key, normalized contour) and the COCO
+	annotations without the ids, which are assigned by the main process in the order of the tiles.
+	"""
+	ortho = np.load(sources["ortho"], mmap_mode="r")
+	labels = np.load(sources["label"], mmap_mode="r")
+	ids = np.load(sources["id"], mmap_mode="r") if "id" in sources else None
+
+	data_format = settings["data_format"]
+	tile_size = settings["tile_size"]
+
+	results = []
+	for (i, top, left) in tiles:
+
+		name = settings["tilename"] + str.format("_{0:04d}", (i))
+
+		filenameRGB = os.path.join(settings["basenameim"], name + ".png")
+		saveTile(filenameRGB, cropTile(ortho, top, left, tile_size))
+
+		croplabel = cropTile(labels, top, left, tile_size)
+		saveTile(os.path.join(settings["basenamelab"], name + ".png"), croplabel)
+
+		annotations = []
+
+		if ids is not None:
+
+			regions_map = cropTile(ids, top, left, tile_size)
+			regions = measure.regionprops(regions_map)
+
+			if data_format == "YOLO-v5":
+
+				for region in regions:
+					row = region.centroid[0]
+					col = region.centroid[1]
+					rgb = croplabel[int(row), int(col)]
+					color_key = Label.convertColorToKey(int(rgb[0]), int(rgb[1]), int(rgb[2]))
+					if color_key != "000-000-000":
+						contour = regionContour(region) / tile_size
+						txt = " ".join(["{:.6f} {:.6f}".format(x, y) for (x, y) in contour.tolist()])
+						annotations.append((color_key, txt))
+
+			if data_format == "COCO":
+
+				for region in regions:
+
+					tilemask = (regions_map == region.label).astype(np.uint8)
+					segmentation = maskcoco.encode(np.asfortranarray(tilemask))
+					segmentation["counts"] = segmentation["counts"].decode("utf-8")
+
+					category_id = -1
+					for jj in range(10):
+						N = int((jj * region.coords.shape[0]) / 10)
+						rgb = croplabel[region.coords[N, 0], region.coords[N, 1]]
+						color_key = Label.convertColorToKey(int(rgb[0]), int(rgb[1]), int(rgb[2]))
+						if color_key != "000-000-000":
+							category_id = settings["color_to_category_id"][color_key]
+
+					# COCO format for BBOX -> [x,y,width,height]
+					bbox = [region.bbox[1], region.bbox[0], region.bbox[3] - region.bbox[1], region.bbox[2] - region.bbox[0]]
+
+					infos = {'segmentation': segmentation, 'area': int(region.area), 'iscrowd': 0, 'image_id': None,
+							 'bbox': bbox, 'category_id': category_id, "id": None}
+
+					annotations.append(infos)
+
+		results.append((name, filenameRGB, annotations))
+
+	return results
 
 
 class NewDataset(object):
@@ -79,6 +233,9 @@ class NewDataset(object):
 		#self.idmap = None
 		self.id_image = None
 
+		# memory-mapped images read by the workers during the export of the tiles (see createTileSources)
+		self.tile_sources = None
+
 		self.frequencies = None
 
 		self.radius_map = None
@@ -258,29 +415,105 @@ class NewDataset(object):
 		self.frequencies = frequencies
 
 
-	def computeExactCoverage(self, area, target_classes):
+	def metricsClasses(self, target_classes):
 		"""
-		Compute the coverage of the target classes inside the given area.
-		The area is stored as (top, left, width, height).
+		The classes considered by the landscape metrics (background is skipped), in the order of the metrics.
 		"""
+		return [key for key in target_classes.keys() if key != "Background"]
 
-		top = area[0]
-		left = area[1]
-		right = left + area[2]
-		bottom = top + area[3]
-		labelsint = self.labels[top:bottom, left:right].copy()
 
-		A = float(area[2] * area[3])
+	def computeExactCoverage(self, areas, target_classes):
+		"""
+		Compute the coverage of the target classes inside the given areas, an array of (top, left, width, height).
+		The pixels of a class inside an area are counted in O(1) using the summed-area table (integral image)
+		of the class, built once for all the areas. It returns an array (areas x classes).
+		"""
+		areas = np.asarray(areas, dtype=np.int64).reshape(-1, 4)
+		classes = self.metricsClasses(target_classes)
 
-		# background is skipped
-		coverage_per_class = {}
-		for key in target_classes.keys():
-			if key != "Background":
-				label_code = target_classes[key]
-				coverage = float(np.count_nonzero(labelsint == label_code)) / A
-				coverage_per_class[key] = coverage
+		h = self.labels.shape[0]
+		w = self.labels.shape[1]
+		top = np.clip(areas[:, 0], 0, h)
+		left = np.clip(areas[:, 1], 0, w)
+		bottom = np.clip(areas[:, 0] + areas[:, 3], 0, h)
+		right = np.clip(areas[:, 1] + areas[:, 2], 0, w)
+
+		A = (areas[:, 2] * areas[:, 3]).astype(np.float64)
+
+		coverage = np.zeros((areas.shape[0], len(classes)))
+		dtype = np.int32 if h * w < 2**31 else np.int64
+
+		# one table at a time, the tables of all the classes can be too big for the large maps
+		for j, key in enumerate(classes):
+			table = np.zeros((h + 1, w + 1), dtype=dtype)
+			np.cumsum(self.labels == target_classes[key], axis=0, dtype=dtype, out=table[1:, 1:])
+			np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+
+			counts = table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+			coverage[:, j] = counts / A
+			del table
+
+		return coverage
+
+
+	def computeCountsAndPSCV(self, areas, target_classes, threshold=3.0/4.0):
+		"""
+		Compute the number of corals and the Patch Size Coefficient of Variation (PSCV) of the target classes inside
+		the given areas, an array of (top, left, width, height). A coral is counted if and only if its bbox is inside
+		the area for more than the threshold. The bboxes and the areas of the regions are grouped by class and
+		tested against a chunk of areas at a time. It returns two arrays (areas x classes).
+		"""
+		areas = np.asarray(areas, dtype=np.float64).reshape(-1, 4)
+		classes = self.metricsClasses(target_classes)
+
+		number = np.zeros((areas.shape[0], len(classes)), dtype=np.int64)
+		PSCV = np.zeros((areas.shape[0], len(classes)))
+
+		for j, key in enumerate(classes):
 
-		return coverage_per_class
+			if self.frequencies[key] <= 0.0:
+				continue
+
+			blobs = [blob for blob in self.blobs if blob.class_name == key]
+			if len(blobs) == 0:
+				continue
+
+			bboxes = np.array([blob.bbox for blob in blobs], dtype=np.float64)
+			sizes = np.array([blob.area for blob in blobs], dtype=np.float64)
+			bbox_area = bboxes[:, 2] * bboxes[:, 3]
+
+			for start in range(0, areas.shape[0], METRICS_CHUNK_SIZE):
+				chunk = areas[start:start + METRICS_CHUNK_SIZE]
+
+				# intersection of the bboxes (see bbox_intersection), chunk x regions
+				dx = np.minimum(chunk[:, 1, None] + chunk[:, 2, None], bboxes[None, :, 1] + bboxes[None, :, 2]) \
+					 - np.maximum(chunk[:, 1, None], bboxes[None, :, 1])
+				dy = np.minimum(chunk[:, 0, None] + chunk[:, 3, None], bboxes[None, :, 0] + bboxes[None, :, 3]) \
+					 - np.maximum(chunk[:, 0, None], bboxes[None, :, 0])
+				intersection = np.maximum(dx, 0.0) * np.maximum(dy, 0.0)
+
+				with np.errstate(divide='ignore', invalid='ignore'):
+					inside = (intersection / bbox_area > threshold).astype(np.float64)
+
+					n = inside.sum(axis=1)
+					mean_areas = (inside @ sizes) / n
+					var_areas = np.maximum((inside @ (sizes * sizes)) / n - mean_areas * mean_areas, 0.0)
+					pscv = (100.0 * np.sqrt(var_areas)) / mean_areas
+
+				number[start:start + METRICS_CHUNK_SIZE, j] = n.astype(np.int64)
+				PSCV[start:start + METRICS_CHUNK_SIZE, j] = np.where(n > 0, pscv, 0.0)
+
+		return number, PSCV
+
+
+	def computeMetrics(self, areas, target_classes):
+		"""
+		Spatial/ecological metrics (number of corals, coverage and PSCV per class) of many areas at once.
+		"""
+		number, PSCV = self.computeCountsAndPSCV(areas, target_classes)
+		coverage = self.computeExactCoverage(areas, target_classes)
+
+		return number, coverage, PSCV
 
 
 	# FIXME: This function is no more valid and it must be reimplemented
@@ -322,35 +555,9 @@ class NewDataset(object):
 		The area is stored as (top, left, width, height).
 		"""
 
-		number = []
-		PSCV = []
-
-		# a coral is counted if and only if it is inside the given area for 3/4
-		for key in enumerate(target_classes.keys()):
-
-			if key != "Background":
+		number, coverage, PSCV = self.computeMetrics([area], target_classes)
 
-				areas = []
-				if self.frequencies[key] > 0.0:
-					for blob in self.blobs:
-						if blob.class_name == key and self.checkBlobInside(area, blob, 3.0/4.0):
-							areas.append(blob.area)
-
-				# number of entities
-				number.append(len(areas))
-
-				if len(areas) > 0:
-					# Patch Size Coefficient of Variation (PSCV)
-					mean_areas = np.mean(areas)
-					std_areas = np.std(areas)
-					PSCV.append((100.0 * std_areas) / mean_areas)
-				else:
-					PSCV.append(0.0)
-
-		# coverage evaluation
-		coverage = self.computeExactCoverage(area, target_classes)
-
-		return number, coverage, PSCV
+		return number[0].tolist(), coverage[0].tolist(), PSCV[0].tolist()
 
 
 	def rangeScore(self, area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV):
@@ -439,71 +646,49 @@ class NewDataset(object):
 
 		landscape_number, landscape_coverage, landscape_PSCV = self.calculateMetrics([0, 0, map_w, map_h], target_classes)
 
-		# calculate normalization factor
-		numbers = []
-		coverages = []
-		PSCVs = []
-		sn = []
-		sc = []
-		sP = []
-		for i in range(5000):
-
-			aspect_ratio_factor = factor = rnd.uniform(0.4, 2.5)
-			w = int(area_w / aspect_ratio_factor)
-			h = int(area_h * aspect_ratio_factor)
-			px = rnd.randint(0, map_w - w - 1)
-			py = rnd.randint(0, map_h - h - 1)
-
-			area_bbox = [py, px, w, h]
-			area_number, area_coverage, area_PSCV = self.calculateMetrics(area_bbox, target_classes)
-			s1, s2, s3 = self.rangeScore(area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV)
-
-			numbers.append(area_number)
-			coverages.append(area_coverage)
-			PSCVs.append(area_PSCV)
-
-			sn.append(s1)
-			sc.append(s2)
-			sP.append(s3)
-
-			if i % 50 == 0:
-				sys.stdout.write("\rFinding biologically representative areas (pass 1/2)... %.2f %%" % ((i * 100.0) / 5000.0))
-
-		sn = np.array(sn)
-		sc = np.array(sc)
-		sP = np.array(sP)
-		self.sn_min = np.min(sn, axis=0)
-		self.sn_max = np.max(sn, axis=0)
-		self.sc_min = np.min(sc, axis=0)
-		self.sc_max = np.max(sc, axis=0)
-		self.sP_min = np.min(sP, axis=0)
-		self.sP_max = np.max(sP, axis=0)
+		# the candidate areas: the first 5000 are used to calculate the normalization factors, the others are scored
+		candidates = []
+		for i in range(15000):
 
-		for i in range(10000):
-
-			aspect_ratio_factor = factor = rnd.uniform(0.4, 2.5)
+			aspect_ratio_factor = rnd.uniform(0.4, 2.5)
 			w = int(area_w / aspect_ratio_factor)
 			h = int(area_h * aspect_ratio_factor)
-
 			px = rnd.randint(0, map_w - w - 1)
 			py = rnd.randint(0, map_h - h - 1)
 
-			area_bbox = [py, px, w, h]
+			candidates.append([py, px, w, h])
 
-			area_number, area_coverage, area_PSCV = self.calculateMetrics(area_bbox, target_classes)
-			scores = self.calculateNormalizedScore(area_number, area_coverage, area_PSCV, landscape_number, landscape_coverage, landscape_PSCV)
+		sys.stdout.write("Finding biologically representative areas...\n")
 
-			for jj, score in enumerate(scores):
-				if math.isnan(score):
-					scores[jj] = 0.0
+		# the metrics of all the candidates are calculated at once
+		numbers, coverages, PSCVs = self.computeMetrics(candidates, target_classes)
 
-			aggregated_score = sum(scores) / len(scores)
+		# distances from the landscape metrics (see rangeScore)
+		valid = np.array(landscape_number) > 0
+		with np.errstate(divide='ignore', invalid='ignore'):
+			sn = np.where(valid, np.abs((numbers / np.array(landscape_number, dtype=np.float64)) * 100.0 - 15.0), 0.0)
+		sc = np.where(valid, np.abs((coverages - np.array(landscape_coverage)) * 100.0), 0.0)
+		sP = np.where(valid, np.abs(PSCVs - np.array(landscape_PSCV)), 0.0)
 
-			area_info.append((area_bbox, scores, aggregated_score))
+		# calculate normalization factor
+		self.sn_min = np.min(sn[:5000], axis=0)
+		self.sn_max = np.max(sn[:5000], axis=0)
+		self.sc_min = np.min(sc[:5000], axis=0)
+		self.sc_max = np.max(sc[:5000], axis=0)
+		self.sP_min = np.min(sP[:5000], axis=0)
+		self.sP_max = np.max(sP[:5000], axis=0)
+
+		# normalized scores (see calculateNormalizedScore)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			scores = ((sn[5000:] - self.sn_min) / (self.sn_max - self.sn_min) +
+					  (sc[5000:] - self.sc_min) / (self.sc_max - self.sc_min) +
+					  (sP[5000:] - self.sP_min) / (self.sP_max - self.sP_min)) / 3.0
+		scores = np.where(valid & ~np.isnan(scores), scores, 0.0)
 
-			if i % 50 == 0:
-				sys.stdout.write("\rFinding biologically representative areas (pass 2/2)... %.2f %%" % ((i * 100.0) / 10000.0))
+		aggregated_scores = scores.sum(axis=1) / scores.shape[1]
 
+		for i in range(scores.shape[0]):
+			area_info.append((candidates[5000 + i], scores[i].tolist(), aggregated_scores[i]))
 
 		area_info.sort(key=lambda x:x[2])
 		val_area = area_info[0][0]
@@ -817,53 +1002,47 @@ class NewDataset(object):
 			else:
 				self.training_tiles.append(tile)
 
-	def cleanTrainingTiles(self, training_tiles):
+	def tilesIndex(self, tiles, half_size):
 		"""
-		If a training tile intersect a validation or a test tile it is removed.
+		Spatial index of the bboxes of the given tiles (the tiles are centered in the samples).
 		"""
+		index = SpatialIndex(cell_size=max(int(half_size * 2), 1))
+		for tile in tiles:
+			bbox = [tile[1] - half_size, tile[0] - half_size, half_size * 2, half_size * 2]
+			index.insert(bbox, bbox)
 
-		cleaned_tiles = []
-		bbox1 = [0, 0, 0, 0]
-		bbox2 = [0, 0, 0, 0]
-		size = self.crop_size + 4
-		half_size = int(size / 2)
-
-		for tile in training_tiles:
+		return index
 
-			bbox1[0] = tile[1] - half_size
-			bbox1[1] = tile[0] - half_size
-			bbox1[2] = half_size * 2
-			bbox1[3] = half_size * 2
 
-			flag = True
-			for vtile in self.validation_tiles:
+	def overlapsTiles(self, bbox, index, threshold=10.0):
+		"""
+		It returns True if the bbox intersects one of the indexed tiles for more than the threshold (in percentage).
+		"""
+		for bbox2 in index.query(bbox):
+			area = self.bbox_intersection(bbox, bbox2)
+			area_perc = (100.0 * area) / float(bbox[2] * bbox[3])
+			if area_perc > threshold:
+				return True
 
-				bbox2[0] = vtile[1] - half_size
-				bbox2[1] = vtile[0] - half_size
-				bbox2[2] = half_size * 2
-				bbox2[3] = half_size * 2
+		return False
 
-				area = self.bbox_intersection(bbox1, bbox2)
-				area_perc = (100.0*area) / float(bbox1[2] * bbox1[3])
-				if area_perc > 10.0:
-					flag = False
-					break
 
-			if flag is True:
-				for ttile in self.test_tiles:
+	def cleanTrainingTiles(self, training_tiles):
+		"""
+		If a training tile intersect a validation or a test tile it is removed.
+		"""
 
-					bbox2[0] = ttile[1] - half_size
-					bbox2[1] = ttile[0] - half_size
-					bbox2[2] = half_size * 2
-					bbox2[3] = half_size * 2
+		size = self.crop_size + 4
+		half_size = int(size / 2)
 
-					area = self.bbox_intersection(bbox1, bbox2)
-					area_perc = (100.0 * area) / float(bbox1[2] * bbox1[3])
-					if area_perc > 10.0:
-						flag = False
-						break
+		# the tiles tested are only the ones close to the training tile
+		validation_index = self.tilesIndex(self.validation_tiles, half_size)
+		test_index = self.tilesIndex(self.test_tiles, half_size)
 
-			if flag is True:
+		cleaned_tiles = []
+		for tile in training_tiles:
+			bbox = [tile[1] - half_size, tile[0] - half_size, half_size * 2, half_size * 2]
+			if not self.overlapsTiles(bbox, validation_index) and not self.overlapsTiles(bbox, test_index):
 				cleaned_tiles.append(tile)
 
 		return cleaned_tiles
@@ -874,46 +1053,16 @@ class NewDataset(object):
 		It can be required by the oversampling.
 		"""
 
-		cleaned_tiles = []
-		bbox1 = [0, 0, 0, 0]
-		bbox2 = [0, 0, 0, 0]
 		size = self.crop_size + 4
 		half_size = size / 2
 
-		for vtile in validation_tiles:
-
-			bbox1[0] = vtile[1] - half_size
-			bbox1[1] = vtile[0] - half_size
-			bbox1[2] = half_size * 2
-			bbox1[3] = half_size * 2
-
-			flag = True
-			for ttile in self.training_tiles:
-
-				bbox2[0] = ttile[1] - half_size
-				bbox2[1] = ttile[0] - half_size
-				bbox2[2] = half_size * 2
-				bbox2[3] = half_size * 2
-
-				area = self.bbox_intersection(bbox1, bbox2)
-				area_perc = (100.0*area) / float(bbox1[2] * bbox1[3])
-				if area_perc > 10.0:
-					flag = False
+		training_index = self.tilesIndex(self.training_tiles, half_size)
+		test_index = self.tilesIndex(self.test_tiles, half_size)
 
-			if flag is True:
-				for tile in self.test_tiles:
-
-					bbox2[0] = tile[1] - half_size
-					bbox2[1] = tile[0] - half_size
-					bbox2[2] = half_size * 2
-					bbox2[3] = half_size * 2
-
-					area = self.bbox_intersection(bbox1, bbox2)
-					area_perc = (100.0 * area) / float(bbox1[2] * bbox1[3])
-					if area_perc > 10.0:
-						flag = False
-
-			if flag is True:
+		cleaned_tiles = []
+		for vtile in validation_tiles:
+			bbox = [vtile[1] - half_size, vtile[0] - half_size, half_size * 2, half_size * 2]
+			if not self.overlapsTiles(bbox, training_index) and not self.overlapsTiles(bbox, test_index):
 				cleaned_tiles.append(vtile)
 
 		return cleaned_tiles
@@ -944,7 +1093,7 @@ class NewDataset(object):
 		self.radius_map = gaussian(self.radius_map, sigma=60.0, mode='reflect')
 
 
-	def sampleBlobWimportanceSampling(self, blob, current_samples):
+	def sampleBlobWimportanceSampling(self, blob, sampler):
 
 		offset_x = blob.bbox[1]
 		offset_y = blob.bbox[0]
@@ -963,23 +1112,12 @@ class NewDataset(object):
 				px = px + offset_x
 				py = py + offset_y
 
-				r1 = self.radius_map[py, px]
+				sampler.tryAdd(px, py, self.radius_map[py, px])
 
-				flag = True
-				for sample in current_samples:
-					r2 = self.radius_map[sample[1], sample[0]]
-					d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-					if d < (r1 + r2) / 2.0:
-						flag = False
-						break
+		return sampler
 
-				if flag is True:
-					current_samples.append((px, py))
 
-		return current_samples
-
-
-	def sampleSubAreaWImportanceSampling(self, area, current_samples):
+	def sampleSubAreaWImportanceSampling(self, area, sampler):
 		"""
 		Sample the given area using the Poisson Disk sampling according to the given radius map.
 		The area is stored as (top, left, width, height).
@@ -994,23 +1132,12 @@ class NewDataset(object):
 			px = rnd.randint(left, left + w - 1)
 			py = rnd.randint(top, top + h - 1)
 
-			r1 = self.radius_map[py, px]
-
-			flag = True
-			for sample in current_samples:
-				r2 = self.radius_map[sample[1], sample[0]]
-				d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-				if d < (r1+r2)/2.0:
-					flag = False
-					break
+			sampler.tryAdd(px, py, self.radius_map[py, px])
 
-			if flag is True:
-				current_samples.append((px, py))
+		return sampler
 
-		return current_samples
 
-
-	def sampleBlobWPoissonDisk(self, blob, current_samples, r):
+	def sampleBlobWPoissonDisk(self, blob, sampler, r):
 
 		map_w = self.ortho_image.width()
 		map_h = self.ortho_image.height()
@@ -1033,21 +1160,12 @@ class NewDataset(object):
 				py = py + offset_y
 
 				if px > self.crop_size and px < map_w - self.crop_size and py > self.crop_size and py < map_h - self.crop_size:
+					sampler.tryAdd(px, py, 2.0 * r)
 
-					flag = True
-					for sample in current_samples:
-						d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-						if d < 2.0*r:
-							flag = False
-							break
-
-					if flag is True:
-						current_samples.append((px, py))
-
-		return current_samples
+		return sampler
 
 
-	def sampleBackgroundWPoissonDisk(self, area, current_samples, r):
+	def sampleBackgroundWPoissonDisk(self, area, sampler, r):
 
 		offset_x = int(area[1])
 		offset_y = int(area[0])
@@ -1063,17 +1181,9 @@ class NewDataset(object):
 				px = px + offset_x
 				py = py + offset_y
 
-				flag = True
-				for sample in current_samples:
-					d = math.sqrt((sample[0] - px) * (sample[0] - px) + (sample[1] - py) * (sample[1] - py))
-					if d < 2.0*r:
-						flag = False
-						break
+				sampler.tryAdd(px, py, 2.0 * r)
 
-				if flag is True:
-					current_samples.append((px, py))
-
-		return current_samples
+		return sampler
 
 
 	def oversamplingBlobsWPoissonDisk(self, area, classes_to_sample, radii):
@@ -1083,19 +1193,27 @@ class NewDataset(object):
 		The functions returns a list of (x,y) coordinates.
 		"""
 
+		# the samples of the rare classes are the closest ones
+		sampler = PoissonDiskSampler(2.0 * min(list(radii) + [280.0]))
+
 		# minority classes are sampled before majority classes
-		samples = []
 		for i, class_name in enumerate(classes_to_sample):
 			radius = radii[i]
 			for blob in self.blobs:
 				if blob.class_name == class_name:
-					samples = self.sampleBlobWPoissonDisk(blob, samples, radius)
-					txt = str(len(samples)) + "\r"
+					sampler = self.sampleBlobWPoissonDisk(blob, sampler, radius)
+					txt = str(len(sampler)) + "\r"
 					sys.stdout.write(txt)
 
-		samples = self.sampleBackgroundWPoissonDisk(area=area, current_samples=samples, r=280.0)
+		# the background samples are farther apart, their grid is sized to their distance
+		background_r = 280.0
+		background_sampler = PoissonDiskSampler(2.0 * background_r)
+		for (x, y), distance in zip(sampler.samples, sampler.distances):
+			background_sampler.add(x, y, distance)
+
+		background_sampler = self.sampleBackgroundWPoissonDisk(area=area, sampler=background_sampler, r=background_r)
 
-		return samples
+		return background_sampler.samples
 
 
 	def oversamplingBlobsWImportanceSampling(self, area, classes_to_sample, radii):
@@ -1105,13 +1223,15 @@ class NewDataset(object):
 		The functions returns a list of (x,y) coordinates.
 		"""
 
+		# the radius of a sample depends on its position
+		sampler = PoissonDiskSampler(max(float(np.mean(self.radius_map)), 1.0), variable=True)
+
 		# minority classes are sampled before majority classes
-		samples = []
 		for class_name in classes_to_sample:
 			for blob in self.blobs:
 				if blob.class_name == class_name:
-					samples = self.sampleBlobWimportanceSampling(blob, samples)
-					txt = str(len(samples)) + "\r"
+					sampler = self.sampleBlobWimportanceSampling(blob, sampler)
+					txt = str(len(sampler)) + "\r"
 					sys.stdout.write(txt)
 
 		tile_size = 1024
@@ -1134,9 +1254,9 @@ class NewDataset(object):
 
 				sub_area = [top, left, tile_size, tile_size]
 
-				samples = self.sampleSubAreaWImportanceSampling(sub_area, samples)
+				sampler = self.sampleSubAreaWImportanceSampling(sub_area, sampler)
 
-		return samples
+		return sampler.samples
 
 
 	def cut_tiles(self, regular=True, oversampling=False, classes_to_sample=None, radii=None):
@@ -1155,11 +1275,50 @@ class NewDataset(object):
 			pass  # oversampling must be re-implemented !
 
 
-	def export_tiles(self, basename, tilename):
+	def createTileSources(self, folder):
+		"""
+		Save the images to crop in memory-mapped arrays (.npy files in the given folder) shared with the workers.
+		"""
+		sources = {"ortho": os.path.join(folder, "ortho.npy"), "label": os.path.join(folder, "label.npy")}
+
+		qimageToMemmap(self.ortho_image, sources["ortho"], "RGBA" if self.ortho_image.hasAlphaChannel() else "RGB")
+		qimageToMemmap(self.label_image, sources["label"], "RGB")
+
+		if self.data_format == "COCO" or self.data_format == "YOLO-v5":
+			sources["id"] = os.path.join(folder, "id.npy")
+			qimageToMemmap(self.id_image, sources["id"], "ID")
+
+		return sources
+
+
+	def export_tiles(self, basename, tilename, workers=None, progress=None, canceled=None):
 		"""
 		Exports the tiles INSIDE the given areas (val_area and test_area are stored as (top, left, width, height))
 		The training tiles are the ones of the entire map minus the ones inside the test validation and test area.
+		The tiles are saved by a pool of worker processes (workers=None means one for each CPU), progress is called
+		with the percentage of the tiles exported and the export stops when canceled returns True.
+		It returns False if the export has been canceled.
 		"""
+		with tempfile.TemporaryDirectory(dir=basename) as folder:
+			self.tile_sources = self.createTileSources(folder)
+			try:
+				return self.saveTiles(basename, tilename, workers, progress, canceled)
+			finally:
+				self.tile_sources = None
+
+
+	def saveTiles(self, basename, tilename, workers, progress, canceled):
+
+		if self.data_format == "YOLO-v5":
+			tiles = [self.validation_tiles, self.training_tiles]
+		else:
+			tiles = [self.validation_tiles, self.test_tiles, self.training_tiles]
+		total = max(sum([len(t) for t in tiles]), 1)
+		exported = 0
+
+		def updateProgress(n):
+			if progress is not None:
+				progress(100.0 * (exported + n) / total)
 
 		if self.data_format == "YOLO-v5":
 			yolo_cache_filename = os.path.join(basename, "yolo-cache.json")
@@ -1191,7 +1350,9 @@ class NewDataset(object):
 		except:
 			pass
 
-		self.cropAndSaveTiles(self.validation_tiles, tilename, basenameVim, basenameVlab)
+		if not self.cropAndSaveTiles(self.validation_tiles, tilename, basenameVim, basenameVlab, workers, updateProgress, canceled):
+			return False
+		exported += len(self.validation_tiles)
 
 
 		##### TEST
@@ -1210,7 +1371,9 @@ class NewDataset(object):
 			except:
 				pass
 
-			self.cropAndSaveTiles(self.test_tiles, tilename, basenameTestIm, basenameTestLab)
+			if not self.cropAndSaveTiles(self.test_tiles, tilename, basenameTestIm, basenameTestLab, workers, updateProgress, canceled):
+				return False
+			exported += len(self.test_tiles)
 
 
 		##### TRAIN
@@ -1232,7 +1395,8 @@ class NewDataset(object):
 		except:
 			pass
 
-		self.cropAndSaveTiles(self.training_tiles, tilename, basenameTrainIm, basenameTrainLab)
+		if not self.cropAndSaveTiles(self.training_tiles, tilename, basenameTrainIm, basenameTrainLab, workers, updateProgress, canceled):
+			return False
 
 		if self.data_format == "YOLO-v5":
 			# create dataset.YAML
@@ -1269,11 +1433,16 @@ class NewDataset(object):
 			json.dump(data, fc)
 			fc.close()
 
+		return True
+
 
-	def cropAndSaveTiles(self, tiles, tilename, basenameim, basenamelab):
+	def cropAndSaveTiles(self, tiles, tilename, basenameim, basenamelab, workers=None, progress=None, canceled=None):
 		"""
 		Given a list of tiles save them by cutting the RGB orthoimage and hte label image.
 		COCO annotations is also saved (optionally).
+		The tiles are cropped from the memory-mapped images (see createTileSources) and saved by a pool of worker
+		processes when they are many; the annotations of each chunk of tiles are merged following the order of the
+		tiles. It returns False if the export has been canceled.
 		"""
 
 		imagecount_id = 0
@@ -1281,6 +1450,7 @@ class NewDataset(object):
 
 		imageList = []
 		segmentationList = []
+		color_to_category_id = {}
 
 		if self.data_format == "COCO":
 
@@ -1304,8 +1474,6 @@ class NewDataset(object):
 			list_names.sort()
 
 			# used later to retrieve the category id
-			color_to_category_id = {}
-
 			for i, label_name in enumerate(list_names):
 
 				color_key = self.labels_dict[label_name].getColorAsKey()
@@ -1343,111 +1511,65 @@ class NewDataset(object):
 			jsondata = {'info': info, 'categories': categorieslist}
 
 		half_tile_size = self.tile_size // 2
+		samples = [(i, sample[1] - half_tile_size, sample[0] - half_tile_size) for i, sample in enumerate(tiles)]
 
-		for i, sample in enumerate(tiles):
-
-			cx = sample[0]
-			cy = sample[1]
-			top = cy - half_tile_size
-			left = cx - half_tile_size
-
-			# RGB image
-			cropimg = genutils.cropQImage(self.ortho_image, [top, left, self.tile_size, self.tile_size])
-			filenameRGB = os.path.join(basenameim, tilename + str.format("_{0:04d}", (i)) + ".png")
-			cropimg.save(filenameRGB)
-
-			# image label
-			croplabel = genutils.cropQImage(self.label_image, [top, left, self.tile_size, self.tile_size])
-			filenameLabel = os.path.join(basenamelab, tilename + str.format("_{0:04d}", (i)) + ".png")
-			croplabel.save(filenameLabel)
-
-			if self.data_format == "COCO" or self.data_format == "YOLO-v5":
-
-				cropidlabel = genutils.cropQImage(self.id_image, [top, left, self.tile_size, self.tile_size])
-				cropidlabel = genutils.qimageToNumpyArray(cropidlabel)
-				cropidlabel = cropidlabel.astype(np.int32)
-
-				# decode ids
-				regions_map = np.zeros((cropidlabel.shape[0], cropidlabel.shape[1]), dtype=np.int32)
-				regions_map = cropidlabel[:,:,0] + cropidlabel[:,:,1] * 256 + cropidlabel[:,:,2] * 65536
-				regions = measure.regionprops(regions_map)
+		settings = {"data_format": self.data_format, "tile_size": self.tile_size, "tilename": tilename,
+					"basenameim": basenameim, "basenamelab": basenamelab, "color_to_category_id": color_to_category_id}
 
-				if self.data_format == "YOLO-v5":
-
-					filenameLabel = os.path.join(basenamelab, tilename + str.format("_{0:04d}", (i)) + ".txt")
-					fp = open(filenameLabel, "wt")
-
-					for region in regions:
-						blob = Blob(region,0,0,0)
-						n = blob.contour.shape[0]
-						row = region.centroid[0]
-						col = region.centroid[1]
-						rgb = croplabel.pixel(int(col), int(row))
-						color_key = Label.convertColorToKey(qRed(rgb), qGreen(rgb), qBlue(rgb))
-						if color_key != "000-000-000":
-							class_code = self.yolo_class_mapper.get(color_key)
-							if class_code is None:
-								self.yolo_class_mapper[color_key] = self.yolo_class_counter
-								class_code = self.yolo_class_counter
-								self.yolo_class_counter += 1
+		results = genutils.parallelMap(exportTiles, samples, EXPORT_CHUNK_SIZE, EXPORT_PARALLEL_TILES, workers,
+									   args=(self.tile_sources, settings))
 
-							txt = "{:d} ".format(class_code)
-							for i in range(n):
-								x = blob.contour[i, 0] / self.tile_size
-								y = blob.contour[i, 1] / self.tile_size
-								value = "{:.6f} {:.6f}".format(x,y)
-								txt += value
-								txt += " "
-
-							txt = txt[:-1]
-							txt += "\n"
-							fp.write(txt)
-
-					fp.close()
-
-				if self.data_format == "COCO":
+		done = 0
+		try:
+			for chunk_results in results:
 
-					image_dict = {"license": 2,
-							 "file_name": tilename + str.format("_{0:04d}", (i)) + ".png",
-							 "coco_url": filenameRGB,
-							 "height": self.tile_size,
-							 "width": self.tile_size,
-							 "date_captured": self.image_info.acquisition_date,
-							 "id": imagecount_id }
+				for (name, filenameRGB, annotations) in chunk_results:
 
-					for region in regions:
+					if self.data_format == "YOLO-v5":
 
-						tilemask = np.zeros_like(regions_map).astype(np.uint8)
-						tilemask[region.coords[:, 1], region.coords[:, 0]] = 1
-						#segmentation = genutils.binaryMaskToRle(tilemask)
-						segmentation = maskcoco.encode(np.asfortranarray(np.transpose(tilemask)))
+						filenameLabel = os.path.join(basenamelab, name + ".txt")
+						with open(filenameLabel, "wt") as fp:
+							for (color_key, txt) in annotations:
+								class_code = self.yolo_class_mapper.get(color_key)
+								if class_code is None:
+									self.yolo_class_mapper[color_key] = self.yolo_class_counter
+									class_code = self.yolo_class_counter
+									self.yolo_class_counter += 1
 
-						segmentation["counts"] = segmentation["counts"].decode("utf-8")
+								fp.write("{:d} ".format(class_code) + txt + "\n")
 
-						category_id = -1
-						for jj in range(10):
-							N = int((jj * region.coords.shape[0]) / 10)
-							rgb = croplabel.pixel(region.coords[N, 1], region.coords[N, 0])
-							color_key = Label.convertColorToKey(qRed(rgb), qGreen(rgb), qBlue(rgb))
-							if color_key != "000-000-000":
-								category_id = color_to_category_id[color_key]
+					if self.data_format == "COCO":
 
-						# COCO format for BBOX -> [x,y,width,height]
-						bbox = [region.bbox[1], region.bbox[0], region.bbox[3] - region.bbox[1], region.bbox[2] - region.bbox[0]]
+						image_dict = {"license": 2,
+								 "file_name": name + ".png",
+								 "coco_url": filenameRGB,
+								 "height": self.tile_size,
+								 "width": self.tile_size,
+								 "date_captured": self.image_info.acquisition_date,
+								 "id": imagecount_id }
 
-						infos = {'segmentation': {}, 'area' : int(region.area), 'iscrowd' : 0,'image_id': imagecount_id, 'bbox': bbox, 'category_id': category_id, "id": segcount_id}
+						for infos in annotations:
 
-						segcount_id = segcount_id + 1
+							infos["image_id"] = imagecount_id
+							infos["id"] = segcount_id
+							segcount_id = segcount_id + 1
 
-						infos["segmentation"] = segmentation
+							if infos["category_id"] >= 0:
+								segmentationList.append(infos)
 
-						if category_id >= 0:
-							segmentationList.append(infos)
+						imageList.append(image_dict)
 
-					imageList.append(image_dict)
+						imagecount_id = imagecount_id + 1
 
-					imagecount_id = imagecount_id + 1
+				done += len(chunk_results)
+				if progress is not None:
+					progress(done)
 
+				if canceled is not None and canceled():
+					return False
+		finally:
+			# the tiles not exported yet are discarded when the export is canceled
+			results.close()
 
 		if self.data_format == "COCO":
 
@@ -1457,6 +1579,8 @@ class NewDataset(object):
 			with open(annotations_filename, 'w') as f:
 				json.dump(jsondata, f)
 
+		return True
+
 
 	##### VISUALIZATION FUNCTIONS - FOR DEBUG PURPOSES
 
@@ -0,0 +1,260 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+
+# version of the cache format, increment it to invalidate the existing caches
+CACHE_VERSION = 1
+
+# size of the block of pixels processed at once during the creation of the cache
+BLOCK_SIZE = 4096
+
+
+class OverviewCache(object):
+    """
+    Persistent, on-disk cache of the channels of a project. For each channel it stores a tiled, compressed
+    GeoTIFF with internal overviews, ready to be visualized by tiles (see TiledImage). The DEM channels are
+    stored already converted in a shaded gray-level map (hillshade), so they do not need to be converted when
+    the project is opened.
+    The cache entries are keyed by the path, the modification time and the size of the original file, so they
+    are automatically invalidated when the map changes.
+    """
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+
+    def entryPrefix(self, filename, type):
+        """
+        The prefix identifies the map (different maps can have the same name in different folders).
+        """
+        path_digest = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()[:8]
+        basename = os.path.splitext(os.path.basename(filename))[0]
+
+        return basename + "_" + type + "_" + path_digest + "_"
+
+    def entryName(self, filename, type):
+
+        stat = os.stat(filename)
+        key = "{:d}|{:d}|{:d}".format(stat.st_mtime_ns, stat.st_size, CACHE_VERSION)
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+        return self.entryPrefix(filename, type) + digest
+
+    def entryPaths(self, filename, type):
+
+        name = self.entryName(filename, type)
+        return os.path.join(self.cache_dir, name + ".tif"), os.path.join(self.cache_dir, name + ".json")
+
+    def cachedFile(self, filename, type):
+        """
+        It returns the cached file and its metadata if a valid cache entry exists, (None, None) otherwise.
+        """
+        if self.cache_dir is None or not os.path.exists(filename):
+            return None, None
+
+        tif_filename, json_filename = self.entryPaths(filename, type)
+        if not os.path.exists(tif_filename) or not os.path.exists(json_filename):
+            return None, None
+
+        try:
+            with open(json_filename, "r") as f:
+                metadata = json.load(f)
+        except Exception:
+            return None, None
+
+        return tif_filename, metadata
+
+    def build(self, filename, type, progress=None, force=False):
+        """
+        Create the cache entry of the given map (if it does not exist, or force is True).
+        Progress is an optional function receiving the percentage of completion.
+        It returns the cached file.
+        """
+        tif_filename, metadata = self.cachedFile(filename, type)
+        if tif_filename is not None and not force:
+            return tif_filename
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.removeStaleEntries(filename, type)
+
+        tif_filename, json_filename = self.entryPaths(filename, type)
+        tmp_filename = tif_filename + ".tmp"
+
+        with rio.open(filename) as src:
+
+            metadata = {
+                "source": os.path.abspath(filename),
+                "type": type,
+                "width": src.width,
+                "height": src.height,
+                "nodata": src.nodata,
+                "version": CACHE_VERSION
+            }
+
+            if type == "DEM":
+                value_range = self.demValueRange(src)
+                metadata["value_range"] = list(value_range)
+
+            profile = {
+                "driver": "GTiff",
+                "width": src.width,
+                "height": src.height,
+                "count": 3,
+                "dtype": "uint8",
+                "tiled": True,
+                "blockxsize": 512,
+                "blockysize": 512,
+                "compress": "DEFLATE" if type == "DEM" else "JPEG",
+                "BIGTIFF": "IF_SAFER"
+            }
+            if type != "DEM":
+                profile["photometric"] = "YCBCR"
+            if src.crs is not None:
+                profile["crs"] = src.crs
+                profile["transform"] = src.transform
+
+            with rio.open(tmp_filename, "w", **profile) as dst:
+
+                blocks = [(top, left) for top in range(0, src.height, BLOCK_SIZE)
+                          for left in range(0, src.width, BLOCK_SIZE)]
+
+                for i, (top, left) in enumerate(blocks):
+                    w = min(BLOCK_SIZE, src.width - left)
+                    h = min(BLOCK_SIZE, src.height - top)
+                    window = Window(left, top, w, h)
+
+                    if type == "DEM":
+                        data = self.shadedBlock(src, window, value_range)
+                    else:
+                        data = self.rgbBlock(src, window)
+
+                    dst.write(data, window=window)
+
+                    if progress is not None:
+                        progress(90.0 * (i + 1) / len(blocks))
+
+                factors = []
+                factor = 2
+                while max(src.width, src.height) / factor >= 256:
+                    factors.append(factor)
+                    factor *= 2
+
+                if len(factors) > 0:
+                    dst.build_overviews(factors, Resampling.average)
+                    dst.update_tags(ns="rio_overview", resampling="average")
+
+        os.replace(tmp_filename, tif_filename)
+
+        with open(json_filename, "w") as f:
+            json.dump(metadata, f)
+
+        if progress is not None:
+            progress(100.0)
+
+        return tif_filename
+
+    def removeStaleEntries(self, filename, type):
+        """
+        Remove the old entries of the given map (e.g. created before the map was modified).
+        """
+        prefix = self.entryPrefix(filename, type)
+
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def rgbBlock(self, src, window):
+
+        indexes = list(range(1, min(src.count, 3) + 1))
+        data = src.read(indexes, window=window)
+        if data.shape[0] == 1:
+            data = np.repeat(data, 3, axis=0)
+        if data.dtype != np.uint8:
+            data = np.clip(data, 0, 255).astype(np.uint8)
+
+        return data
+
+    def demValueRange(self, src):
+        """
+        It returns the (min, max) depth values, estimated on a downsampled version of the DEM.
+        """
+        scale = max(max(src.width, src.height) / 2048.0, 1.0)
+        out_shape = (max(1, int(src.height / scale)), max(1, int(src.width / scale)))
+        data = src.read(1, out_shape=out_shape, resampling=Resampling.nearest).astype(np.float32)
+        valid = np.isfinite(data)
+        if src.nodata is not None:
+            valid &= data != src.nodata
+        data = data[valid]
+        if data.size == 0:
+            return (0.0, 1.0)
+
+        return (float(data.min()), float(data.max()))
+
+    def shadedBlock(self, src, window, value_range, azimuth=315.0, altitude=45.0):
+        """
+        It converts a block of the DEM in a gray-level map modulated by the hillshade.
+        The block is read with a border of one pixel to compute the gradient without seams.
+        """
+        left = max(0, window.col_off - 1)
+        top = max(0, window.row_off - 1)
+        right = min(src.width, window.col_off + window.width + 1)
+        bottom = min(src.height, window.row_off + window.height + 1)
+        dem = src.read(1, window=Window(left, top, right - left, bottom - top)).astype(np.float32)
+
+        invalid = ~np.isfinite(dem)
+        if src.nodata is not None:
+            invalid |= dem == src.nodata
+
+        (min_value, max_value) = value_range
+        dem[invalid] = min_value
+
+        xres = abs(src.transform.a) if src.crs is not None else 1.0
+        yres = abs(src.transform.e) if src.crs is not None else 1.0
+        dy, dx = np.gradient(dem, yres, xres)
+
+        slope = np.pi / 2.0 - np.arctan(np.hypot(dx, dy))
+        aspect = np.arctan2(-dx, dy)
+        az = np.radians(360.0 - azimuth + 90.0)
+        alt = np.radians(altitude)
+        shade = np.sin(alt) * np.sin(slope) + np.cos(alt) * np.cos(slope) * np.cos(az - aspect)
+        shade = np.clip(shade, 0.0, 1.0)
+
+        den = max_value - min_value if max_value > min_value else 1.0
+        gray = np.clip((dem - min_value) / den, 0.0, 1.0)
+
+        value = 255.0 * gray * (0.5 + 0.5 * shade)
+        value[invalid] = 0
+        value = value.astype(np.uint8)
+
+        # remove the border
+        r0 = window.row_off - top
+        c0 = window.col_off - left
+        value = value[r0:r0 + window.height, c0:c0 + window.width]
+
+        return np.stack([value, value, value])
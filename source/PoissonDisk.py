@@ -0,0 +1,94 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import math
+
+
+class PoissonDiskSampler(object):
+    """
+    Poisson-disk sampling accelerated by a uniform grid of the accepted samples (as in Bridson's algorithm):
+    a candidate is tested only against the samples of the cells around it, instead of all the samples.
+
+    A candidate conflicts with the accepted samples closer than its distance (the distance can change from
+    a candidate to another, e.g. a radius for each class). If variable is True each sample keeps its own
+    distance (e.g. from a radius map) and two samples conflict if they are closer than the mean of their
+    distances. The cell size should be close to the typical distance.
+    """
+
+    def __init__(self, cell_size, variable=False):
+
+        self.cell_size = float(cell_size)
+        self.variable = variable
+        self.cells = {}        # (cx, cy) -> indices of the samples
+        self.samples = []      # accepted samples, as (x, y)
+        self.distances = []
+        self.max_distance = 0.0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def isFree(self, x, y, distance):
+        """
+        It returns True if a sample in (x, y) with the given distance does not conflict with the accepted ones.
+        """
+        if len(self.samples) == 0:
+            return True
+
+        if self.variable:
+            # the farthest conflicting sample is closer than the mean of the distance and the largest one
+            reach = int(math.ceil((distance + self.max_distance) / (2.0 * self.cell_size)))
+        else:
+            reach = int(math.ceil(distance / self.cell_size))
+
+        (cx, cy) = self.cell(x, y)
+
+        for gy in range(cy - reach, cy + reach + 1):
+            for gx in range(cx - reach, cx + reach + 1):
+                cell = self.cells.get((gx, gy))
+                if cell is None:
+                    continue
+
+                for index in cell:
+                    (sx, sy) = self.samples[index]
+                    d = math.sqrt((sx - x) * (sx - x) + (sy - y) * (sy - y))
+                    min_distance = (distance + self.distances[index]) / 2.0 if self.variable else distance
+                    if d < min_distance:
+                        return False
+
+        return True
+
+    def add(self, x, y, distance):
+
+        self.cells.setdefault(self.cell(x, y), []).append(len(self.samples))
+        self.samples.append((x, y))
+        self.distances.append(distance)
+        self.max_distance = max(self.max_distance, distance)
+
+    def tryAdd(self, x, y, distance):
+        """
+        Add the sample if it does not conflict with the accepted ones. It returns True if the sample is added.
+        """
+        if self.isFree(x, y, distance):
+            self.add(x, y, distance)
+            return True
+
+        return False
@@ -1,7 +1,10 @@
+import io
 import datetime
 import json
 import csv
 import os
+import zipfile
+import time
 
 import numpy as np
 import pandas as pd
@@ -47,14 +50,55 @@ def replacePaths(old_path, new_path, images, taglab_dir):
                 image.georef_filename = taglab_dir.relativeFilePath(filename)
 
 
+# extension of the projects saved in the binary format (see Project.saveBinary)
+BINARY_PROJECT_EXTENSION = ".tlb"
+BINARY_PROJECT_VERSION = 1
+
+def isBinaryProject(filename):
+    return filename.lower().endswith(BINARY_PROJECT_EXTENSION)
+
+def loadBinaryProjectData(filename):
+    """
+    It reads a binary project and returns the same data of the corresponding json project.
+    """
+    with zipfile.ZipFile(filename, "r") as archive:
+        header = json.loads(archive.read("header.json").decode("utf-8"))
+        if header.get("version", 0) > BINARY_PROJECT_VERSION:
+            raise Exception("The project has been saved with a newer version of TagLab.")
+        contours = np.load(io.BytesIO(archive.read("contours.npy")))
+        sizes = np.load(io.BytesIO(archive.read("contour_sizes.npy")))
+
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+
+    def decode(obj):
+        if isinstance(obj, dict):
+            if "$contour" in obj and len(obj) == 1:
+                k = obj["$contour"]
+                return contours[offsets[k]:offsets[k + 1]]
+            return {key: decode(value) for key, value in obj.items()}
+        elif isinstance(obj, list):
+            return [decode(value) for value in obj]
+        return obj
+
+    return decode(header["project"])
+
 def loadProject(taglab_working_dir, filename, default_dict):
     dir = QDir(taglab_working_dir)
     abspath = os.path.join(taglab_working_dir, dir.relativeFilePath(filename))
-    f = open(abspath, "r")
-    try:
-        data = json.load(f)
-    except json.JSONDecodeError as e:
-        raise Exception(str(e))
+
+    if isBinaryProject(abspath):
+        try:
+            data = loadBinaryProjectData(abspath)
+        except (zipfile.BadZipFile, KeyError, ValueError) as e:
+            raise Exception(str(e))
+        f = None
+    else:
+        f = open(abspath, "r")
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise Exception(str(e))
 
     if "Map File" in data:
         project = loadOldProject(taglab_working_dir, data)
@@ -63,13 +107,17 @@ def loadProject(taglab_working_dir, filename, default_dict):
     else:
         project = Project(**data)
 
-    f.close()
+    if f is not None:
+        f.close()
 
     if project.dictionary_name == "":
         project.dictionary_name = "My dictionary"
 
     project.filename = filename
 
+    # on-disk overviews cache of the channels
+    project.setCacheDir(project.cacheDir())
+
     # check if a file exist for each image and each channel
     taglab_dir = QDir(taglab_working_dir)
     for image in project.images:
@@ -151,9 +199,62 @@ def loadOldProject(taglab_working_dir, data):
 
 
 class ProjectEncoder(json.JSONEncoder):
+
+    # keys of the regions saved by this version (see Blob.toDict)
+    REGION_KEYS = set(Blob(None, 0, 0, 0).toDict().keys())
+
+    @staticmethod
+    def isRawContour(contour):
+        """
+        True if the contour is stored in the current format: the string of the json projects or the array of
+        deltas of the binary projects (see loadBinaryProjectData).
+        """
+        return isinstance(contour, str) or (isinstance(contour, np.ndarray) and contour.ndim == 1)
+
+    def encodeRawContour(self, contour):
+        """
+        Contour of a region not decoded yet: the string of the json projects is saved as it is,
+        the array of the binary projects (see loadBinaryProjectData) is converted into the same string.
+        """
+        if isinstance(contour, np.ndarray):
+            return " ".join(np.char.mod('%d', contour))
+        return contour
+
+    def encodeRawRegion(self, data):
+        """
+        Region not decoded yet. The regions saved by older versions (e.g. with the contours stored as lists of
+        points) are decoded and encoded again, so they are saved as if the image had been opened.
+        """
+        if set(data.keys()) != self.REGION_KEYS or not self.isRawContour(data["contour"]) \
+                or not all(self.isRawContour(c) for c in data["inner contours"]):
+            blob = Blob(None, 0, 0, 0)
+            blob.fromDict(data)
+            return self.default(blob)
+
+        data = dict(data)
+        data["contour"] = self.encodeRawContour(data["contour"])
+        data["inner contours"] = [self.encodeRawContour(c) for c in data["inner contours"]]
+        return data
+
+    def encodeRawAnnotations(self, annotations):
+
+        regions = [self.encodeRawRegion(data) for data in annotations.get("regions", [])]
+
+        # the points are few, they are always saved in the current format
+        points = []
+        for data in annotations.get("points", []):
+            point = Point(0, 0, "Empty", 0)
+            point.fromDict(data)
+            points.append(point.save())
+
+        return { "regions": regions, "points": points }
+
     def default(self, obj):
         if isinstance(obj, Image):
-            return obj.save()
+            data = obj.save()
+            if not obj.annotationsLoaded():
+                data["annotations"] = self.encodeRawAnnotations(data["annotations"])
+            return data
         elif isinstance(obj, Channel):
             return obj.save()
         elif isinstance(obj, Label):
@@ -179,6 +280,33 @@ class ProjectEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class ProjectBinaryEncoder(ProjectEncoder):
+    """
+    Same as ProjectEncoder, but the contours of the regions are collected as arrays of integers (the same values
+    stored as text in the json projects) and replaced by a reference {"$contour": index}.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ProjectBinaryEncoder, self).__init__(*args, **kwargs)
+        self.contours = []
+
+    def encodeContour(self, contour):
+        self.contours.append(Blob.toDeltas(contour))
+        return {"$contour": len(self.contours) - 1}
+
+    def encodeRawContour(self, contour):
+
+        if isinstance(contour, str):
+            contour = np.fromiter(map(int, contour.split(' ')), dtype=int)
+
+        self.contours.append(contour)
+        return {"$contour": len(self.contours) - 1}
+
+    def default(self, obj):
+        if isinstance(obj, Blob):
+            return obj.toDict(contour_encoder=self.encodeContour)
+        return ProjectEncoder.default(self, obj)
+
+
 class Project(QObject):
 
     # custom signals
@@ -243,6 +371,21 @@ class Project(QObject):
 
         self.markers = markers  # Store alignment markers with 'ref' & 'coreg' images
 
+    def cacheDir(self):
+        """
+        Folder of the overviews cache of the project channels (next to the project file).
+        """
+        if self.filename is None:
+            return None
+
+        return os.path.splitext(self.filename)[0] + "_cache"
+
+    def setCacheDir(self, cache_dir):
+
+        for image in self.images:
+            for channel in image.channels:
+                channel.cache_dir = cache_dir
+
     def importLabelsFromConfiguration(self, dictionary):
         """
         This function should be removed when the Labels Panel will be finished.
@@ -311,15 +454,48 @@ class Project(QObject):
                         "Inconsistent correspondences has been found !!\nPlease, Notify this problem to the TagLab developers.")
                     msgBox.exec()
 
+        if filename is None:
+            filename = self.filename
+
+        if isBinaryProject(filename):
+            self.saveBinary(filename)
+            return
+
         data = self.__dict__
         str = json.dumps(data, cls=ProjectEncoder, indent=1)
 
-        if filename is None:
-            filename = self.filename
         f = open(filename, "w")
         f.write(str)
         f.close()
 
+    def saveBinary(self, filename):
+        """
+        Save the project in the binary format: a zip archive with a json header (the project without the contours)
+        and the contours of the regions stored as delta-encoded integer arrays. It is loaded by loadProject as
+        the corresponding json project.
+        """
+        encoder = ProjectBinaryEncoder()
+        header = { "version": BINARY_PROJECT_VERSION, "project": self.__dict__ }
+        header_str = encoder.encode(header)
+
+        sizes = np.array([len(c) for c in encoder.contours], dtype=np.int64)
+        if len(encoder.contours) > 0:
+            contours = np.concatenate(encoder.contours)
+        else:
+            contours = np.zeros(0, dtype=np.int64)
+        if len(contours) == 0 or np.abs(contours).max() < 2**31:
+            contours = contours.astype(np.int32)
+
+        tmp_filename = filename + ".tmp"
+        with zipfile.ZipFile(tmp_filename, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            archive.writestr("header.json", header_str)
+            for name, array in [("contours.npy", contours), ("contour_sizes.npy", sizes)]:
+                buffer = io.BytesIO()
+                np.save(buffer, array)
+                archive.writestr(name, buffer.getvalue())
+
+        os.replace(tmp_filename, filename)
+
     # def loadDictionary(self, filename):
     #     """
     #     It returns True if the dictionary is opened correctly, otherwise it returns False.
@@ -610,7 +786,7 @@ class Project(QObject):
                     else:
                         table.set([], blobs_added)
 
-                self.updateGenets()
+                self.genet.updateRegions(img, blobs_added)
 
                 flag_update_table = True
 
@@ -638,7 +814,7 @@ class Project(QObject):
                     for blob in blobs:
                         blob.correspondence_to_check = True
 
-                self.updateGenets()
+                self.genet.updateRegions(img, [], [blob_removed])
 
                 flag_update_table = True
 
@@ -734,7 +910,7 @@ class Project(QObject):
                         for blob in blobs:
                             blob.correspondence_to_check = True
 
-                self.updateGenets()
+                self.genet.updateRegions(img, blobs_added, blob_removed)
 
                 flag_update_table = True
 
@@ -856,7 +1032,8 @@ class Project(QObject):
             blob.correspondence_to_check = False
 
         corresp_table.set(blobs1, blobs2)
-        self.genet.updateGenets()
+        self.genet.updateRegions(corresp_table.source, blobs1)
+        self.genet.updateRegions(corresp_table.target, blobs2)
 
     def updatePixelSizeInCorrespondences(self, image, flag_surface_area):
 
@@ -864,31 +1041,32 @@ class Project(QObject):
         for corr in corresp_tables:
             corr.updateAreas(use_surface_area=flag_surface_area)
 
-    def computeCorrespondences(self, img_source_idx, img_target_idx):
+    def scaledRegion(self, blob, conversion):
         """
-        Compute the correspondences between an image pair.
+        It returns a lightweight copy of the blob, with only the data used by the matching, with the geometry in
+        millimeters and the area in square centimeters.
+        """
+        blob_c = Blob(None, 0, 0, 0)
+        blob_c.id = blob.id
+        blob_c.class_name = blob.class_name
+        blob_c.bbox = (blob.bbox * conversion).round().astype(int)
+        blob_c.contour = blob.contour * conversion
+        blob_c.inner_contours = [inner * conversion for inner in blob.inner_contours]
+        blob_c.area = blob.area * conversion * conversion / 100
+        return blob_c
+
+    def computeCorrespondences(self, img_source_idx, img_target_idx, workers=None):
+        """
+        Compute the correspondences between an image pair. The time spent by the matching is stored in the
+        matching_time of the correspondences table.
         """
 
         conversion1 = self.images[img_source_idx].pixelSize()
         conversion2 = self.images[img_target_idx].pixelSize()
 
         # switch form px to mm just for calculation (except areas that are in cm)
-
-        blobs1 = []
-        for blob in self.images[img_source_idx].annotations.seg_blobs:
-            blob_c = blob.copy()
-            blob_c.bbox = (blob_c.bbox * conversion1).round().astype(int)
-            blob_c.contour = blob_c.contour * conversion1
-            blob_c.area = blob_c.area * conversion1 * conversion1 / 100
-            blobs1.append(blob_c)
-
-        blobs2 = []
-        for blob in self.images[img_target_idx].annotations.seg_blobs:
-            blob_c = blob.copy()
-            blob_c.bbox = (blob_c.bbox * conversion2).round().astype(int)
-            blob_c.contour = blob_c.contour * conversion2
-            blob_c.area = blob_c.area * conversion2 * conversion2 / 100
-            blobs2.append(blob_c)
+        blobs1 = [self.scaledRegion(blob, conversion1) for blob in self.images[img_source_idx].annotations.seg_blobs]
+        blobs2 = [self.scaledRegion(blob, conversion2) for blob in self.images[img_target_idx].annotations.seg_blobs]
 
         # create correspondences table
         if self.correspondences is None:
@@ -896,8 +1074,10 @@ class Project(QObject):
 
         corr = self.createCorrespondencesTable(img_source_idx, img_target_idx)
 
-        corr.autoMatch(blobs1, blobs2)
-        #corr.autoMatchM(blobs1, blobs2)   # autoMatchM resolves matching taking into account live/dead specimens (class name constraint is removed)
+        start = time.time()
+        corr.autoMatch(blobs1, blobs2, workers=workers)
+        #corr.autoMatchM(blobs1, blobs2, workers=workers)   # autoMatchM resolves matching taking into account live/dead specimens (class name constraint is removed)
+        corr.matching_time = time.time() - start
 
         lines = corr.correspondences + corr.dead + corr.born
 
@@ -0,0 +1,240 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import os
+import json
+
+from PyQt5.QtCore import QObject, pyqtSlot
+
+from source.Blob import Blob
+from source.Point import Point
+from source.Image import Image
+
+# the journal is compacted (the project is saved entirely) when it contains too many events, or after a number of
+# autosaves (the changes not tracked by the journal, e.g. the correspondences or the labels, are saved in this way)
+COMPACTION_EVENTS = 20000
+COMPACTION_AUTOSAVES = 10
+
+
+def journalFilename(project_filename):
+    filename, _ = os.path.splitext(project_filename)
+    return filename + "_autosave.journal"
+
+def snapshotFilename(project_filename):
+    filename, extension = os.path.splitext(project_filename)
+    return filename + "_autosave" + extension
+
+
+class ProjectJournal(QObject):
+    """
+    Append-only journal (write-ahead log) of the editing of the annotations, used by the autosave.
+    The journal stores the events (regions and points added, removed, updated, classified) that happened after
+    the last time the project has been saved entirely (the base of the journal), one json object per line.
+    Autosaving only appends the new events; from time to time the journal is compacted: the project is saved
+    in a snapshot, which becomes the new base, and the journal restarts.
+    After a crash, the project is recovered by loading the base and replaying the events (see replay()).
+    """
+
+    def __init__(self, project, parent=None):
+        super(ProjectJournal, self).__init__(parent)
+
+        self.project = project
+        self.filename = None
+        self.pending = []           # events not yet written in the journal
+        self.events = 0             # events written since the last compaction
+        self.autosaves = 0          # autosaves since the last compaction
+
+        project.blobAdded[Image, Blob].connect(self.blobAdded)
+        project.blobRemoved[Image, Blob].connect(self.blobRemoved)
+        project.blobUpdated[Image, Blob, Blob].connect(self.blobUpdated)
+        project.blobClassChanged[Image, str, Blob].connect(self.blobClassChanged)
+        project.pointAdded[Image, Point].connect(self.pointAdded)
+        project.pointRemoved[Image, Point].connect(self.pointRemoved)
+        project.pointClassChanged[Image, str, Point].connect(self.pointClassChanged)
+
+    def close(self):
+
+        self.project.blobAdded[Image, Blob].disconnect(self.blobAdded)
+        self.project.blobRemoved[Image, Blob].disconnect(self.blobRemoved)
+        self.project.blobUpdated[Image, Blob, Blob].disconnect(self.blobUpdated)
+        self.project.blobClassChanged[Image, str, Blob].disconnect(self.blobClassChanged)
+        self.project.pointAdded[Image, Point].disconnect(self.pointAdded)
+        self.project.pointRemoved[Image, Point].disconnect(self.pointRemoved)
+        self.project.pointClassChanged[Image, str, Point].disconnect(self.pointClassChanged)
+
+    def start(self, base_filename):
+        """
+        Start a new (empty) journal whose base is the given project file (just saved).
+        """
+        self.filename = journalFilename(self.project.filename)
+        self.pending = []
+        self.events = 0
+        self.autosaves = 0
+
+        header = { "base": os.path.abspath(base_filename), "base_mtime": os.stat(base_filename).st_mtime_ns }
+        with open(self.filename, "w") as f:
+            f.write(json.dumps(header) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        # a snapshot older than the project is useless
+        snapshot = snapshotFilename(self.project.filename)
+        if os.path.abspath(snapshot) != os.path.abspath(base_filename) and os.path.exists(snapshot):
+            os.remove(snapshot)
+
+    def flush(self):
+        """
+        Append the pending events to the journal.
+        """
+        if len(self.pending) == 0 or self.filename is None:
+            return
+
+        with open(self.filename, "a") as f:
+            f.write("".join(self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.events += len(self.pending)
+        self.pending = []
+
+    def compact(self):
+        """
+        Save the whole project in the snapshot file and restart the journal from it.
+        """
+        snapshot = snapshotFilename(self.project.filename)
+        self.project.save(snapshot)
+        self.start(snapshot)
+
+    def autosave(self):
+
+        self.autosaves += 1
+        if self.filename is None or self.events + len(self.pending) > COMPACTION_EVENTS \
+                or self.autosaves >= COMPACTION_AUTOSAVES:
+            self.compact()
+        else:
+            self.flush()
+
+    def append(self, event):
+        self.pending.append(json.dumps(event) + "\n")
+
+    @pyqtSlot(Image, Blob)
+    def blobAdded(self, img, blob):
+        self.append({ "event": "add", "image": img.id, "blob": blob.toDict() })
+
+    @pyqtSlot(Image, Blob)
+    def blobRemoved(self, img, blob):
+        self.append({ "event": "remove", "image": img.id, "id": blob.id })
+
+    @pyqtSlot(Image, Blob, Blob)
+    def blobUpdated(self, img, old_blob, new_blob):
+        self.append({ "event": "update", "image": img.id, "id": old_blob.id, "blob": new_blob.toDict() })
+
+    @pyqtSlot(Image, str, Blob)
+    def blobClassChanged(self, img, old_class_name, blob):
+        self.append({ "event": "class", "image": img.id, "id": blob.id, "class name": blob.class_name })
+
+    @pyqtSlot(Image, Point)
+    def pointAdded(self, img, point):
+        self.append({ "event": "add point", "image": img.id, "point": point.toDict() })
+
+    @pyqtSlot(Image, Point)
+    def pointRemoved(self, img, point):
+        self.append({ "event": "remove point", "image": img.id, "id": point.id })
+
+    @pyqtSlot(Image, str, Point)
+    def pointClassChanged(self, img, old_class_name, point):
+        self.append({ "event": "point class", "image": img.id, "id": point.id, "class name": point.class_name })
+
+
+def recoverableJournal(project_filename):
+    """
+    It returns the base file and the events of the journal of the given project if there is something to recover,
+    (None, None) otherwise.
+    """
+    filename = journalFilename(project_filename)
+    if not os.path.exists(filename):
+        return None, None
+
+    events = []
+    with open(filename, "r") as f:
+        try:
+            header = json.loads(f.readline())
+        except json.JSONDecodeError:
+            return None, None
+
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                # the last event can be truncated by a crash
+                break
+
+    base = header.get("base")
+    if base is None or not os.path.exists(base) or os.stat(base).st_mtime_ns != header.get("base_mtime"):
+        return None, None
+
+    # nothing changed after the project has been saved
+    if len(events) == 0 and os.path.abspath(base) == os.path.abspath(project_filename):
+        return None, None
+
+    return base, events
+
+def replay(project, events):
+    """
+    Apply the events of a journal to the project (loaded from the base of the journal).
+    """
+    images = { image.id: image for image in project.images }
+
+    for event in events:
+
+        img = images.get(event["image"])
+        if img is None:
+            continue
+
+        event_type = event["event"]
+        if event_type == "add":
+            blob = Blob(None, 0, 0, 0)
+            blob.fromDict(event["blob"])
+            project.addBlob(img, blob, notify=False)
+        elif event_type == "remove":
+            blob = img.annotations.blobById(event["id"])
+            if blob is not None:
+                project.removeBlob(img, blob, notify=False)
+        elif event_type == "update":
+            old_blob = img.annotations.blobById(event["id"])
+            if old_blob is not None:
+                blob = Blob(None, 0, 0, 0)
+                blob.fromDict(event["blob"])
+                project.updateBlob(img, old_blob, blob, notify=False)
+        elif event_type == "class":
+            blob = img.annotations.blobById(event["id"])
+            if blob is not None:
+                project.setBlobClass(img, blob, event["class name"], notify=False)
+        elif event_type == "add point":
+            point = Point(0, 0, "Empty", 0)
+            point.fromDict(event["point"])
+            project.addPoint(img, point, notify=False)
+        elif event_type == "remove point":
+            point = img.annotations.pointById(event["id"])
+            if point is not None:
+                project.removePoint(img, point, notify=False)
+        elif event_type == "point class":
+            point = img.annotations.pointById(event["id"])
+            if point is not None:
+                project.setPointClass(img, point, event["class name"], notify=False)
@@ -417,7 +417,7 @@ class QtGeometricInfoWidget(QWidget):
         for blob in self.workingBlobs:
             pxmm = self.activeviewer.px_to_mm
             pxmm2 = pxmm * pxmm
-            blobMeasure = measure.regionprops(blob.getMask())
+            blobMeasure = measure.regionprops(blob.getMask(copy=False))
             self.geometricData[blob.id] = {}
             # base properties
             self.geometricData[blob.id]["class"] = blob.class_name
@@ -443,7 +443,7 @@ class QtGeometricInfoWidget(QWidget):
             self.geometricData[blob.id]["minAxisEllipse"] = round(blobMeasure[0].minor_axis_length * pxmm, self.properties["minAxisEllipse"]["round"])
 
             # minimum rectangle fit
-            contours, _ = cv2.findContours(blob.getMask().astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours, _ = cv2.findContours(blob.getMask(copy=False).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             cnt = contours[0]
             rect = cv2.minAreaRect(cnt)
             if rect[1][1] >= rect[1][0]:  # swap sides and rotate angle to have major side first
@@ -566,7 +566,7 @@ class QtGeometricInfoWidget(QWidget):
         for blob in self.workingBlobs:
             min_row, min_col, _, _ = blob.bbox
             ######################################## RECTANGLE
-            contours, _ = cv2.findContours(blob.getMask().astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours, _ = cv2.findContours(blob.getMask(copy=False).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             rect = cv2.minAreaRect(contours[0])
             if rect[1][1] >= rect[1][0]:  # swap sides and rotate angle to have major side first
                 rect = (rect[0], (rect[1][1], rect[1][0]), rect[2] - 90.0)
@@ -585,7 +585,7 @@ class QtGeometricInfoWidget(QWidget):
     # display fitted ellipses with axes in the viewer
     def displayFittedEllipses(self):
         for blob in self.workingBlobs:
-            blobMeasure = measure.regionprops(blob.getMask())
+            blobMeasure = measure.regionprops(blob.getMask(copy=False))
             region = blobMeasure[0]
             # The centroid is relative to the mask, so offset by bbox
             min_row, min_col, _, _ = blob.bbox
@@ -836,7 +836,7 @@ class QtGeometricInfoWidget(QWidget):
             pen = QPen(Qt.NoPen)
             brush = QBrush(color)
             # draw the blob's filled contour
-            contours, _ = cv2.findContours(blob.getMask().astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours, _ = cv2.findContours(blob.getMask(copy=False).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             cnt = contours[0]
             polygon = QPolygonF([QPointF(float(point[0][0])+min_col+0.5, float(point[0][1])+min_row+0.5) for point in cnt])
             newItemC = self.activeviewer.scene.addPolygon(polygon, pen, brush)
@@ -871,7 +871,7 @@ class QtGeometricInfoWidget(QWidget):
             pen = QPen(Qt.NoPen)
             brush = QBrush(color)
             # draw the blob's filled contour
-            contours, _ = cv2.findContours(blob.getMask().astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours, _ = cv2.findContours(blob.getMask(copy=False).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             cnt = contours[0]
             polygon = QPolygonF([QPointF(float(point[0][0])+min_col+0.5, float(point[0][1])+min_row+0.5) for point in cnt])
             newItemC = self.activeviewer.scene.addPolygon(polygon, pen, brush)
@@ -1,12 +1,50 @@
 import os.path
 from PyQt5.QtCore import Qt, QPointF, QRectF, QFileInfo, QDir, pyqtSlot, pyqtSignal, QT_VERSION_STR
 from PyQt5.QtGui import QImage, QPixmap, QPainter, QPainterPath, QPen, QImageReader, QMouseEvent
-from PyQt5.QtWidgets import QApplication, QGraphicsView, QGraphicsScene, QFileDialog, QGraphicsPixmapItem
+from PyQt5.QtWidgets import QApplication, QGraphicsView, QGraphicsScene, QFileDialog, QGraphicsPixmapItem, QGraphicsItem, \
+    QStyleOptionGraphicsItem
+
+from source.TiledImage import TiledImage
+
+
+class TiledImageItem(QGraphicsItem):
+    """
+    Graphics item that draws a TiledImage. Only the tiles intersecting the exposed area are drawn, at the
+    pyramid level corresponding to the current zoom factor.
+    """
+
+    def __init__(self, tiled_image):
+        QGraphicsItem.__init__(self)
+
+        self.tiled_image = tiled_image
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0.0, 0.0, self.tiled_image.width(), self.tiled_image.height())
+
+    def paint(self, painter, option, widget=None):
+
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.tiled_image.levelForScale(scale)
+
+        exposed = option.exposedRect
+        (tx0, ty0, tx1, ty1) = self.tiled_image.tileRange(level, exposed.left(), exposed.top(),
+                                                          exposed.right(), exposed.bottom())
+
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, level > 0)
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                tile = self.tiled_image.tile(level, tx, ty)
+                if tile is not None:
+                    (left, top, w, h) = self.tiled_image.tileRect(level, tx, ty)
+                    painter.drawImage(QRectF(left, top, w, h), tile)
+
 
 class QtImageViewer(QGraphicsView):
     """
     Basic PyQt image viewer with pan and zoom capabilities.
-    The input image (it must be a QImage) is internally converted into a QPixmap.
+    The input image (a QImage) is internally converted into a QPixmap. Maps too large to fit in memory can be
+    given as a TiledImage, in this case they are drawn by tiles read on demand.
     """
 
     viewUpdated = pyqtSignal(QRectF)                  # region visible in percentage
@@ -32,6 +70,9 @@ class QtImageViewer(QGraphicsView):
         self.pixmapitem.setZValue(0)
         # Don't add to scene yet - will be added when pixmap is set in setImg()
 
+        # item used to draw tiled images (see setImg())
+        self.tiled_item = None
+
         # OVERLAY
         self.scene_overlay = QGraphicsScene()
 
@@ -79,7 +120,7 @@ class QtImageViewer(QGraphicsView):
 
     def setImg(self, img, zoomf=0.0):
         """
-        Set the scene's current image (input image must be a QImage)
+        Set the scene's current image (input image must be a QImage or a TiledImage)
         For calculating the zoom factor automatically set it to 0.0.
         """
 
@@ -87,26 +128,39 @@ class QtImageViewer(QGraphicsView):
         if type(img) is QImage:
             imageARGB32 = img.convertToFormat(QImage.Format_ARGB32)
             self.pixmap = QPixmap.fromImage(imageARGB32)
-            self.thumb = None
-            self.imgwidth = img.width()
-            self.imgheight = img.height()
-            if self.imgheight:
-                self.ZOOM_FACTOR_MIN = min(1.0 * self.width() / self.imgwidth, 1.0 * self.height() / self.imgheight)
+        elif type(img) is TiledImage:
+            # the pixmap stores only an overview of the map (used for the thumbnail)
+            self.pixmap = QPixmap.fromImage(img.overview())
         else:
-            raise RuntimeError("Argument must be a QImage.")
+            raise RuntimeError("Argument must be a QImage or a TiledImage.")
 
-        # Add pixmap item to scene if not already added
-        if self.pixmapitem.scene() is None:
-            self.scene.addItem(self.pixmapitem)
-        
-        self.pixmapitem.setPixmap(self.pixmap)
+        self.thumb = None
+        self.imgwidth = img.width()
+        self.imgheight = img.height()
+        if self.imgheight:
+            self.ZOOM_FACTOR_MIN = min(1.0 * self.width() / self.imgwidth, 1.0 * self.height() / self.imgheight)
+
+        self.removeTiledItem()
+
+        if type(img) is TiledImage:
+            if self.pixmapitem.scene() is not None:
+                self.scene.removeItem(self.pixmapitem)
+            self.tiled_item = TiledImageItem(img)
+            self.tiled_item.setZValue(0)
+            self.scene.addItem(self.tiled_item)
+        else:
+            # Add pixmap item to scene if not already added
+            if self.pixmapitem.scene() is None:
+                self.scene.addItem(self.pixmapitem)
+
+            self.pixmapitem.setPixmap(self.pixmap)
 
         if zoomf < 0.0000001:
 
             # calculate zoom factor
 
             # Set scene size to image size (!)
-            self.setSceneRect(QRectF(self.pixmap.rect()))
+            self.setSceneRect(QRectF(0, 0, self.imgwidth, self.imgheight))
 
             # calculate zoom factor
             pixels_of_border = 10
@@ -148,8 +202,23 @@ class QtImageViewer(QGraphicsView):
         self.scale(self.zoom_factor, self.zoom_factor)
         self.invalidateScene()
 
+    def removeTiledItem(self):
+
+        if self.tiled_item is not None:
+            self.scene.removeItem(self.tiled_item)
+            self.tiled_item = None
+
+    def imageItem(self):
+        """
+        It returns the graphics item used to draw the current image.
+        """
+        if self.tiled_item is not None:
+            return self.tiled_item
+        return self.pixmapitem
+
     def clear(self):
         self.pixmapitem.setPixmap(QPixmap())
+        self.removeTiledItem()
         self.img_map = None
 
     def disableScrollBars(self):
@@ -203,6 +272,10 @@ class QtImageViewer(QGraphicsView):
         if self.overlay_image.width() <= 1:
             return
 
+        # overlays are not supported on tiled images
+        if self.tiled_item is not None:
+            return
+
         pxmap = self.pixmap.copy()
         p = QPainter()
         p.begin(pxmap)
@@ -142,6 +142,10 @@ class QtImageViewerPlus(QtImageViewer):
         self.selected_sampling_area = None
 
         self.taglab_dir = taglab_dir
+
+        # if True the maps are visualized by tiles (maps larger than 32767 pixels are always tiled)
+        self.tiled_viewer = False
+
         self.tools = Tools(self)
         self.tools.createTools()
 
@@ -323,7 +327,7 @@ class QtImageViewerPlus(QtImageViewer):
             img = channel.qimage
         else:
             QApplication.setOverrideCursor(Qt.WaitCursor)
-            img = channel.loadData(self.taglab_dir)
+            img = channel.loadData(self.taglab_dir, tiled=self.tiled_viewer)
             QApplication.restoreOverrideCursor()
 
         if img.isNull():
@@ -334,7 +338,7 @@ class QtImageViewerPlus(QtImageViewer):
             channel.filename = dir.relativeFilePath(filename)
 
             QApplication.setOverrideCursor(Qt.WaitCursor)
-            img = channel.loadData(self.taglab_dir)
+            img = channel.loadData(self.taglab_dir, tiled=self.tiled_viewer)
             QApplication.restoreOverrideCursor()
 
             if img.isNull():
@@ -345,6 +349,13 @@ class QtImageViewerPlus(QtImageViewer):
         else:
             self.setChannelImg(img)
 
+    @pyqtSlot(bool)
+    def setTiledViewer(self, enabled):
+        """
+        Enable/disable the visualization of the maps by tiles. It takes effect when a map is loaded.
+        """
+        self.tiled_viewer = enabled
+
     def setChannelImg(self, channel_img, zoomf=0.0):
         """
         Set the scene's current image (input image must be a QImage)
@@ -494,8 +505,7 @@ class QtImageViewerPlus(QtImageViewer):
         """
         Toggle the visibility of the base image.
         """
-        if self.pixmapitem is not None:
-            self.pixmapitem.setVisible(checked != 0)
+        self.imageItem().setVisible(checked != 0)
 
     def enableFill(self):
 
@@ -1252,13 +1262,10 @@ class QtImageViewerPlus(QtImageViewer):
         ey = max(y,self.dragSelectionStart[1])
         self.resetSelection()
         # select all blobs that are inside the selection rectangle
-        for blob in self.annotations.seg_blobs:
+        for blob in self.annotations.calculate_inner_blobs([sy, sx, ex - sx, ey - sy]):
             visible = self.project.isLabelVisible(blob.class_name)
             if not visible:
                 continue
-            box = blob.bbox
-            if sx > box[1] or sy > box[0] or ex < box[1] + box[2] or ey < box[0] + box[3]:
-                continue
             self.addToSelectedList(blob)
         # select all points that are inside the selection rectangle
         for annpoint in self.annotations.annpoints:
@@ -1443,11 +1450,10 @@ class QtImageViewerPlus(QtImageViewer):
         for blob in self.selected_blobs:
             self.updateBlobQPath(blob, False)
         self.selected_blobs.clear()        
-        for blob in self.image.annotations.seg_blobs:
-            if Mask.checkIntersection(wa, blob.bbox):
-                if blob not in self.selected_blobs:
-                    self.selected_blobs.append(blob)
-                    self.updateBlobQPath(blob, True)
+        for blob in self.image.annotations.calculate_inner_intersecting_blobs(wa):
+            if blob not in self.selected_blobs:
+                self.selected_blobs.append(blob)
+                self.updateBlobQPath(blob, True)
 
         if redraw:
             self.scene.invalidate()
@@ -1900,9 +1906,7 @@ class QtImageViewerPlus(QtImageViewer):
 
             blob = Blob(region, offset[0], offset[1], new_id)
             blob.class_name = class_name
-            # Add to annotations
-            self.image.annotations.seg_blobs.append(blob)
-            # self.drawBlob(blob)
+            # Add to annotations (addBlob also registers the blob in the annotations)
             self.addBlob(blob, selected=False, redraw=False)
             added_blobs.append(blob)
 
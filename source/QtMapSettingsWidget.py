@@ -163,15 +163,6 @@ class QtMapSettingsWidget(QWidget):
             msgBox.exec()
             return
 
-        # TODO: redundat check, remove it ?
-        image_reader = QImageReader(rgb_filename)
-        size = image_reader.size()
-        if size.width() > 32767 or size.height() > 32767:
-            msgBox = QMessageBox()
-            msgBox.setText("The image is too large. TagLab is limited to 32767x32767 pixels.")
-            msgBox.exec()
-            return
-
         self.accepted.emit()
         self.close()
 
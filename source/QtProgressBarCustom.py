@@ -1,6 +1,6 @@
 from PyQt5.QtCore import Qt, QMargins, QRect, QSize, pyqtSlot, pyqtSignal
 from PyQt5.QtGui import QPainter, QBrush, QPixmap, QPen, QColor, QIcon, qRgb, qRed, qGreen, qBlue, QFont
-from PyQt5.QtWidgets import QWidget, QGroupBox, QSizePolicy, QSlider, QLabel, QHBoxLayout, QVBoxLayout
+from PyQt5.QtWidgets import QWidget, QGroupBox, QSizePolicy, QSlider, QLabel, QHBoxLayout, QVBoxLayout, QPushButton
 
 class QtProgressBarCustom(QWidget):
 
@@ -21,8 +21,15 @@ class QtProgressBarCustom(QWidget):
         self.lblBar = QLabel()
         self.lblBar.setPixmap(self.pxmapBar)
 
+        # the cancel button is shown only by the operations that can be canceled (see showCancel)
+        self.btnCancel = QPushButton("Cancel")
+        self.btnCancel.setFixedHeight(self.bar_height)
+        self.btnCancel.clicked.connect(self.cancel)
+        self.btnCancel.hide()
+
         layoutH = QHBoxLayout()
         layoutH.addWidget(self.lblBar)
+        layoutH.addWidget(self.btnCancel)
         layoutH.setContentsMargins(QMargins(0, 0, 0, 0))
         self.setLayout(layoutH)
 
@@ -31,6 +38,20 @@ class QtProgressBarCustom(QWidget):
         self.current_progress = 0.0
         self.message = "Classification"
         self.flag_perc = True
+        self.canceled = False
+
+
+    def showCancel(self):
+
+        self.canceled = False
+        self.btnCancel.show()
+
+
+    @pyqtSlot()
+    def cancel(self):
+
+        self.canceled = True
+        self.btnCancel.setEnabled(False)
 
 
     def showPerc(self):
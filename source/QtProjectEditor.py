@@ -166,7 +166,7 @@ class QtProjectEditor(QWidget):
             self.table.setItem(row, 5, dem_item)
             
             # Annotations count
-            ann_count = len(img.annotations.seg_blobs) + len(img.annotations.annpoints)
+            ann_count = img.annotationsCount()
             total_annotations += ann_count
             ann_item = QTableWidgetItem(str(ann_count))
             ann_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
@@ -28,6 +28,8 @@ class generalSettingsWidget(QWidget):
 
     researchFieldChanged = pyqtSignal(str)
     autosaveInfoChanged = pyqtSignal(int)
+    tiledViewerChanged = pyqtSignal(bool)
+    tileCacheSizeChanged = pyqtSignal(int)
 
     def __init__(self, settings, taglab_dir, parent=None):
         super(generalSettingsWidget, self).__init__(parent)
@@ -59,6 +61,15 @@ class generalSettingsWidget(QWidget):
         self.btn_default_dict.setFixedWidth(20)
         self.btn_default_dict.clicked.connect(self.chooseDict)
 
+        # maps larger than 32767 pixels are always visualized by tiles
+        self.checkbox_tiled_viewer = QCheckBox("Visualize maps by tiles (for very large maps)")
+        self.lbl_tile_cache = QLabel("Tile cache size: ")
+        self.spinbox_tile_cache = QSpinBox()
+        self.spinbox_tile_cache.setRange(64, 16384)
+        self.spinbox_tile_cache.setSingleStep(64)
+        self.spinbox_tile_cache.setValue(512)
+        self.lbl_tile_cache_2 = QLabel(" MB")
+
         layout_H1 = QHBoxLayout()
         layout_H1.addWidget(self.lbl_research_field)
         layout_H1.addWidget(self.combo_research_field)
@@ -76,16 +87,30 @@ class generalSettingsWidget(QWidget):
         layout_H3.addWidget(self.edit_default_dict)
         layout_H3.addWidget(self.btn_default_dict)
 
+        layout_H4 = QHBoxLayout()
+        layout_H4.addWidget(self.checkbox_tiled_viewer)
+        layout_H4.addStretch()
+
+        layout_H5 = QHBoxLayout()
+        layout_H5.addWidget(self.lbl_tile_cache)
+        layout_H5.addWidget(self.spinbox_tile_cache)
+        layout_H5.addWidget(self.lbl_tile_cache_2)
+        layout_H5.addStretch()
+
         layout = QVBoxLayout()
         layout.addLayout(layout_H1)
         layout.addLayout(layout_H2)
         layout.addLayout(layout_H3)
+        layout.addLayout(layout_H4)
+        layout.addLayout(layout_H5)
 
         self.setLayout(layout)
 
         self.combo_research_field.currentTextChanged.connect(self.setResearchField)
         self.checkbox_autosave.stateChanged.connect(self.autosaveChanged)
         self.spinbox_autosave_interval.valueChanged.connect(self.autosaveIntervalChanged)
+        self.checkbox_tiled_viewer.stateChanged.connect(self.tiledViewerStateChanged)
+        self.spinbox_tile_cache.valueChanged.connect(self.tileCacheValueChanged)
 
     @pyqtSlot()
     def chooseDict(self):
@@ -125,6 +150,31 @@ class generalSettingsWidget(QWidget):
 
         self.autosaveInfoChanged.emit(value)
 
+    @pyqtSlot(int)
+    def tiledViewerStateChanged(self, status):
+
+        enabled = self.checkbox_tiled_viewer.isChecked()
+        self.settings.setValue("tiled-viewer", enabled)
+        self.tiledViewerChanged.emit(enabled)
+
+    @pyqtSlot(int)
+    def tileCacheValueChanged(self, value):
+
+        self.settings.setValue("tile-cache-size", value)
+        self.tileCacheSizeChanged.emit(value)
+
+    def setTiledViewer(self, enabled):
+
+        self.checkbox_tiled_viewer.setChecked(enabled)
+        self.settings.setValue("tiled-viewer", enabled)
+        self.tiledViewerChanged.emit(enabled)
+
+    def setTileCacheSize(self, size_mb):
+
+        self.spinbox_tile_cache.setValue(size_mb)
+        self.settings.setValue("tile-cache-size", size_mb)
+        self.tileCacheSizeChanged.emit(size_mb)
+
     def setResearchField(self, field):
 
         if field == "Marine Ecology":
@@ -526,6 +576,8 @@ class QtSettingsWidget(QWidget):
         self.autosave_interval = self.settings.value("autosave", defaultValue=0, type=int)
         self.research_field = self.settings.value("research-field", defaultValue="Marine Ecology/Biology", type=str)
         self.default_dictionary = self.settings.value("default-dictionary", defaultValue="dictionaries/scripps.json", type=str)
+        self.tiled_viewer = self.settings.value("tiled-viewer", defaultValue=False, type=bool)
+        self.tile_cache_size = self.settings.value("tile-cache-size", defaultValue=512, type=int)
 
         self.selection_pen_color = self.settings.value("selection-pen-color", defaultValue="255-255-255", type=str)
         self.selection_pen_width = self.settings.value("selection-pen-width", defaultValue=2, type=int)
@@ -537,6 +589,8 @@ class QtSettingsWidget(QWidget):
 
         self.general_settings.setResearchField(self.research_field)
         self.general_settings.setAutosaveInterval(self.autosave_interval)
+        self.general_settings.setTiledViewer(self.tiled_viewer)
+        self.general_settings.setTileCacheSize(self.tile_cache_size)
 
         self.drawing_settings.setBorderColor(self.border_pen_color)
         self.drawing_settings.setBorderWidth(self.border_pen_width)
@@ -87,6 +87,10 @@ class QtTYNWidget(QWidget):
         self.lblBS.setFixedWidth(TEXT_SPACE)
         self.lblBS.setAlignment(Qt.AlignRight)
 
+        self.lblWorkers = QLabel("Data Loading Workers: ")
+        self.lblWorkers.setFixedWidth(TEXT_SPACE)
+        self.lblWorkers.setAlignment(Qt.AlignRight)
+
         self.lblTotalBackground = QLabel("Cumulative background: ")
         self.lblTotalBackground.setStyleSheet("QLabel { background-color : rgb(40,40,40); color : white; }")
         self.lblTotalBackgroundValue = QLabel("")
@@ -140,6 +144,11 @@ class QtTYNWidget(QWidget):
         self.editBatchSize.setStyleSheet("background-color: rgb(55,55,55); border: 1px solid rgb(90,90,90)")
         self.editBatchSize.setReadOnly(False)
         self.editBatchSize.setMinimumWidth(LINEWIDTH)
+        self.editWorkers = QLineEdit(str(training.DATALOADER_WORKERS))
+        self.editWorkers.setStyleSheet("background-color: rgb(55,55,55); border: 1px solid rgb(90,90,90)")
+        self.editWorkers.setReadOnly(False)
+        self.editWorkers.setMinimumWidth(LINEWIDTH)
+        self.editWorkers.setToolTip("Number of processes that load the tiles during the training (0 loads them in the main process).")
 
 
         self.comboTraining = QComboBox()
@@ -210,6 +219,10 @@ class QtTYNWidget(QWidget):
         layoutH7.addWidget(self.lblBS)
         layoutH7.addWidget(self.editBatchSize)
 
+        layoutH8 = QHBoxLayout()
+        layoutH8.addWidget(self.lblWorkers)
+        layoutH8.addWidget(self.editWorkers)
+
         self.layoutInputs = QVBoxLayout()
         self.layoutInputs.addLayout(layoutH1)
         self.layoutInputs.addLayout(layoutH2)
@@ -221,6 +234,7 @@ class QtTYNWidget(QWidget):
         self.layoutInputs.addLayout(layoutLR)
         self.layoutInputs.addLayout(layoutH6)
         self.layoutInputs.addLayout(layoutH7)
+        self.layoutInputs.addLayout(layoutH8)
 
 
         ##### Main layout
@@ -394,6 +408,10 @@ class QtTYNWidget(QWidget):
 
         return int(self.editBatchSize.text())
 
+    def getWorkers(self):
+
+        return int(self.editWorkers.text())
+
     def getTargetClasses(self):
 
         target_classes = self.target_classes.copy()
@@ -521,6 +539,13 @@ class QtTYNWidget(QWidget):
             msgBox.exec()
             return
 
+        if self.getWorkers() < 0:
+            msgBox = QMessageBox()
+            msgBox.setWindowTitle(self.TAGLAB_VERSION)
+            msgBox.setText("The number of data loading workers cannot be negative.")
+            msgBox.exec()
+            return
+
         self.launchTraining.emit()
 
     def analyzeDataset(self):
@@ -1,4 +1,6 @@
 
+import os
+import struct
 import numpy as np
 import json
 import math
@@ -10,12 +12,21 @@ from rasterio.plot import reshape_as_raster
 from rasterio.mask import mask
 from rasterio.control import GroundControlPoint
 from rasterio.transform import from_origin, from_gcps
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from rasterio.enums import Resampling
 import pandas as pd
-from source.Blob import Blob
+from source.Blob import Blob, blobsFromPolygons, IMPORT_CHUNK_SIZE
 from source.Shape import Shape
-from source.Mask import subtract
+from source import genutils
 from shapely.geometry import Polygon
 
+# the blobs of the polygons of a shapefile are created by a pool of worker processes when the polygons are many
+IMPORT_PARALLEL_POLYGONS = 1000
+
+# size of the tiles (blocks) of the exported GeoTIFFs, they are painted and written one at a time
+GEOTIFF_TILE_SIZE = 512
+
 
 def mm_to_degrees(mm_pixel_size, center_lat):
     """
@@ -295,61 +306,91 @@ def createPolygonFromWorkingArea(working_area, transform):
 
 
 def read_attributes(filename):
+    """
+    It reads the attributes of the features of a shapefile, column by column.
+    """
     driver = ogr.GetDriverByName("ESRI Shapefile")
     dataSource = driver.Open(filename, 0)
     layer = dataSource.GetLayer(0)
-    data = pd.DataFrame()
+
+    definition = layer.GetLayerDefn()
+    names = [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+    columns = [[] for name in names]
     for feat in layer:
-        shpdict =json.loads(feat.ExportToJson())
-        properties = shpdict['properties']
-        if data.empty:
-            data = pd.DataFrame.from_dict([properties])
-        else:
-            new_row = pd.DataFrame.from_dict([properties])
-            data = pd.concat([data, new_row])
+        for i, column in enumerate(columns):
+            column.append(feat.GetField(i))
+
+    if len(columns) == 0 or len(columns[0]) == 0:
+        return pd.DataFrame()
+
+    # missing values are kept as None (not converted to NaN)
+    data = pd.DataFrame({name: pd.Series(column, dtype=object) if None in column else column
+                         for name, column in zip(names, columns)}, columns=names)
     return data
 
 
-def read_regions_geometry(filename, georef_filename):
+def read_polygons(layer, reproject, transform):
+    """
+    It returns the polygons of the layer as a list of (outer ring, inner rings, valid), with the rings in pixel
+    coordinates. The coordinates of all the polygons are reprojected and converted in a single batch.
+    """
+    points = []
+    offsets = [0]      # the rings are slices of the points
+    polygons = []      # (first ring, number of rings, valid)
+    for feat in layer:
+        geom = feat.GetGeometryRef()
+        if geom is None or geom.GetGeometryName() != 'POLYGON':
+            continue
 
-    img = rio.open(georef_filename)
-    transform = img.transform
+        first = len(offsets) - 1
+        for i in range(geom.GetGeometryCount()):
+            points.extend(geom.GetGeometryRef(i).GetPoints(2) or [])
+            offsets.append(len(points))
+        polygons.append((first, geom.GetGeometryCount(), geom.IsValid()))
+
+    if len(points) == 0:
+        return []
+
+    if reproject is not None:
+        points = reproject.TransformPoints(points)
+
+    coords = np.asarray(points, dtype=float)[:, :2]
+
+    # map -> pixel coordinates
+    inv = ~transform
+    pixels = np.empty_like(coords)
+    pixels[:, 0] = inv.a * coords[:, 0] + inv.b * coords[:, 1] + inv.c
+    pixels[:, 1] = inv.d * coords[:, 0] + inv.e * coords[:, 1] + inv.f
+
+    rings = np.split(pixels, offsets[1:-1])
+    return [(rings[first], rings[first + 1:first + count], valid) for first, count, valid in polygons]
+
+
+def read_regions_geometry(filename, georef_filename, workers=None):
+    """
+    It creates the blobs of the polygons of a shapefile (the other geometries are skipped). The polygons are
+    reprojected in the reference system of the georeferenced map, and their blobs are created by a pool of
+    worker processes (workers=None means one for each CPU) when they are many.
+    """
+    with rio.open(georef_filename) as img:
+        transform = img.transform
+        crs_wkt = img.crs.wkt
 
     driver = ogr.GetDriverByName("ESRI Shapefile")
     dataSource = driver.Open(filename, 0)
     layer = dataSource.GetLayer(0)
 
-
     #set spatial reference and transformation
     sourceprj = layer.GetSpatialRef()
-    targetprj = osr.SpatialReference(wkt = img.crs.wkt)
-    #need to check if sourceproj == targetproj
-    reproject = osr.CoordinateTransformation(sourceprj, targetprj) #this is a transform
+    targetprj = osr.SpatialReference(wkt = crs_wkt)
+    reproject = None
+    if sourceprj is not None and not sourceprj.IsSame(targetprj):
+        reproject = osr.CoordinateTransformation(sourceprj, targetprj) #this is a transform
 
-    blobList = []
-    for feat in layer:
-        transformed = feat.GetGeometryRef()
-        transformed.Transform(reproject)
+    polygons = read_polygons(layer, reproject, transform)
 
-        shpdict = json.loads(feat.ExportToJson())
-        if shpdict['geometry']['type'] == 'Polygon':
-            blob = Blob(None, 0, 0, 0)
-            coord = shpdict['geometry']['coordinates']
-            outercontour = coord[0]
-            outpointpixels = changeFormatInv([outercontour], transform)
-            blob.createFromClosedCurve([np.asarray(outpointpixels)], False)
-            for i in range(1, len(coord)):
-                innercontourn_i = coord[i]
-                innerpointpixels_i = changeFormatInv([innercontourn_i], transform)
-                innerblob = Blob(None, 0, 0, 0)
-                innerblob.createFromClosedCurve([np.asarray(innerpointpixels_i)], False)
-                # FIXME: prevents problem if the innerblob size is less than one pixel, but it is not clear
-                #  when it happens
-                if innerblob.bbox[2] > 0.9 and innerblob.bbox[3] > 0.9:
-                    (mask, box) = subtract(blob.getMask(), blob.bbox, innerblob.getMask(), innerblob.bbox)
-                    if mask.any():
-                        blob.updateUsingMask(box, mask.astype(int))
-            blobList.append(blob)
+    results = genutils.parallelMap(blobsFromPolygons, polygons, IMPORT_CHUNK_SIZE, IMPORT_PARALLEL_POLYGONS, workers)
+    blobList = [blob for blobs in results for blob in blobs]
 
     return blobList
 
@@ -392,16 +433,52 @@ def read_geometry(filename, georef_filename):
 
 
 
+def ringToMap(contour, transform):
+    """
+    It converts a ring (pixel coordinates) in map coordinates, closing it if necessary.
+    """
+    points = np.asarray(contour, dtype=float)
+    if points.shape[0] > 0 and np.any(points[0] != points[-1]):
+        points = np.vstack([points, points[:1]])
+
+    if transform is None:
+        return points
+
+    coords = np.empty_like(points)
+    coords[:, 0] = transform.a * points[:, 0] + transform.b * points[:, 1] + transform.c
+    coords[:, 1] = transform.d * points[:, 0] + transform.e * points[:, 1] + transform.f
+    return coords
+
+
+def polygonToWkb(blob, transform):
+    """
+    It returns the polygon of the blob (contour and holes) in map coordinates as WKB, without building a
+    shapely Polygon (see createPolygon).
+    """
+    rings = [ringToMap(blob.contour, transform)] + [ringToMap(inner, transform) for inner in blob.inner_contours]
+
+    # little endian, wkbPolygon, number of rings, then the points of each ring
+    wkb = [struct.pack('<BII', 1, 3, len(rings))]
+    for ring in rings:
+        wkb.append(struct.pack('<I', ring.shape[0]))
+        wkb.append(ring.astype('<f8').tobytes())
+
+    return b''.join(wkb)
+
+
 def write_shapefile(project, image, blobs, georef_filename, out_shp):
     """
+    Export the visible regions (in the working area, if any) as a georeferenced shapefile or, if the
+    output file has the .gpkg extension, as a GeoPackage (which has no limit on the length of the field names).
+    The attributes and the geometries are built in bulk and the features are written in a single transaction.
     https://gis.stackexchange.com/a/52708/8104
     """
     scale_factor = image.pixelSize()
     date = image.acquisition_date
     # load georeference information to use
-    img = rio.open(georef_filename)
-    geoinfo = img.crs
-    transform = img.transform
+    with rio.open(georef_filename) as img:
+        geoinfo = img.crs
+        transform = img.transform
     annotations = image.annotations
 
     working_area = project.working_area
@@ -410,104 +487,51 @@ def write_shapefile(project, image, blobs, georef_filename, out_shp):
         # only the blobs inside the working area are considered
         blobs = annotations.calculate_inner_blobs(working_area)
 
-
     # create the list of visible instances
-    name_list = []
-    visible_blobs = []
-    for blob in blobs:
-        if blob.qpath_gitem.isVisible():
-            index = blob.blob_name
-            name_list.append(index)
-            visible_blobs.append(blob)
+    visible_blobs = [blob for blob in blobs if blob.qpath_gitem.isVisible()]
 
     # SHAPEFILE NAMES CANNOT BE LONGER THAN 10 characters
 
-    number_of_seg = len(name_list)
+    number_of_seg = len(visible_blobs)
     dict = {
-        'TL_id': np.zeros(number_of_seg, dtype = np.int64),
-        'TL_Date': [],
-        'TL_Class': [],
-        'TL_Genet': np.zeros(number_of_seg, dtype = np.int64),
-        'TL_Cx': np.zeros(number_of_seg),
-        'TL_Cy': np.zeros(number_of_seg),
-        'TL_Area': np.zeros(number_of_seg),
-        'TL_SurfA': np.zeros(number_of_seg),
-        'TL_Perim': np.zeros(number_of_seg),
-        'TL_Note': []}
+        'TL_id': np.array([blob.id for blob in visible_blobs], dtype=np.int64),
+        'TL_Date': [date] * number_of_seg,
+        'TL_Class': [blob.class_name for blob in visible_blobs],
+        'TL_Genet': np.array([blob.genet if blob.genet is not None else 0 for blob in visible_blobs], dtype=np.int64),
+        'TL_Cx': np.array([round(blob.centroid[0], 1) for blob in visible_blobs], dtype=np.float64),
+        'TL_Cy': np.array([round(blob.centroid[1], 1) for blob in visible_blobs], dtype=np.float64),
+        'TL_Area': np.array([round(blob.area * (scale_factor) * (scale_factor) / 100, 2) for blob in visible_blobs], dtype=np.float64),
+        'TL_SurfA': np.array([round(blob.surface_area * (scale_factor) * (scale_factor) / 100, 2) if blob.surface_area > 0.0 else 0.0
+                              for blob in visible_blobs], dtype=np.float64),
+        'TL_Perim': np.array([round(blob.perimeter * scale_factor / 10, 1) for blob in visible_blobs], dtype=np.float64),
+        'TL_Note': [blob.note for blob in visible_blobs]}
 
     for attribute in project.region_attributes.data:
         key = attribute["name"]
+        values = [blob.data.get(key) for blob in visible_blobs]
         if attribute['type'] in ['string', 'keyword']:
-            dict[key] = []
-        elif attribute['type'] in ['integer number', 'boolean']:
-            dict[key] = np.zeros(number_of_seg, dtype = np.int64)
+            dict[key] = [value if value is not None else '' for value in values]
+        elif attribute['type'] == 'integer number':
+            dict[key] = np.array([value if value is not None else 0 for value in values], dtype=np.int64)
+        elif attribute['type'] == 'boolean':
+            dict[key] = np.array([(1 if value else 0) if value is not None else 0 for value in values], dtype=np.int64)
         elif attribute['type'] in ['decimal number']:
-            dict[key] = np.zeros(number_of_seg, dtype = np.float64)
+            dict[key] = np.array([value if value is not None else np.nan for value in values], dtype=np.float64)
         else:
             # unknown attribute type, not saved
             pass
 
-    for i, blob in enumerate(visible_blobs):
-        dict['TL_id'][i] = blob.id
-        dict['TL_Date'].append(date)
-        dict['TL_Class'].append(blob.class_name)
-        dict['TL_Cx'][i] = round(blob.centroid[0], 1)
-        dict['TL_Cy'][i] = round(blob.centroid[1], 1)
-        dict['TL_Area'][i] = round(blob.area * (scale_factor) * (scale_factor) / 100, 2)
-        if blob.surface_area > 0.0:
-            dict['TL_SurfA'][i] = round(blob.surface_area * (scale_factor) * (scale_factor) / 100, 2)
-        dict['TL_Perim'][i] = round(blob.perimeter * scale_factor / 10, 1)
-
-        if blob.genet is not None:
-            dict['TL_Genet'][i] = blob.genet
-
-        dict['TL_Note'].append(blob.note)
-
-        for attribute in project.region_attributes.data:
-
-            key = attribute["name"]
-
-            try:
-                value = blob.data[key]
-            except:
-                value = None
-
-            if attribute['type'] == 'integer number':
+    # convert blobs in polygons (WKB)
+    geometries = [polygonToWkb(blob, transform) for blob in visible_blobs]
 
-                if value is not None:
-                    dict[key][i] = value
-                else:
-                    dict[key][i] = 0
-
-            elif attribute['type'] == 'boolean':
-
-                if value is not None:
-                    dict[key][i] = 1 if value else 0
-                else:
-                    dict[key][i] = 0
-
-            elif attribute['type'] == 'decimal number':
-
-                if value is not None:
-                    dict[key][i] = value
-                else:
-                    dict[key][i] = np.NaN
-
-            else:
-                if value is not None:
-                    dict[key].append(value)
-                else:
-                    dict[key].append('')
-
-    # # convert blobs in polygons
-    polygons = []
-    for blob in visible_blobs:
-        if blob.qpath_gitem.isVisible():
-            polygon = createPolygon(blob, transform)
-            polygons.append(polygon)
+    # Now convert them to a shapefile (or a GeoPackage) with OGR
+    if os.path.splitext(out_shp)[1].lower() == ".gpkg":
+        outDriver = ogr.GetDriverByName('GPKG')
+    else:
+        outDriver = ogr.GetDriverByName('Esri Shapefile')
 
-    # Now convert them to a shapefile with OGR
-    outDriver = ogr.GetDriverByName('Esri Shapefile')
+    if os.path.exists(out_shp):
+        outDriver.DeleteDataSource(out_shp)
     outDataSource = outDriver.CreateDataSource(out_shp)
     srs = osr.SpatialReference()
     if geoinfo is not None:
@@ -516,10 +540,9 @@ def write_shapefile(project, image, blobs, georef_filename, out_shp):
     # create a layer
     outLayer = outDataSource.CreateLayer("polygon", srs, geom_type=ogr.wkbPolygon)
     OGRTypes = {int: ogr.OFTInteger, str: ogr.OFTString, float: ogr.OFTReal}
-    defn = outLayer.GetLayerDefn()
-    # Create attribute fields according to the data types
-
 
+    # Create attribute fields according to the data types, the values are converted to Python types in bulk
+    columns = []
     for key in list(dict.keys()):
 
             if type(dict[key]) == list:
@@ -529,27 +552,22 @@ def write_shapefile(project, image, blobs, georef_filename, out_shp):
             else:
                 outLayer.CreateField(ogr.FieldDefn(key, OGRTypes[float]))
 
-    for i in range(len(polygons)):
-        feat = ogr.Feature(defn)
-        geom = ogr.CreateGeometryFromWkb(polygons[i].wkb)
-        feat.SetGeometry(geom)
-
-        for key in list(dict.keys()):
-            if type(dict[key]) == list:
-                feat.SetField(key, dict[key][i])
-
-            elif dict[key].dtype == np.int64 or dict[key].dtype == np.int32:
-                feat.SetField(key, int(dict[key][i]))
+            columns.append(dict[key] if type(dict[key]) == list else dict[key].tolist())
 
-            else:
-                feat.SetField(key, float(dict[key][i]))
+    defn = outLayer.GetLayerDefn()
+    fields = range(len(columns))
 
-        # Make a geometry, from Shapely object
+    outLayer.StartTransaction()
+    for i in range(number_of_seg):
+        feat = ogr.Feature(defn)
+        feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(geometries[i]))
+        for field in fields:
+            feat.SetField(field, columns[field][i])
         outLayer.CreateFeature(feat)
-        feat = geom = None  # destroy these
+    outLayer.CommitTransaction()
 
     # Save and close everything
-    ds = layer = feat = geom = None
+    outDataSource = outLayer = feat = None
 
 def load_georef(image):
     # load georeference information to use
@@ -585,40 +603,92 @@ def saveClippedTiff(input, blobs, georef_filename, name):
     with rio.open(name, "w", **out_meta) as dest:
         dest.write(out_image)
 
-def saveGeorefLabelMap(label_map, georef_filename, working_area, out_name):
+def georefWindow(width, height, working_area):
+    """
+    It returns the window (rasterio) of the map to export: the working area (if any) inside the map.
+    """
+    if working_area is None:
+        return Window(0, 0, width, height)
 
-    ## TO DO: CLEAN UP THIS FUNCTION!
+    top, left, w, h = [int(v) for v in working_area]
+    col_off = min(max(left, 0), width)
+    row_off = min(max(top, 0), height)
+    return Window(col_off, row_off, min(left + w, width) - col_off, min(top + h, height) - row_off)
 
-    # create a georeferenced label image (as raster)
-    img = rio.open(georef_filename)
-    meta = img.meta
-    transform = img.transform
-    crs = img.crs
 
-    myLabel = reshape_as_raster(label_map)
-    myLabel_meta = meta.copy()
-    myLabel_meta.update({"dtype": rio.uint8,
-                         "count": 3,
-                         "nodata": None})
-    with rio.open(out_name + ".tif", "w", **myLabel_meta) as dest:
-        dest.write(myLabel)
+def georefProfile(width, height, crs, transform, count):
+    """
+    Profile of the exported GeoTIFFs: tiled, compressed (lossless), with the overviews built after writing.
+    """
+    profile = {"driver": "GTiff", "dtype": rio.uint8, "count": count, "nodata": None,
+               "width": width, "height": height, "crs": crs, "transform": transform,
+               "compress": "deflate", "predictor": 2, "BIGTIFF": "IF_SAFER"}
 
-    if working_area is not None:
+    # small images are not tiled (the tiles must be multiple of 16)
+    if width >= GEOTIFF_TILE_SIZE and height >= GEOTIFF_TILE_SIZE:
+        profile.update({"tiled": True, "blockxsize": GEOTIFF_TILE_SIZE, "blockysize": GEOTIFF_TILE_SIZE})
+
+    return profile
+
+
+def buildOverviews(dest):
 
-        dataset = rio.open(out_name + ".tif")
-        # convert the working area into a polygon
-        working_area_polygon = createPolygonFromWorkingArea(working_area, transform)
-        # crop the raster using the working area polygon
-        out_image, out_transform = rio.mask.mask(dataset, [working_area_polygon], crop=True)
-        out_meta = dataset.meta.copy()
-        out_meta.update({"driver": "GTiff",
-                          "height": out_image.shape[1],
-                          "width": out_image.shape[2],
-                          "transform": out_transform})
-        dataset.close()
-
-        with rio.open(out_name + ".tif", "w", **out_meta) as dest:
-            dest.write(out_image)
+    factors = []
+    factor = 2
+    while max(dest.width, dest.height) / factor >= GEOTIFF_TILE_SIZE // 2:
+        factors.append(factor)
+        factor *= 2
+
+    if len(factors) > 0:
+        dest.build_overviews(factors, Resampling.nearest)
+        dest.update_tags(ns='rio_overview', resampling='nearest')
+
+
+def saveGeorefLabelMap(label_map, georef_filename, working_area, out_name):
+    """
+    Save an image (an array of the size of the map) as a georeferenced GeoTIFF cropped to the working area.
+    """
+    with rio.open(georef_filename) as img:
+        transform = img.transform
+        crs = img.crs
+
+    window = georefWindow(label_map.shape[1], label_map.shape[0], working_area)
+    cropped = label_map[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width]
+
+    profile = georefProfile(window.width, window.height, crs, window_transform(window, transform), 3)
+    with rio.open(out_name + ".tif", "w", **profile) as dest:
+        dest.write(reshape_as_raster(cropped[:, :, :3]))
+        buildOverviews(dest)
+
+
+def writeGeorefLabelMap(annotations, size, labels_dictionary, georef_filename, working_area, out_name, progress=None):
+    """
+    Save the label map of the annotations as a georeferenced GeoTIFF (tiled, compressed, with overviews)
+    cropped to the working area. The label map is painted from the regions and written one tile at a time (see
+    Annotation.render_label_window), so the memory used does not depend on the size of the map.
+    """
+    with rio.open(georef_filename) as img:
+        transform = img.transform
+        crs = img.crs
+
+    window = georefWindow(size.width(), size.height(), working_area)
+    profile = georefProfile(window.width, window.height, crs, window_transform(window, transform), 3)
+
+    order = annotations.label_map_order()
+    tiles = [(row, col) for row in range(0, window.height, GEOTIFF_TILE_SIZE)
+                        for col in range(0, window.width, GEOTIFF_TILE_SIZE)]
+
+    with rio.open(out_name + ".tif", "w", **profile) as dest:
+        for i, (row, col) in enumerate(tiles):
+            h = min(GEOTIFF_TILE_SIZE, window.height - row)
+            w = min(GEOTIFF_TILE_SIZE, window.width - col)
+            tile = annotations.render_label_window([window.row_off + row, window.col_off + col, w, h], size,
+                                                   labels_dictionary, order)
+            dest.write(reshape_as_raster(tile[:, :, :3]), window=Window(col, row, w, h))
+            if progress is not None:
+                progress(100.0 * (i + 1) / len(tiles))
+
+        buildOverviews(dest)
 
 
 def exportSlope(raster, filename):
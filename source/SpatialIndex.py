@@ -0,0 +1,137 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import math
+
+
+class SpatialIndex(object):
+    """
+    Uniform grid over the bounding boxes of the regions, used to speed up the spatial queries (click,
+    selection rectangle, working area). Each item is registered in all the cells covered by its bbox.
+    Bounding boxes follow the TagLab convention [top, left, width, height].
+
+    The queries return a superset of the items touching the given area (the caller applies the exact test),
+    in the same order the items have been inserted.
+    """
+
+    def __init__(self, cell_size=512):
+
+        self.cell_size = cell_size
+        self.cells = {}        # (cx, cy) -> {id(item): item}
+        self.entries = {}      # id(item) -> (item, cell range, insertion order)
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cellRange(self, bbox):
+
+        cs = self.cell_size
+        top, left, width, height = bbox[0], bbox[1], bbox[2], bbox[3]
+        cx0 = int(math.floor(left / cs))
+        cy0 = int(math.floor(top / cs))
+        cx1 = int(math.floor((left + max(width, 0)) / cs))
+        cy1 = int(math.floor((top + max(height, 0)) / cs))
+        return (cx0, cy0, cx1, cy1)
+
+    def insert(self, item, bbox):
+
+        key = id(item)
+        if key in self.entries:
+            self.remove(item)
+
+        cell_range = self.cellRange(bbox)
+        (cx0, cy0, cx1, cy1) = cell_range
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                self.cells.setdefault((cx, cy), {})[key] = item
+
+        self.entries[key] = (item, cell_range, self.counter)
+        self.counter += 1
+
+    def remove(self, item):
+        """
+        Remove the item. The cells are the ones computed at insertion, so the item is removed correctly
+        even if its bbox has been modified in the meantime.
+        """
+        key = id(item)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+
+        (cx0, cy0, cx1, cy1) = entry[1]
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is not None:
+                    cell.pop(key, None)
+                    if len(cell) == 0:
+                        del self.cells[(cx, cy)]
+        return True
+
+    def update(self, item, bbox):
+        """
+        Re-register an item whose bbox has changed.
+        """
+        self.remove(item)
+        self.insert(item, bbox)
+
+    def clear(self):
+
+        self.cells.clear()
+        self.entries.clear()
+        self.counter = 0
+
+    def query(self, bbox):
+        """
+        It returns the items registered in the cells covered by the given bbox.
+        """
+        (cx0, cy0, cx1, cy1) = self.cellRange(bbox)
+
+        found = {}
+        ncells = (cx1 - cx0 + 1) * (cy1 - cy0 + 1)
+        if ncells > len(self.cells):
+            # large area: visiting the non-empty cells is cheaper
+            for (cx, cy), cell in self.cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    found.update(cell)
+        else:
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    cell = self.cells.get((cx, cy))
+                    if cell is not None:
+                        found.update(cell)
+
+        return self.sorted(found)
+
+    def queryPoint(self, x, y):
+        """
+        It returns the items registered in the cell containing the given point.
+        """
+        cell = self.cells.get((int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))))
+        if cell is None:
+            return []
+
+        return self.sorted(cell)
+
+    def sorted(self, items):
+
+        entries = self.entries
+        keys = sorted(items.keys(), key=lambda key: entries[key][2])
+        return [items[key] for key in keys]
@@ -0,0 +1,320 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2020
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+from PyQt5.QtCore import QSize, QRect
+from PyQt5.QtGui import QImage
+
+from source import genutils
+
+# QImage (and QPixmap) cannot exceed this size, larger maps must be visualized by tiles
+MAX_QIMAGE_SIZE = 32767
+
+
+class TileCache(object):
+    """
+    LRU cache of decoded tiles with a memory budget (in bytes).
+    The cache is shared among all the tiled images, so the budget is global.
+    """
+
+    def __init__(self, budget=512 * 1024 * 1024):
+
+        self.budget = budget
+        self.used = 0
+        self.tiles = OrderedDict()    # key -> (QImage, size in bytes)
+
+    def get(self, key):
+
+        item = self.tiles.get(key)
+        if item is None:
+            return None
+
+        self.tiles.move_to_end(key)
+        return item[0]
+
+    def put(self, key, qimage):
+
+        if key in self.tiles:
+            self.used -= self.tiles[key][1]
+            del self.tiles[key]
+
+        nbytes = qimage.sizeInBytes()
+        self.tiles[key] = (qimage, nbytes)
+        self.used += nbytes
+
+        # evict the least recently used tiles
+        while self.used > self.budget and len(self.tiles) > 1:
+            _, (_, size) = self.tiles.popitem(last=False)
+            self.used -= size
+
+    def setBudget(self, budget):
+
+        self.budget = budget
+        while self.used > self.budget and len(self.tiles) > 0:
+            _, (_, size) = self.tiles.popitem(last=False)
+            self.used -= size
+
+    def removeImage(self, image_key):
+        """
+        Remove all the tiles of the given image.
+        """
+        keys = [key for key in self.tiles.keys() if key[0] == image_key]
+        for key in keys:
+            self.used -= self.tiles[key][1]
+            del self.tiles[key]
+
+    def clear(self):
+
+        self.tiles.clear()
+        self.used = 0
+
+
+tile_cache = TileCache()
+
+
+class TiledImage(object):
+    """
+    Pyramid-backed access to a (possibly huge) map stored as a GeoTIFF (or any raster readable by rasterio).
+    The map is never loaded entirely: tiles are read lazily through rasterio windows, at the level of the
+    pyramid required by the current zoom, and cached in a LRU tile cache.
+    Level 0 is the full resolution, level k is downsampled by a factor 2^k.
+
+    The class exposes the subset of the QImage interface used by TagLab (width(), height(), size(), copy(), isNull())
+    so a TiledImage can be used in place of the map QImage.
+
+    An optional display version of the map (e.g. the entry of the overviews cache, which is lossy and stores the
+    DEM already shaded) can be given: it is used only to draw the map (tile() and overview()), the data returned
+    by read() and copy() always come from the original file.
+    """
+
+    TILE_SIZE = 512
+
+    def __init__(self, filename, type="RGB", nodata=None, cache=None, display_filename=None):
+
+        self.filename = filename
+        self.type = type                     # RGB | DEM
+        self.cache = tile_cache if cache is None else cache
+
+        self.dataset = rio.open(filename)
+        self.nodata = nodata if nodata is not None else self.dataset.nodata
+        self.w = self.dataset.width
+        self.h = self.dataset.height
+        self.bands = self.dataset.count
+        self.display_dataset = rio.open(display_filename) if display_filename is not None else None
+
+        # number of levels needed to have the whole map inside a single tile
+        side = max(self.w, self.h)
+        self.levels = max(1, int(math.ceil(math.log2(max(side / self.TILE_SIZE, 1.0)))) + 1)
+
+        # depth range used to map the DEM values to gray levels (computed on the coarsest level when needed)
+        self.value_range = None
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def size(self):
+        return QSize(self.w, self.h)
+
+    def rect(self):
+        return QRect(0, 0, self.w, self.h)
+
+    def isNull(self):
+        return self.w == 0 or self.h == 0
+
+    def close(self):
+
+        self.cache.removeImage(self.filename)
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+        if self.display_dataset is not None:
+            self.display_dataset.close()
+            self.display_dataset = None
+
+    def levelForScale(self, scale):
+        """
+        It returns the pyramid level to use when the map is drawn with the given scale (screen pixels per map pixel).
+        """
+        if scale <= 0.0:
+            return self.levels - 1
+
+        level = int(math.floor(math.log2(1.0 / scale))) if scale < 1.0 else 0
+        return min(max(level, 0), self.levels - 1)
+
+    def tileSpan(self, level):
+        """
+        Size (in full resolution pixels) of the area covered by a tile at the given level.
+        """
+        return self.TILE_SIZE << level
+
+    def tileRange(self, level, left, top, right, bottom):
+        """
+        It returns the range of the tiles (tx0, ty0, tx1, ty1), inclusive, covering the given area (in map pixels).
+        """
+        span = self.tileSpan(level)
+        left = max(0, left)
+        top = max(0, top)
+        right = min(self.w - 1, right)
+        bottom = min(self.h - 1, bottom)
+
+        return (int(left // span), int(top // span), int(right // span), int(bottom // span))
+
+    def tileRect(self, level, tx, ty):
+        """
+        Area (left, top, width, height) covered by the tile in full resolution pixels.
+        """
+        span = self.tileSpan(level)
+        left = tx * span
+        top = ty * span
+        w = min(span, self.w - left)
+        h = min(span, self.h - top)
+        return (left, top, w, h)
+
+    def tile(self, level, tx, ty):
+        """
+        It returns the tile (as a QImage) at the given level. The tile is read and cached if necessary.
+        """
+        key = (self.filename, level, tx, ty)
+        qimg = self.cache.get(key)
+        if qimg is not None:
+            return qimg
+
+        (left, top, w, h) = self.tileRect(level, tx, ty)
+        if w <= 0 or h <= 0:
+            return None
+
+        out_w = max(1, int(math.ceil(w / (1 << level))))
+        out_h = max(1, int(math.ceil(h / (1 << level))))
+        data = self.read(left, top, w, h, out_w, out_h, display=True)
+        qimg = self.toQImage(data)
+        self.cache.put(key, qimg)
+
+        return qimg
+
+    def read(self, left, top, w, h, out_w=None, out_h=None, display=False):
+        """
+        Read a window of the map (full resolution coordinates), optionally resampled to out_w x out_h.
+        Overviews stored inside the file are automatically used by GDAL when the window is downsampled.
+        If display is True the window is read from the display version of the map, if any.
+        It returns the data as a (h, w, c) numpy array, or as a (h, w) array of depth values.
+        """
+        if out_w is None:
+            out_w = w
+        if out_h is None:
+            out_h = h
+
+        window = Window(left, top, w, h)
+
+        dataset = self.dataset
+        if display and self.display_dataset is not None:
+            dataset = self.display_dataset
+        elif self.type == "DEM":
+            data = dataset.read(1, window=window, out_shape=(out_h, out_w), resampling=Resampling.nearest)
+            return data.astype(np.float32)
+
+        indexes = list(range(1, min(dataset.count, 3) + 1))
+        data = dataset.read(indexes, window=window, out_shape=(len(indexes), out_h, out_w),
+                                 resampling=Resampling.nearest)
+        data = np.moveaxis(data, 0, -1)  # Since Rasterio is channel first shape=(c, h, w)
+        if data.shape[2] == 1:
+            data = np.repeat(data, 3, axis=2)
+        if data.dtype != np.uint8:
+            data = np.clip(data, 0, 255).astype(np.uint8)
+
+        return data
+
+    def computeValueRange(self):
+
+        scale = max(max(self.w, self.h) / self.TILE_SIZE, 1.0)
+        out_w = max(1, int(self.w / scale))
+        out_h = max(1, int(self.h / scale))
+        data = self.read(0, 0, self.w, self.h, out_w, out_h)
+        if self.nodata is not None:
+            data = data[data != self.nodata]
+        data = data[np.isfinite(data)]
+        if data.size == 0:
+            return (0.0, 1.0)
+
+        return (float(data.min()), float(data.max()))
+
+    def toQImage(self, data):
+
+        # depth values
+        if data.ndim == 2:
+            if self.value_range is None:
+                self.value_range = self.computeValueRange()
+            fmap = data.copy()
+            (min_value, max_value) = self.value_range
+            if self.nodata is not None:
+                fmap[fmap == self.nodata] = max_value
+            den = max_value - min_value if max_value > min_value else 1.0
+            fmap = np.clip((fmap - min_value) / den, 0.0, 1.0)
+            fmap = (255.0 * fmap).astype(np.uint8)
+            data = np.stack([fmap, fmap, fmap], axis=-1)
+
+        return genutils.rgbToQImage(data)
+
+    def overview(self, max_size=1024):
+        """
+        It returns a downsampled version of the whole map (as a QImage) with the longest side of max_size pixels.
+        """
+        scale = max(self.w, self.h) / max_size
+        if scale < 1.0:
+            scale = 1.0
+        out_w = max(1, int(self.w / scale))
+        out_h = max(1, int(self.h / scale))
+        data = self.read(0, 0, self.w, self.h, out_w, out_h, display=True)
+        return self.toQImage(data)
+
+    def copy(self, *args):
+        """
+        Same as QImage.copy(): it accepts a QRect or (x, y, w, h) and returns the corresponding full resolution
+        crop as a QImage. The parts outside the map are black (as for QImage).
+        """
+        if len(args) == 0:
+            x, y, w, h = 0, 0, self.w, self.h
+        elif len(args) == 1:
+            rect = args[0]
+            x, y, w, h = rect.x(), rect.y(), rect.width(), rect.height()
+        else:
+            x, y, w, h = args
+
+        x, y, w, h = int(x), int(y), int(w), int(h)
+
+        crop = np.zeros((h, w, 3), dtype=np.uint8) if self.type != "DEM" else np.zeros((h, w), dtype=np.float32)
+
+        left = max(x, 0)
+        top = max(y, 0)
+        right = min(x + w, self.w)
+        bottom = min(y + h, self.h)
+
+        if right > left and bottom > top:
+            data = self.read(left, top, right - left, bottom - top)
+            crop[top - y:bottom - y, left - x:right - x] = data
+
+        return self.toQImage(crop)
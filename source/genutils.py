@@ -20,6 +20,13 @@
 # THIS FILE CONTAINS UTILITY FUNCTIONS, E.G. CONVERSION BETWEEN DATA TYPES, BASIC OPERATIONS, ETC.
 
 import io
+import os
+import zlib
+import struct
+import multiprocessing
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from PyQt5.QtCore import Qt, QObject, QMetaObject, QMetaMethod
 from PyQt5.QtGui import QImage, QPixmap, qRgb, qRgba
 import numpy as np
@@ -45,6 +52,49 @@ def clampCoords(x, y, W, H):
     return (x, y)
 
 
+def parallelMap(fn, items, chunk_size, min_items, workers=None, args=(), count=None):
+    """
+    It splits the items in chunks of chunk_size items and yields the results of fn(chunk, *args), in the order of
+    the chunks. If the items are at least min_items the chunks are processed by a pool of worker processes
+    (workers=None means one for each CPU), otherwise in this process. The items can be an iterator, count is then
+    the number of items; only two chunks per worker are submitted in advance, so the chunks not processed yet
+    are never all in memory.
+
+    The workers are spawned, not forked: a forked worker inherits the Qt state (and the CUDA context) of the main
+    process, which cannot be used safely. A spawned worker imports the module of fn, so fn must be a function
+    defined at the top level of a module, and the chunks and the arguments must be picklable.
+    """
+    if count is None:
+        count = len(items)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    iterator = iter(items)
+    chunks = iter(lambda: list(islice(iterator, chunk_size)), [])
+
+    if workers <= 1 or count < min_items:
+        for chunk in chunks:
+            yield fn(chunk, *args)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(max_workers=max(1, min(workers, math.ceil(count / chunk_size))), mp_context=context)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(fn, chunk, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+    finally:
+        # the chunks not started yet are discarded if the results are not used until the end
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def isValidDate(txt):
     """
     Check if a date in the ISO format YYYY-MM-DD is valid.
@@ -229,6 +279,58 @@ def rgbToQImage(image):
 
     return qimg.copy()
 
+class PNGWriter(object):
+    """
+    Streaming writer of RGBA PNG images: the image is written by strips of rows, so the whole image is never
+    in memory (see Annotation.export_label_map).
+    """
+
+    def __init__(self, filename, width, height, compression=6):
+
+        self.width = width
+        self.height = height
+        self.compressor = zlib.compressobj(compression)
+
+        self.file = open(filename, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, RGBA, no interlace
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def chunk(self, chunk_type, data):
+
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write(self, strip):
+        """
+        Append a strip of rows (a RGBA array of the width of the image).
+        """
+        rows = strip.shape[0]
+
+        # each row is filtered with the Sub filter (difference with the pixel on the left)
+        filtered = np.empty((rows, self.width * 4 + 1), np.uint8)
+        filtered[:, 0] = 1
+        pixels = filtered[:, 1:].reshape(rows, self.width, 4)
+        pixels[:, 0] = strip[:, 0]
+        np.subtract(strip[:, 1:], strip[:, :-1], out=pixels[:, 1:])
+
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.chunk(b"IDAT", data)
+
+    def close(self):
+
+        if self.file is None:
+            return
+
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+        self.file.close()
+        self.file = None
+
+
 def rgbaToQImage(image):
     """
     Convert RGBA numpy array to QImage with alpha channel support.
@@ -508,14 +610,14 @@ def removeOverlapping(created, sam_blobs, annotated = False):
             continue
 
         bbox = blob.bbox
-        mask = blob.getMask()
+        mask = blob.getMask(copy=False)
         npixel = np.count_nonzero(mask)
 
         intersected_blobs = []
 
         for blob2 in sam_blobs:
             if blob != blob2 and checkIntersection(bbox, blob2.bbox) is True:
-                mask2 = blob2.getMask()
+                mask2 = blob2.getMask(copy=False)
                 npixel2 = np.count_nonzero(mask2)
                 (imask, ibbox) = intersectMask(mask, bbox, mask2, blob2.bbox)
                 npixeli = np.count_nonzero(imask)
@@ -161,13 +161,13 @@ class Ritm(Tool):
         self.work_area_mask = np.zeros((h,w), dtype=np.int32)
         for blob in self.viewerplus.image.annotations.seg_blobs:
             if checkIntersection(self.work_area_bbox, blob.bbox):
-                mask = blob.getMask()
+                mask = blob.getMask(copy=False)
                 paintMask(self.work_area_mask, self.work_area_bbox, mask, blob.bbox, 1)
 
     def intersectionWithExistingBlobs(self, blob):
         bigmask = self.work_area_mask.copy()
         pixels_before = np.count_nonzero(bigmask)
-        mask = blob.getMask()
+        mask = blob.getMask(copy=False)
         pixels = np.count_nonzero(mask)
         paintMask(bigmask, self.work_area_bbox, mask, blob.bbox, 0)
         pixels_after = np.count_nonzero(bigmask)